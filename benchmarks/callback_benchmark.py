@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""Measure the execution time of the audio callback.
+
+The C function callback() is invoked directly (without an audio device)
+for all combinations of the given action types, sample formats, numbers
+of active actions, channel counts, channel mappings and block sizes.
+
+The results are written to a JSON file, which can be passed to a later
+run with --compare to show the relative change (e.g. between builds).
+
+NumPy has to be installed.
+
+"""
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import rtmixer
+from _rtmixer import ffi, lib
+
+TYPES = 'play_buffer', 'record_buffer', 'play_ringbuffer', 'record_ringbuffer'
+MAPPINGS = 'identity', 'mono', 'reversed'
+DTYPES = 'float32', 'int16', 'int24', 'int32'
+SAMPLESIZES = {'float32': 4, 'int16': 2, 'int24': 3, 'int32': 4}
+
+
+def get_mapping(name, channels, index):
+    if name == 'identity':
+        return list(range(1, channels + 1))
+    elif name == 'mono':
+        return [index % channels + 1]
+    elif name == 'reversed':
+        return list(range(channels, 0, -1))
+    raise ValueError('unknown mapping: {!r}'.format(name))
+
+
+def next_power_of_2(value):
+    return 1 << max(0, value - 1).bit_length()
+
+
+def benchmark(kind, dtype, actions, channels, mapping, blocksize, blocks,
+              samplerate, pending):
+    stream = rtmixer.VirtualMixerAndRecorder(
+        channels=channels, blocksize=blocksize, samplerate=samplerate,
+        qsize=next_power_of_2(actions + pending + 1),
+        pendingsize=max(pending, 1))
+    playing = kind.startswith('play')
+    frames = (blocks + 2) * blocksize  # Actions must not finish too early
+    shared_buffers = {}  # One buffer per channel count, used by all actions
+    ringbuffers = []
+    for index in range(actions):
+        action_mapping = get_mapping(mapping, channels, index)
+        buffer_channels = len(action_mapping)
+        if kind.endswith('ringbuffer'):
+            rb = rtmixer.RingBuffer(SAMPLESIZES[dtype] * buffer_channels,
+                                    next_power_of_2(blocksize))
+            ringbuffers.append(rb)
+            if playing:
+                stream.play_ringbuffer(rb, action_mapping, dtype=dtype)
+            else:
+                stream.record_ringbuffer(rb, action_mapping, dtype=dtype)
+        else:
+            buffer = shared_buffers.setdefault(
+                buffer_channels,
+                np.zeros(frames * buffer_channels * SAMPLESIZES[dtype],
+                         dtype='uint8'))
+            if playing:
+                stream.play_buffer(buffer, action_mapping, dtype=dtype)
+            else:
+                stream.record_buffer(buffer, action_mapping, dtype=dtype)
+    # All buffers/ringbuffers are referenced by the actions.
+
+    # Actions which are scheduled after the end of the benchmark:
+    later = (blocks + 2) * blocksize / samplerate
+    silence = np.zeros((1, 1), dtype='float32')
+    for _ in range(pending):
+        stream.play_buffer(silence, [1], start=later)
+    actions += pending
+
+    input_buffer = ffi.new('float[]', blocksize * channels)
+    output_buffer = ffi.new('float[]', blocksize * channels)
+    timeinfo = ffi.new('PaStreamCallbackTimeInfo*')
+    callback = lib.callback
+    durations = []
+    for block in range(blocks + 1):
+        for rb in ringbuffers:
+            if playing:
+                rb.advance_write_index(rb.write_available)
+            else:
+                rb.advance_read_index(rb.read_available)
+        now = block * blocksize / samplerate
+        timeinfo.inputBufferAdcTime = now
+        timeinfo.currentTime = now
+        timeinfo.outputBufferDacTime = now
+        start = time.perf_counter_ns()
+        result = callback(input_buffer, output_buffer, blocksize, timeinfo,
+                          0, stream._state)
+        durations.append(time.perf_counter_ns() - start)
+        if result != lib.paContinue:
+            raise RuntimeError('callback was aborted')
+    active = len(stream.actions)
+    stream.close()
+    if active != actions:
+        raise RuntimeError('{} of {} actions were finished early'.format(
+            actions - active, actions))
+    # The first invocation moves the actions from the queue into the list:
+    durations = np.array(durations[1:], dtype='float64')
+    ns_per_block = float(np.median(durations))
+    actions -= pending
+    return {
+        'type': kind,
+        'dtype': dtype,
+        'actions': actions,
+        'pending': pending,
+        'channels': channels,
+        'mapping': mapping,
+        'blocksize': blocksize,
+        'blocks': blocks,
+        'samplerate': samplerate,
+        'ns_per_block': ns_per_block,
+        'ns_per_block_mean': float(durations.mean()),
+        'ns_per_block_max': float(durations.max()),
+        'ns_per_frame': ns_per_block / blocksize,
+        'ns_per_frame_and_action': ns_per_block / blocksize / actions,
+        'deadline_fraction': ns_per_block * 1e-9 * samplerate / blocksize,
+    }
+
+
+def key(result):
+    return (result['type'], result.get('dtype', 'float32')) + tuple(
+        result[name] for name in (
+            'actions', 'pending', 'channels', 'mapping', 'blocksize'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--types', nargs='+', choices=TYPES, default=TYPES)
+    parser.add_argument('--dtypes', nargs='+', choices=DTYPES,
+                        default=['float32'])
+    parser.add_argument('--actions', nargs='+', type=int,
+                        default=[1, 10, 100, 1000, 2000])
+    parser.add_argument('--channels', nargs='+', type=int, default=[1, 2, 8])
+    parser.add_argument('--mappings', nargs='+', choices=MAPPINGS,
+                        default=MAPPINGS)
+    parser.add_argument('--blocksizes', nargs='+', type=int,
+                        default=[64, 256, 1024])
+    parser.add_argument('--pending', nargs='+', type=int, default=[0],
+                        help='numbers of additional actions which are '
+                        'scheduled to start after the benchmark')
+    parser.add_argument('--blocks', type=int, default=50,
+                        help='number of measured callback invocations')
+    parser.add_argument('--samplerate', type=float, default=48000)
+    parser.add_argument('-o', '--output', default='callback_benchmark.json',
+                        help='JSON file for the results')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='results of a previous run')
+    args = parser.parse_args()
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {key(r): r for r in json.load(f)['results']}
+
+    results = []
+    for kind, dtype in itertools.product(args.types, args.dtypes):
+        for channels in args.channels:
+            for mapping in args.mappings:
+                if channels == 1 and mapping != 'identity':
+                    continue  # All mappings are the same
+                for blocksize in args.blocksizes:
+                    for actions, pending in itertools.product(
+                            args.actions, args.pending):
+                        result = benchmark(
+                            kind, dtype, actions, channels, mapping,
+                            blocksize, args.blocks, args.samplerate, pending)
+                        results.append(result)
+                        line = ('{type:17} {dtype:7} {actions:5} actions '
+                                '{pending:5} pending {channels:3}ch '
+                                '{mapping:8} {blocksize:5} frames: '
+                                '{ns_per_block:12.0f} ns/block '
+                                '{ns_per_frame:9.1f} ns/frame '
+                                '{deadline_fraction:7.2%} of deadline'
+                                ).format(**result)
+                        old = previous.get(key(result))
+                        if old:
+                            line += ' ({:+.1%})'.format(
+                                result['ns_per_block'] / old['ns_per_block']
+                                - 1)
+                        print(line)
+                        sys.stdout.flush()
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'rtmixer_version': rtmixer.__version__,
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'results': results,
+        }, f, indent=2)
+    print('results written to', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -29,12 +29,10 @@ channels = None
 if duration_min < max(attack, release):
     raise ValueError('minimum duration is too short')
 
-fade_in = np.linspace(0, 1, num=int(samplerate * attack))
-fade_out = np.linspace(1, 0, num=int(samplerate * release))
-
 r = np.random.RandomState(seed)
 
 bleeplist = []
+amplitudes = []
 
 if channels is None:
     channels = sd.default.channels['output']
@@ -48,22 +46,20 @@ for _ in range(bleeps):
     # Convert MIDI pitch (https://en.wikipedia.org/wiki/MIDI_Tuning_Standard)
     frequency = 2 ** ((pitch - 69) / 12) * 440
     t = np.arange(int(samplerate * duration)) / samplerate
-    bleep = amplitude * np.sin(2 * np.pi * frequency * t, dtype='float32')
-    bleep[:len(fade_in)] *= fade_in
-    bleep[-len(fade_out):] *= fade_out
+    bleep = np.sin(2 * np.pi * frequency * t, dtype='float32')
 
-    # Note: Arrays must be 32-bit float and C contiguous!
-    assert bleep.dtype == 'float32'
+    # Note: play_buffers() uses the arrays as they are, with their own dtype
+    # (float32, int16 or int32), but they must be C contiguous!
     assert bleep.flags.c_contiguous
     bleeplist.append(bleep)
+    amplitudes.append(amplitude)
 
 with rtmixer.Mixer(device=device, channels=channels, blocksize=blocksize,
-                   samplerate=samplerate, latency=latency, qsize=512) as m:
+                   samplerate=samplerate, latency=latency) as m:
     start_time = m.time
-    for bleep in bleeplist:
-        m.play_buffer(bleep,
-                      channels=[r.randint(channels) + 1],
-                      start=start_time + r.uniform(start_min, start_max))
-    while m.actions:
-        sd.sleep(100)
+    m.play_buffers(bleeplist,
+                   channels=[[r.randint(channels) + 1] for _ in bleeplist],
+                   start=start_time + r.uniform(start_min, start_max, bleeps),
+                   gain=amplitudes, attack=attack, release=release)
+    m.wait()
     # TODO: check for xruns
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""Show a text-mode level meter of the input signal(s).
+
+The levels are measured in the audio callback, only a few values per
+channel are transferred to Python.
+
+"""
+import math
+import time
+
+import rtmixer
+
+device = None
+channels = 2
+interval = 0.05  # seconds
+width = 50  # characters
+floor = -60  # dB
+
+
+def db(value):
+    return 20 * math.log10(value) if value > 0 else -math.inf
+
+
+def bar(levels, channel):
+    rms = max(db(levels.rms[channel]), floor)
+    peak = max(db(levels.peak[channel]), floor)
+    rms_chars = int(width * (1 - rms / floor))
+    peak_char = min(int(width * (1 - peak / floor)), width - 1)
+    line = ['#'] * rms_chars + [' '] * (width - rms_chars)
+    line[peak_char] = '!' if levels.clipped[channel] else '|'
+    return ''.join(line)
+
+
+with rtmixer.Recorder(device=device, channels=channels,
+                      metering=True) as stream:
+    try:
+        while True:
+            time.sleep(interval)
+            levels = stream.input_levels()
+            print(' '.join('[' + bar(levels, c) + ']'
+                           for c in range(channels)), end='\r', flush=True)
+    except KeyboardInterrupt:
+        print()
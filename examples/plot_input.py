@@ -28,14 +28,12 @@ def update_plot(frame):
     while q.read_available >= stepsize:
         # The ring buffer's size is a multiple of stepsize, therefore we know
         # that the data is contiguous in memory (= the 2nd buffer is empty):
-        read, buf1, buf2 = q.get_read_buffers(stepsize)
+        read, buffer, empty = q.get_read_arrays(stepsize)
         assert read == stepsize
-        assert not buf2
-        buffer = np.frombuffer(buf1, dtype='float32')
-        buffer.shape = -1, channels
-        buffer = buffer[::downsample]
+        assert not len(empty)
+        assert buffer.shape == (stepsize, channels)
         # BTW, "buffer" still uses the ring buffer's memory:
-        assert buffer.base.base == buf1
+        buffer = buffer[::downsample]
         shift = len(buffer)
         plotdata = np.roll(plotdata, -shift, axis=0)
         plotdata[-shift:, :] = buffer
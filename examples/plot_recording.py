@@ -35,9 +35,8 @@ with rtmixer.Recorder(channels=channels, blocksize=blocksize,
             print(tick, end='', flush=True)
             time.sleep(sleeptime)
         print(' recording! (press Ctrl+C to stop)', end='', flush=True)
-        while action in m.actions:
+        while not m.wait(action, timeout=sleeptime):
             print('.', end='', flush=True)
-            time.sleep(sleeptime)
         print(' done.')
     except KeyboardInterrupt:
         m.cancel(action)
@@ -1,8 +1,14 @@
 # This is used to create the _rtmixer extension module (see setup.py).
 
+# By default, the extension module is built in release mode.  Set the
+# environment variable RTMIXER_DEBUG=1 to enable assertions in the callback.
+
 from cffi import FFI
+import os
 import platform
 
+debug = os.environ.get('RTMIXER_DEBUG', '0') not in ('', '0')
+
 if platform.system() == 'Darwin':
     ring_buffer_size_t = 'int32_t'
 else:
@@ -14,8 +20,19 @@ ffibuilder.cdef("""
 /* From portaudio.h: */
 
 typedef double PaTime;
-typedef struct PaStreamCallbackTimeInfo PaStreamCallbackTimeInfo;
+typedef struct PaStreamCallbackTimeInfo
+{
+    PaTime inputBufferAdcTime;
+    PaTime currentTime;
+    PaTime outputBufferDacTime;
+} PaStreamCallbackTimeInfo;
 typedef unsigned long PaStreamCallbackFlags;
+typedef enum PaStreamCallbackResult
+{
+    paContinue=0,
+    paComplete=1,
+    paAbort=2
+} PaStreamCallbackResult;
 
 /* From pa_ringbuffer.h: */
 
@@ -52,8 +69,11 @@ ffibuilder.set_source(
     include_dirs=['src', 'portaudio/include', 'portaudio/src/common'],
     sources=['portaudio/src/common/pa_ringbuffer.c'],
     #extra_compile_args=['-Wconversion'],
-    # TODO: release mode by default, option for using debug mode
-    undef_macros=['NDEBUG'],
+    # Without floating point traps, sample conversions can be vectorized:
+    extra_compile_args=[] if debug or platform.system() == 'Windows'
+    else ['-O3', '-fno-trapping-math'],
+    define_macros=[] if debug else [('NDEBUG', None)],
+    undef_macros=['NDEBUG'] if debug else [],
 )
 
 if __name__ == '__main__':
@@ -13,10 +13,10 @@ setup(
     version=__version__,
     package_dir={'': 'src'},
     py_modules=['rtmixer'],
-    setup_requires=['CFFI>=1.4.0'],
+    setup_requires=['CFFI>=1.12'],
     cffi_modules=['rtmixer_build.py:ffibuilder'],
-    install_requires=['sounddevice>0.3.6'],
-    extras_require={'NumPy': ['NumPy']},
+    install_requires=['CFFI>=1.12', 'sounddevice>0.3.6'],
+    extras_require={'NumPy': ['NumPy'], 'soundfile': ['soundfile>=0.9.0']},
     author='Matthias Geier',
     author_email='Matthias.Geier@gmail.com',
     description='Reliable low-latency audio playback and recording',
@@ -1,207 +1,1556 @@
 /* See ../rtmixer_build.py */
 
-#include <math.h>  // for llround()
+#include <math.h>  // for llround(), expf(), powf(), fabsf()
 #include <stdbool.h>  // for bool, true, false
+#include <stdint.h>  // for int16_t, int32_t, uint32_t, INT32_MAX, INT32_MIN
+#include <string.h>  // for memcpy(), memset()
+#ifdef _WIN32
+#include <io.h>  // for _write()
+#define write _write
+#define WIN32_LEAN_AND_MEAN
+#include <windows.h>  // for QueryPerformanceCounter()
+#else
+#include <time.h>  // for clock_gettime()
+#include <unistd.h>  // for write()
+#endif
+
+#include <portaudio.h>
+#include <pa_ringbuffer.h>
+#include <pa_memorybarrier.h>
+
+#include "rtmixer.h"
+
+#ifdef NDEBUG
+#define CALLBACK_ASSERT(expr) ((void)(0))
+#else
+#define CALLBACK_ASSERT(expr) \
+  do { if (!(expr)) { \
+    printf("Failed assertion in audio callback: \"" #expr "\" (" __FILE__ \
+        ":%i)\n", __LINE__); \
+    return paAbort; \
+  }} while (false)
+#endif
+
+// Integer samples are converted in chunks of this many samples:
+#define SCRATCH_SAMPLES 1024
+
+// At most this many voices are stolen in one block, see steal_voices():
+#define MAX_STEALS 16
+
+// Finished actions are collected in a list, which is sent to result_q as a
+// whole at the end of the callback, see send_results().
+// Unless another end_reason was set before, the action is COMPLETED.
+void finish_action(struct action* action, struct state* state)
+{
+  if (action->end_reason == RUNNING)
+  {
+    action->end_reason = COMPLETED;
+  }
+  action->next = state->finished;
+  action->status = FINISHED;
+  state->finished = action;
+  state->load.finished++;
+}
+
+// Send the list of finished actions (newest first) with a single write.
+// If result_q is full, the list is kept and sent in one of the next blocks.
+bool send_results(struct state* state)
+{
+  if (state->finished
+      && PaUtil_WriteRingBuffer(state->result_q, &state->finished, 1))
+  {
+    state->finished = NULL;
+    return true;
+  }
+  return false;
+}
+
+// Wake up the (non-realtime) thread which is waiting for results.
+// The file descriptor is expected to be non-blocking.  If the pipe is full,
+// there are enough unread notifications anyway, so errors are ignored.
+void notify_results(const struct state* state)
+{
+  if (state->result_fd >= 0)
+  {
+    const char message = 0;
+    if (write(state->result_fd, &message, 1) != 1)
+    {
+      // Nothing to be done
+    }
+  }
+}
+
+// The segments of a playlist are linked via their "next" pointers.
+// Segments which are still in the playlist's queue are discarded by the
+// Python code.
+void finish_segments(struct action* playlist, struct state* state)
+{
+  struct action* segment = playlist->segment;
+  while (segment)
+  {
+    struct action* const next = segment->next;
+    segment->end_reason = CANCELLED;  // Completed segments aren't in the list
+    finish_action(segment, state);
+    segment = next;
+  }
+  playlist->segment = NULL;
+}
+
+void remove_action(struct action** addr, struct state* state)
+{
+  struct action* action = *addr;
+  *addr = action->next;  // Current action is removed from list
+  if (action->type == PLAY_PLAYLIST)
+  {
+    finish_segments(action, state);
+  }
+  finish_action(action, state);
+}
+
+bool is_playing(enum actiontype type)
+{
+  return type == PLAY_BUFFER || type == PLAY_RINGBUFFER
+    || type == PLAY_PLAYLIST;
+}
+
+bool is_control(enum actiontype type)
+{
+  return type == CANCEL || type == CANCEL_ALL || type == SET_GAIN;
+}
+
+void activate_action(struct action* action, struct state* state)
+{
+  // Actions are added at the beginning of the list, because it's easier.
+  // CANCEL actions are kept in a separate list, because they have to be
+  // handled before the actions they are cancelling.
+  struct action** list = is_control(action->type) ? &(state->controls)
+                                                  : &(state->actions);
+  action->next = *list;
+  *list = action;
+  action->status = ACTIVE;
+}
+
+// Check the channel mapping and select the kernel for shoving audio data.
+// This is done once per action, so that the kernels don't have to check
+// anything.
+bool prepare_action(struct action* action, const struct state* state)
+{
+  if (is_control(action->type))
+  {
+    return true;
+  }
+  const frame_t max_channel = is_playing(action->type)
+    ? state->output_channels : state->input_channels;
+  if (action->channels > SCRATCH_SAMPLES
+      && (action->sampleformat != FLOAT32_FORMAT || action->gain != 1.0f
+        || action->channel_gains || action->attack || action->release
+        || action->routes || action->bus))
+  {
+    return false;  // Too many channels for the scratch buffer
+  }
+  if ((action->routes || action->bus) && !is_playing(action->type))
+  {
+    return false;  // Only supported for playback
+  }
+  if (action->type == PLAY_BUFFER
+      && (action->position > action->buffer_frames
+        || action->loop_end > action->buffer_frames
+        || (action->loop_end && action->loop_start >= action->loop_end)
+        || (action->position >= action->loop_end
+          && action->total_frames
+             > action->buffer_frames - action->position)))
+  {
+    return false;  // This would read beyond the end of the buffer
+  }
+  if (action->routes)
+  {
+    for (frame_t r = 0; r < action->route_count; r++)
+    {
+      const struct route* const route = action->routes + r;
+      if (route->source < 1 || route->source > action->channels
+          || route->target < 1 || route->target > max_channel)
+      {
+        return false;
+      }
+    }
+    action->kernel = MATRIX;
+    return true;
+  }
+  bool contiguous = true;
+  for (frame_t c = 0; c < action->channels; c++)
+  {
+    if (action->mapping[c] < 1 || action->mapping[c] > max_channel)
+    {
+      return false;
+    }
+    if (action->mapping[c] != action->mapping[0] + c)
+    {
+      contiguous = false;
+    }
+  }
+  if (action->channels == 1)
+  {
+    action->kernel = MONO;
+  }
+  else if (contiguous)
+  {
+    action->kernel = CONTIGUOUS;
+  }
+  else
+  {
+    action->kernel = GENERIC;
+  }
+  return true;
+}
+
+// Add frames to the device buffer according to the action's routes.
+// All routes are handled in a single pass over the source data.
+// This is only used by play_frames_gain(), which keeps play_float() small.
+void play_matrix(const struct action* action, float* device_data
+  , frame_t device_channels, const float* buffer, frame_t frames)
+{
+  while (frames--)
+  {
+    for (frame_t r = 0; r < action->route_count; r++)
+    {
+      const struct route* const route = action->routes + r;
+      device_data[route->target - 1]
+        += buffer[route->source - 1] * route->gain;
+    }
+    device_data += device_channels;
+    buffer += action->channels;
+  }
+}
+
+// Add frames from an interleaved buffer to the (interleaved) device buffer.
+// The kernels are inlined into the format-specific functions below.
+static inline void play_float(const struct action* action, float* device_data
+  , frame_t device_channels, const float* buffer, frame_t frames)
+{
+  const frame_t channels = action->channels;
+  device_data += action->mapping[0] - 1;
+  switch (action->kernel)
+  {
+    case MONO:
+      for (frame_t i = 0; i < frames; i++)
+      {
+        device_data[i * device_channels] += buffer[i];
+      }
+      break;
+    case CONTIGUOUS:
+      if (channels == device_channels)
+      {
+        for (frame_t i = 0; i < frames * channels; i++)
+        {
+          device_data[i] += buffer[i];
+        }
+        break;
+      }
+      while (frames--)
+      {
+        for (frame_t c = 0; c < channels; c++)
+        {
+          device_data[c] += buffer[c];
+        }
+        device_data += device_channels;
+        buffer += channels;
+      }
+      break;
+    case GENERIC:
+      device_data -= action->mapping[0] - 1;
+      while (frames--)
+      {
+        for (frame_t c = 0; c < channels; c++)
+        {
+          device_data[action->mapping[c] - 1] += *buffer++;
+        }
+        device_data += device_channels;
+      }
+      break;
+    case MATRIX:
+      break;  // See play_matrix()
+  }
+}
+
+// Copy frames from the (interleaved) device buffer to an interleaved buffer.
+static inline void record_float(const struct action* action
+  , const float* device_data, frame_t device_channels, float* buffer
+  , frame_t frames)
+{
+  if (frames == 0)
+  {
+    return;  // buffer may be NULL
+  }
+  const frame_t channels = action->channels;
+  device_data += action->mapping[0] - 1;
+  switch (action->kernel)
+  {
+    case MONO:
+      for (frame_t i = 0; i < frames; i++)
+      {
+        buffer[i] = device_data[i * device_channels];
+      }
+      break;
+    case CONTIGUOUS:
+      if (channels == device_channels)
+      {
+        memcpy(buffer, device_data, sizeof(float) * frames * channels);
+        break;
+      }
+      while (frames--)
+      {
+        memcpy(buffer, device_data, sizeof(float) * channels);
+        device_data += device_channels;
+        buffer += channels;
+      }
+      break;
+    case GENERIC:
+      device_data -= action->mapping[0] - 1;
+      while (frames--)
+      {
+        for (frame_t c = 0; c < channels; c++)
+        {
+          *buffer++ = device_data[action->mapping[c] - 1];
+        }
+        device_data += device_channels;
+      }
+      break;
+    case MATRIX:
+      break;  // Only used for playback, see prepare_action()
+  }
+}
+
+frame_t sample_size(enum sampleformat format)
+{
+  switch (format)
+  {
+    case INT16_FORMAT:
+      return 2;
+    case INT24_FORMAT:
+      return 3;
+    default:
+      return 4;
+  }
+}
+
+void int_to_float(const void* data, float* out, frame_t samples
+  , enum sampleformat format)
+{
+  if (format == INT16_FORMAT)
+  {
+    const int16_t* in = data;
+    for (frame_t i = 0; i < samples; i++)
+    {
+      out[i] = in[i] * (1.0f / 32768.0f);
+    }
+  }
+  else if (format == INT24_FORMAT)
+  {
+    const unsigned char* in = data;
+    for (frame_t i = 0; i < samples; i++, in += 3)
+    {
+      // The sample is put into the upper 3 bytes to get the sign right
+      const int32_t value = (int32_t)((uint32_t)in[0] << 8
+        | (uint32_t)in[1] << 16 | (uint32_t)in[2] << 24);
+      out[i] = (float)value * (1.0f / 2147483648.0f);
+    }
+  }
+  else
+  {
+    const int32_t* in = data;
+    for (frame_t i = 0; i < samples; i++)
+    {
+      out[i] = (float)in[i] * (1.0f / 2147483648.0f);
+    }
+  }
+}
+
+// Round to nearest (halfway cases away from zero).  Unlike lrintf(), this
+// doesn't prevent vectorization.
+static inline float round_sample(float value)
+{
+  return value < 0.0f ? value - 0.5f : value + 0.5f;
+}
+
+// Values outside of the range [-1.0, 1.0] are clipped.
+static inline int32_t float_to_int32(float value)
+{
+  if (value >= 1.0f)
+  {
+    return INT32_MAX;
+  }
+  if (value <= -1.0f)
+  {
+    return INT32_MIN;
+  }
+  const double scaled = value * 2147483648.0;
+  return (int32_t)(scaled < 0.0 ? scaled - 0.5 : scaled + 0.5);
+}
+
+void float_to_int(const float* in, void* data, frame_t samples
+  , enum sampleformat format)
+{
+  if (format == INT16_FORMAT)
+  {
+    int16_t* out = data;
+    for (frame_t i = 0; i < samples; i++)
+    {
+      float value = in[i] * 32768.0f;
+      value = value > 32767.0f ? 32767.0f : value < -32768.0f ? -32768.0f
+                                                              : value;
+      out[i] = (int16_t)round_sample(value);
+    }
+  }
+  else if (format == INT24_FORMAT)
+  {
+    unsigned char* out = data;
+    for (frame_t i = 0; i < samples; i++, out += 3)
+    {
+      float value = in[i] * 8388608.0f;
+      value = value > 8388607.0f ? 8388607.0f : value < -8388608.0f
+                                              ? -8388608.0f : value;
+      const uint32_t bits = (uint32_t)(int32_t)round_sample(value);
+      out[0] = (unsigned char)bits;
+      out[1] = (unsigned char)(bits >> 8);
+      out[2] = (unsigned char)(bits >> 16);
+    }
+  }
+  else
+  {
+    int32_t* out = data;
+    for (frame_t i = 0; i < samples; i++)
+    {
+      out[i] = float_to_int32(in[i]);
+    }
+  }
+}
+
+void play_frames(const struct action* action, float* device_data
+  , frame_t device_channels, const void* data, frame_t frames)
+{
+  if (action->sampleformat == FLOAT32_FORMAT)
+  {
+    play_float(action, device_data, device_channels, data, frames);
+    return;
+  }
+  float scratch[SCRATCH_SAMPLES];
+  const frame_t chunk = SCRATCH_SAMPLES / action->channels;
+  const frame_t chunk_bytes
+    = chunk * action->channels * sample_size(action->sampleformat);
+  while (frames)
+  {
+    const frame_t n = frames < chunk ? frames : chunk;
+    int_to_float(data, scratch, n * action->channels, action->sampleformat);
+    play_float(action, device_data, device_channels, scratch, n);
+    data = (const char*)data + chunk_bytes;
+    device_data += n * device_channels;
+    frames -= n;
+  }
+}
+
+void record_frames(const struct action* action, const float* device_data
+  , frame_t device_channels, void* data, frame_t frames)
+{
+  if (action->sampleformat == FLOAT32_FORMAT)
+  {
+    record_float(action, device_data, device_channels, data, frames);
+    return;
+  }
+  float scratch[SCRATCH_SAMPLES];
+  const frame_t chunk = SCRATCH_SAMPLES / action->channels;
+  const frame_t chunk_bytes
+    = chunk * action->channels * sample_size(action->sampleformat);
+  while (frames)
+  {
+    const frame_t n = frames < chunk ? frames : chunk;
+    record_float(action, device_data, device_channels, scratch, n);
+    float_to_int(scratch, data, n * action->channels, action->sampleformat);
+    data = (char*)data + chunk_bytes;
+    device_data += n * device_channels;
+    frames -= n;
+  }
+}
+
+// Gain of a fade-in at "x" (from 0 to 1).  Exponential fades are linear in
+// dB, starting at -60 dB.
+static inline float fade_gain(float x, enum curve curve)
+{
+  return curve == EXPONENTIAL ? expf(6.9077553f * (x - 1.0f)) : x;
+}
+
+// Check if the action's gain can be ignored for "frames" frames, starting
+// with frame number "pos" of the action.
+static inline bool unity_gain(const struct action* action, frame_t pos
+  , frame_t frames)
+{
+  return action->gain == 1.0f && !action->gain_ramp && !action->channel_gains
+    && pos >= action->attack
+    && action->total_frames - pos - frames >= action->release;
+}
+
+// Like play_frames(), but the samples are multiplied by the action's gain
+// (including fades and per-channel gains) and by an additional linear ramp
+// (used for crossfades and buses), starting with "ramp" and changing by
+// "ramp_step" per frame.  "pos" is the number of the first frame within the
+// action.  A running gain ramp (see SET_GAIN) is advanced.
+void play_frames_gain(struct action* action, float* device_data
+  , frame_t device_channels, const void* data, frame_t frames, frame_t pos
+  , float ramp, float ramp_step)
+{
+  float scratch[SCRATCH_SAMPLES];
+  const frame_t channels = action->channels;
+  const frame_t chunk = SCRATCH_SAMPLES / channels;
+  const frame_t chunk_bytes
+    = chunk * channels * sample_size(action->sampleformat);
+  while (frames)
+  {
+    const frame_t n = frames < chunk ? frames : chunk;
+    if (action->sampleformat == FLOAT32_FORMAT)
+    {
+      memcpy(scratch, data, sizeof(float) * n * channels);
+    }
+    else
+    {
+      int_to_float(data, scratch, n * channels, action->sampleformat);
+    }
+    if (!action->gain_ramp && ramp_step == 0.0f && pos >= action->attack
+        && action->total_frames - pos - n >= action->release)
+    {
+      // Constant gain
+      const float gain = action->gain * ramp;
+      if (action->channel_gains)
+      {
+        for (frame_t i = 0; i < n; i++)
+        {
+          for (frame_t c = 0; c < channels; c++)
+          {
+            scratch[i * channels + c] *= gain * action->channel_gains[c];
+          }
+        }
+      }
+      else
+      {
+        for (frame_t i = 0; i < n * channels; i++)
+        {
+          scratch[i] *= gain;
+        }
+      }
+    }
+    else
+    {
+      for (frame_t i = 0; i < n; i++)
+      {
+        const frame_t k = pos + i;
+        if (action->gain_delay)
+        {
+          action->gain_delay--;
+        }
+        else if (action->gain_ramp)
+        {
+          if (action->gain_curve == EXPONENTIAL)
+          {
+            action->gain *= action->gain_step;
+          }
+          else
+          {
+            action->gain += action->gain_step;
+          }
+          if (--action->gain_ramp == 0)
+          {
+            action->gain = action->target_gain;
+          }
+        }
+        float gain = action->gain * ramp;
+        ramp += ramp_step;
+        if (k < action->attack)
+        {
+          gain *= fade_gain(((float)k + 0.5f) / (float)action->attack
+            , action->fade_curve);
+        }
+        const frame_t remaining = action->total_frames - k;
+        if (remaining <= action->release)
+        {
+          gain *= fade_gain(((float)remaining - 0.5f) / (float)action->release
+            , action->fade_curve);
+        }
+        for (frame_t c = 0; c < channels; c++)
+        {
+          scratch[i * channels + c] *= action->channel_gains
+            ? gain * action->channel_gains[c] : gain;
+        }
+      }
+    }
+    if (action->kernel == MATRIX)
+    {
+      play_matrix(action, device_data, device_channels, scratch, n);
+    }
+    else
+    {
+      play_float(action, device_data, device_channels, scratch, n);
+    }
+    data = (const char*)data + chunk_bytes;
+    device_data += n * device_channels;
+    frames -= n;
+    pos += n;
+  }
+}
+
+// Play "frames" frames, starting with frame number "pos" of the action.
+// Unless "ramp" is 1 and "ramp_step" is 0, an additional gain ramp is
+// applied (see above).  Routes are always handled by play_frames_gain().
+static inline void play_frames_at(struct action* action, float* device_data
+  , frame_t device_channels, const void* data, frame_t frames, frame_t pos
+  , float ramp, float ramp_step)
+{
+  if (ramp == 1.0f && ramp_step == 0.0f && action->kernel != MATRIX
+      && unity_gain(action, pos, frames))
+  {
+    play_frames(action, device_data, device_channels, data, frames);
+  }
+  else
+  {
+    play_frames_gain(action, device_data, device_channels, data, frames
+      , pos, ramp, ramp_step);
+  }
+}
+
+// Play from "position", jumping back to "loop_start" at "loop_end" as long
+// as more frames remain to be played than there are after "loop_end".
+// "ramp" and "ramp_step" are used for crossfades and buses, see
+// play_frames_gain().
+void play_buffer_frames(struct action* action, float* device_data
+  , frame_t device_channels, frame_t frames, float ramp, float ramp_step)
+{
+  const frame_t framesize
+    = action->channels * sample_size(action->sampleformat);
+  while (frames)
+  {
+    frame_t end = action->buffer_frames;
+    if (action->position < action->loop_end)
+    {
+      end = action->loop_end;
+    }
+    frame_t chunk = end - action->position;
+    if (chunk > frames)
+    {
+      chunk = frames;
+    }
+    const char* data = (char*)action->buffer + action->position * framesize;
+    play_frames_at(action, device_data, device_channels, data, chunk
+      , action->done_frames, ramp, ramp_step);
+    ramp += ramp_step * (float)chunk;
+    device_data += chunk * device_channels;
+    action->position += chunk;
+    action->done_frames += chunk;
+    frames -= chunk;
+    if (action->position == action->loop_end
+        && action->total_frames - action->done_frames
+           > action->buffer_frames - action->loop_end)
+    {
+      action->position = action->loop_start;
+    }
+  }
+}
+
+// Multiply two linear ramps over "frames" frames (see play_frames_gain()).
+// The product is interpolated linearly between the exact values at both
+// ends, which is exact if one of the ramps is constant.
+// Returns the initial value, the change per frame is stored in "step".
+static inline float multiply_ramps(float a, float a_step, float b
+  , float b_step, frame_t frames, float* step)
+{
+  const float start = a * b;
+  const float end
+    = (a + a_step * (float)frames) * (b + b_step * (float)frames);
+  *step = (end - start) / (float)frames;
+  return start;
+}
+
+// Get the next valid segment from the queue of a playlist (or NULL).
+struct action* next_segment(struct action* playlist, struct state* state)
+{
+  struct action* segment = NULL;
+  while (PaUtil_ReadRingBuffer(playlist->ringbuffer, &segment, 1))
+  {
+    segment->next = NULL;
+    if (segment->type == PLAY_BUFFER && prepare_action(segment, state)
+        && ((!playlist->crossfade && !playlist->bus)
+          || segment->channels <= SCRATCH_SAMPLES))
+    {
+      segment->status = ACTIVE;
+      return segment;
+    }
+    segment->end_reason = INVALID;
+    finish_action(segment, state);  // Invalid segment, it is discarded
+  }
+  return NULL;
+}
+
+// Play the segments of a playlist back to back.  The following segment is
+// taken from the queue as soon as possible, which allows crossfading it
+// with the end of the current segment.
+// "time" is the time of the first frame in "device_data".
+// "ramp" and "ramp_step" are the gain of the playlist's bus (if any), see
+// get_bus_ramp().
+// Returns the number of played frames, which is less than "frames" if the
+// queue has run dry.
+frame_t play_playlist(struct action* playlist, float* device_data
+  , frame_t device_channels, frame_t frames, PaTime time, float ramp
+  , float ramp_step, struct state* state)
+{
+  frame_t played = 0;
+  while (played < frames)
+  {
+    struct action* current = playlist->segment;
+    if (!current)
+    {
+      current = playlist->segment = next_segment(playlist, state);
+      if (!current)
+      {
+        break;
+      }
+    }
+    const frame_t remaining = current->total_frames - current->done_frames;
+    if (!current->next)
+    {
+      current->next = next_segment(playlist, state);
+      if (current->next)
+      {
+        // The overlap is shortened if the new segment came too late
+        playlist->fade = playlist->crossfade;
+        if (playlist->fade > remaining)
+        {
+          playlist->fade = remaining;
+        }
+        if (playlist->fade > current->next->total_frames)
+        {
+          playlist->fade = current->next->total_frames;
+        }
+      }
+    }
+    struct action* const next = current->next;
+    const frame_t fade = next ? playlist->fade : 0;
+    const PaTime chunk_time = time + (double)played / state->samplerate;
+    float* const chunk_data = device_data + played * device_channels;
+    const float chunk_ramp = ramp + ramp_step * (float)played;
+    frame_t chunk = frames - played;
+    if (current->done_frames == 0)
+    {
+      current->actual_time = chunk_time;
+    }
+    if (remaining > fade)
+    {
+      if (chunk > remaining - fade)
+      {
+        chunk = remaining - fade;
+      }
+      play_buffer_frames(current, chunk_data, device_channels, chunk
+        , chunk_ramp, ramp_step);
+    }
+    else if (remaining)
+    {
+      if (chunk > remaining)
+      {
+        chunk = remaining;
+      }
+      if (next->done_frames == 0)
+      {
+        next->actual_time = chunk_time;
+      }
+      const float step = 1.0f / (float)fade;
+      const float gain = ((float)(fade - remaining) + 0.5f) * step;
+      float out_step = 0.0f;
+      float in_step = 0.0f;
+      const float out = multiply_ramps(1.0f - gain, -step, chunk_ramp
+        , ramp_step, chunk, &out_step);
+      const float in = multiply_ramps(gain, step, chunk_ramp, ramp_step
+        , chunk, &in_step);
+      play_buffer_frames(current, chunk_data, device_channels, chunk
+        , out, out_step);
+      play_buffer_frames(next, chunk_data, device_channels, chunk
+        , in, in_step);
+    }
+    else
+    {
+      chunk = 0;
+    }
+    played += chunk;
+    if (current->done_frames == current->total_frames)
+    {
+      playlist->segment = next;
+      finish_action(current, state);
+    }
+  }
+  return played;
+}
+
+void get_stats(PaStreamCallbackFlags flags, struct stats* stats)
+{
+  stats->blocks++;
+
+  if (flags & paInputUnderflow)  { stats->input_underflows++; }
+  if (flags & paInputOverflow)   { stats->input_overflows++; }
+  if (flags & paOutputUnderflow) { stats->output_underflows++; }
+  if (flags & paOutputOverflow)  { stats->output_overflows++; }
+}
+
+// Convert "requested_time" to a position on the frame clock (unless
+// "start_frame" was given).  This is done only once, when the action is
+// received, therefore it doesn't suffer from jitter in later blocks.
+// "io_time" is the time of the first frame of the current block.
+void set_start_frame(struct action* action, PaTime io_time
+  , const struct state* state)
+{
+  if (!action->has_start_frame)
+  {
+    action->start_frame = state->frame
+      + llround((action->requested_time - io_time) * state->samplerate);
+    action->has_start_frame = true;
+  }
+}
+
+// Publish the relation between frame clock and stream time for Python.
+// This is a "sequence lock": "clock_seq" is odd while "clock" is written.
+void update_clock(const PaStreamCallbackTimeInfo* timeInfo
+  , struct state* state)
+{
+  state->clock_seq++;
+  PaUtil_WriteMemoryBarrier();
+  state->clock.frame = state->frame;
+  state->clock.input_time = timeInfo->inputBufferAdcTime;
+  state->clock.output_time = timeInfo->outputBufferDacTime;
+  PaUtil_WriteMemoryBarrier();
+  state->clock_seq++;
+}
+
+// The gain of a bus can be changed by Python at any time.  It is read once
+// per block, the new value is reached at the end of the block.
+void update_bus(struct bus* bus, frame_t frameCount)
+{
+  bus->start_gain = bus->end_gain;
+  bus->end_gain = bus->gain;
+  bus->gain_step = (bus->end_gain - bus->start_gain) / (float)frameCount;
+}
+
+// Accumulate the levels of an interleaved signal and publish a snapshot for
+// Python.  The snapshots are double-buffered: "seq" is odd while the next
+// one is written (like in a sequence lock), but the previous one stays
+// valid during that time.  Python acknowledges the number of the snapshot
+// it has read, after that only the levels of later blocks are kept,
+// therefore no peaks are lost, regardless of how often Python reads them.
+void update_meter(struct meter* meter, const float* data, frame_t frames)
+{
+  const frame_t channels = meter->channels;
+  const unsigned long acknowledged = meter->acknowledged;
+  if (acknowledged != meter->handled)
+  {
+    meter->handled = acknowledged;
+    const unsigned long published = meter->seq / 2;
+    if (acknowledged == published)
+    {
+      memset(meter->levels, 0, sizeof(struct levels) * channels);
+      meter->frames = 0;
+    }
+    else if (acknowledged + 1 == published)
+    {
+      // The previous block was published after the acknowledged snapshot
+      memcpy(meter->levels, meter->block_levels
+        , sizeof(struct levels) * channels);
+      meter->frames = meter->block_frames;
+    }
+    else
+    {
+      // Python took more than a block to acknowledge.  The levels are not
+      // reset, i.e. some values are reported twice (but none are lost).
+    }
+  }
+  for (frame_t c = 0; c < channels; c++)
+  {
+    struct levels* const levels = meter->levels + c;
+    struct levels* const block = meter->block_levels + c;
+    float peak = 0.0f;
+    float sum_squares = 0.0f;
+    frame_t clipped = 0;
+    for (frame_t i = 0; i < frames; i++)
+    {
+      const float value = fabsf(data[i * channels + c]);
+      peak = value > peak ? value : peak;
+      sum_squares += value * value;
+      clipped += value >= 1.0f;
+    }
+    block->peak = peak;
+    block->sum_squares = sum_squares;
+    block->clipped = clipped;
+    levels->peak = peak > levels->peak ? peak : levels->peak;
+    levels->sum_squares += sum_squares;
+    levels->clipped += clipped;
+  }
+  meter->block_frames = frames;
+  meter->frames += frames;
+  const unsigned long slot = (meter->seq / 2 + 1) % 2;
+  meter->seq++;
+  PaUtil_WriteMemoryBarrier();
+  memcpy(meter->snapshots + slot * channels, meter->levels
+    , sizeof(struct levels) * channels);
+  meter->snapshot_frames[slot] = meter->frames;
+  PaUtil_WriteMemoryBarrier();
+  meter->seq++;
+}
+
+// Monotonic time (in seconds) for measuring the execution time of the
+// callback.  The stream time can't be used for that, because it is only
+// provided at the beginning of the callback.
+double get_time(void)
+{
+#ifdef _WIN32
+  LARGE_INTEGER counter, frequency;
+  QueryPerformanceCounter(&counter);
+  QueryPerformanceFrequency(&frequency);
+  return (double)counter.QuadPart / (double)frequency.QuadPart;
+#else
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return (double)now.tv_sec + (double)now.tv_nsec * 1e-9;
+#endif
+}
+
+// Accumulate the load statistics and add a record to the telemetry ring.
+// The ring is overwritten continuously, Python reads the latest
+// "telemetry_count" records (at most "telemetry_size"), see
+// _Base.telemetry().  "finished" is the value of load.finished at the
+// beginning of the block.
+void update_load(struct state* state, frame_t frameCount, double duration
+  , frame_t active, frame_t started, frame_t finished)
+{
+  struct load* const load = &(state->load);
+  const double fraction = duration * state->samplerate / (double)frameCount;
+  if (load->blocks == 0 || duration < load->min_duration)
+  {
+    load->min_duration = duration;
+  }
+  if (duration > load->max_duration)
+  {
+    load->max_duration = duration;
+  }
+  load->total_duration += duration;
+  load->last_load = (float)fraction;
+  load->blocks++;
+  const double bin = fraction * 10.0;
+  load->histogram[bin < 10.0 ? (frame_t)bin : 10]++;
+  load->started += started;
+
+  if (state->telemetry)
+  {
+    struct telemetry* const record = state->telemetry
+      + (state->telemetry_count & (state->telemetry_size - 1));
+    record->frame = state->frame;
+    record->frames = frameCount;
+    record->duration = (float)duration;
+    record->load = (float)fraction;
+    record->active = active;
+    record->started = started;
+    record->finished = load->finished - finished;
+    PaUtil_WriteMemoryBarrier();
+    state->telemetry_count++;
+  }
+}
+
+// A "voice" is a PLAY_BUFFER action which plays in the current block (and
+// which isn't already being stolen).
+static inline bool is_voice(const struct action* action
+  , frameclock_t block_end, const struct state* state)
+{
+  return action->type == PLAY_BUFFER && action->status == ACTIVE
+    && action->end_reason != STOLEN
+    && (action->started || (action->start_frame < block_end
+      && (action->allow_belated || action->start_frame >= state->frame)));
+}
+
+// Check if voice "a" should be stolen before voice "b": lower priority
+// first, then the quieter one, then the one which has played longer.
+bool steal_first(const struct action* a, const struct action* b)
+{
+  if (a->priority != b->priority)
+  {
+    return a->priority < b->priority;
+  }
+  const float a_gain = fabsf(a->gain);
+  const float b_gain = fabsf(b->gain);
+  if (a_gain != b_gain)
+  {
+    return a_gain < b_gain;
+  }
+  return a->done_frames > b->done_frames;
+}
+
+// Steal the least important voices if there are more than max_voices, or
+// one voice per block if the previous block exceeded max_load.  Voices
+// which haven't started yet are skipped, the others are faded out within
+// steal_fade frames (or less, if they end earlier anyway).  Voices with more
+// than SCRATCH_SAMPLES channels can't be faded and are never stolen.
+// The candidates are selected in a single pass over the active actions,
+// keeping the MAX_STEALS best ones sorted (by insertion), which takes
+// O(active * MAX_STEALS) time.  If more voices exceed the limit, the
+// remaining ones are stolen in the following blocks.
+void steal_voices(struct state* state, frameclock_t block_end)
+{
+  struct action* candidates[MAX_STEALS];
+  frame_t candidate_count = 0;
+  frame_t voices = 0;
+  for (struct action* i = state->actions; i; i = i->next)
+  {
+    if (!is_voice(i, block_end, state))
+    {
+      continue;
+    }
+    voices++;
+    if (i->channels > SCRATCH_SAMPLES)
+    {
+      continue;  // Can't be faded out, see prepare_action()
+    }
+    if (candidate_count == MAX_STEALS
+        && !steal_first(i, candidates[MAX_STEALS - 1]))
+    {
+      continue;
+    }
+    frame_t j = candidate_count < MAX_STEALS ? candidate_count++
+                                             : MAX_STEALS - 1;
+    for (; j > 0 && steal_first(i, candidates[j - 1]); j--)
+    {
+      candidates[j] = candidates[j - 1];
+    }
+    candidates[j] = i;
+  }
+  frame_t limit = state->max_voices ? state->max_voices : voices;
+  if (state->max_load > 0.0f && state->load.last_load > state->max_load
+      && voices && limit >= voices)
+  {
+    limit = voices - 1;
+  }
+  frame_t steals = voices > limit ? voices - limit : 0;
+  if (steals > candidate_count)
+  {
+    steals = candidate_count;
+  }
+  for (frame_t k = 0; k < steals; k++)
+  {
+    struct action* const victim = candidates[k];
+    victim->end_reason = STOLEN;
+    if (!victim->started)
+    {
+      // The action is removed from its list when it's visited next:
+      victim->status = DISCARDED;
+    }
+    else
+    {
+      // NB: total_frames may be ULONG_MAX (infinite loop)
+      const frame_t remaining = victim->total_frames - victim->done_frames;
+      if (remaining > state->steal_fade && remaining > victim->release)
+      {
+        victim->total_frames = victim->done_frames + state->steal_fade;
+        victim->release = state->steal_fade;
+      }
+    }
+    state->load.stolen++;
+  }
+}
 
-#include <portaudio.h>
-#include <pa_ringbuffer.h>
+// Get the gain ramp of the action's bus (see play_frames_gain()), starting
+// with frame "offset" of the current block.  Without a bus, this is 1.
+static inline void get_bus_ramp(const struct action* action, frame_t offset
+  , float* ramp, float* ramp_step)
+{
+  *ramp = 1.0f;
+  *ramp_step = 0.0f;
+  if (action->bus)
+  {
+    *ramp = action->bus->start_gain + action->bus->gain_step * (float)offset;
+    *ramp_step = action->bus->gain_step;
+  }
+}
 
-#include "rtmixer.h"
+// The "pending" actions are stored in a binary min-heap, ordered by
+// start_frame.  Only the earliest action has to be checked in each block.
 
-#ifdef NDEBUG
-#define CALLBACK_ASSERT(expr) ((void)(0))
-#else
-#define CALLBACK_ASSERT(expr) \
-  do { if (!(expr)) { \
-    printf("Failed assertion in audio callback: \"" #expr "\" (" __FILE__ \
-        ":%i)\n", __LINE__); \
-    return paAbort; \
-  }} while (false)
-#endif
+void sift_up(struct action** heap, frame_t i)
+{
+  struct action* const action = heap[i];
+  while (i > 0)
+  {
+    frame_t parent = (i - 1) / 2;
+    if (heap[parent]->start_frame <= action->start_frame)
+    {
+      break;
+    }
+    heap[i] = heap[parent];
+    heap[i]->pending_index = i;
+    i = parent;
+  }
+  heap[i] = action;
+  action->pending_index = i;
+}
 
-void remove_action(struct action** addr, const struct state* state)
+void sift_down(struct action** heap, frame_t size, frame_t i)
 {
-  struct action* action = *addr;
-  *addr = action->next;  // Current action is removed from list
-  action->next = NULL;
-  ring_buffer_size_t written = PaUtil_WriteRingBuffer(state->result_q
-    , &action, 1);
-  if (written != 1)
+  struct action* const action = heap[i];
+  for (;;)
+  {
+    frame_t child = 2 * i + 1;
+    if (child >= size)
+    {
+      break;
+    }
+    if (child + 1 < size
+        && heap[child + 1]->start_frame < heap[child]->start_frame)
+    {
+      child++;
+    }
+    if (action->start_frame <= heap[child]->start_frame)
+    {
+      break;
+    }
+    heap[i] = heap[child];
+    heap[i]->pending_index = i;
+    i = child;
+  }
+  heap[i] = action;
+  action->pending_index = i;
+}
+
+void heapify(struct action** heap, frame_t size)
+{
+  for (frame_t i = size / 2; i > 0; i--)
   {
-    // TODO: do something? Stop callback? Log error (in "state")?
-    printf("result queue is full\n");
+    sift_down(heap, size, i - 1);
   }
 }
 
-void get_stats(PaStreamCallbackFlags flags, struct stats* stats)
+bool push_pending(struct action* action, struct state* state)
 {
-  stats->blocks++;
+  if (state->pending_size == state->pending_capacity)
+  {
+    return false;
+  }
+  state->pending[state->pending_size] = action;
+  sift_up(state->pending, state->pending_size);
+  state->pending_size++;
+  action->status = PENDING;
+  return true;
+}
 
-  if (flags & paInputUnderflow)  { stats->input_underflows++; }
-  if (flags & paInputOverflow)   { stats->input_overflows++; }
-  if (flags & paOutputUnderflow) { stats->output_underflows++; }
-  if (flags & paOutputOverflow)  { stats->output_overflows++; }
+struct action* remove_pending(frame_t i, struct state* state)
+{
+  struct action** heap = state->pending;
+  struct action* const action = heap[i];
+  state->pending_size--;
+  if (i < state->pending_size)
+  {
+    heap[i] = heap[state->pending_size];
+    if (i > 0 && heap[i]->start_frame < heap[(i - 1) / 2]->start_frame)
+    {
+      sift_up(heap, i);
+    }
+    else
+    {
+      sift_down(heap, state->pending_size, i);
+    }
+  }
+  return action;
+}
+
+enum timing
+{
+  EARLY,
+  DUE,
+  BELATED,
+};
+
+// Check if the action is due to start in the current block.
+// If it is, "offset" is set to the number of frames before it starts.
+// "io_time" is the time of the first frame of the current block.
+enum timing get_timing(struct action* action, PaTime io_time
+  , frame_t frameCount, const struct state* state, frame_t* offset)
+{
+  *offset = 0;
+
+  if (action->started)
+  {
+    return DUE;  // This action is already "active"
+  }
+
+  if (action->start_frame >= state->frame)
+  {
+    if (action->start_frame - state->frame >= (frameclock_t)frameCount)
+    {
+      // We are too early, let's continue in the next block!
+      return EARLY;
+    }
+    *offset = (frame_t)(action->start_frame - state->frame);
+    action->actual_time = io_time + (double)*offset / state->samplerate;
+  }
+  else
+  {
+    // We are too late!
+    if (!action->allow_belated)
+    {
+      action->actual_time = 0.0;  // a.k.a. "false"
+      return BELATED;
+    }
+    action->actual_time = io_time;
+  }
+  action->started = true;
+  return DUE;
+}
+
+// Change the gain of "target" within "ramp" frames, starting with frame
+// "offset" of the current block.  Without a ramp, the gain jumps at
+// "offset" (which is handled as a ramp of a single frame).
+void set_gain(struct action* target, float gain, frame_t ramp
+  , enum curve curve, frame_t offset, const struct state* state)
+{
+  if (target->status == FINISHED || target->channels > SCRATCH_SAMPLES)
+  {
+    return;
+  }
+  frame_t delay = offset;
+  if (!target->started && target->start_frame > state->frame)
+  {
+    // The target starts later in this block (or in a later block)
+    const frameclock_t target_offset = target->start_frame - state->frame;
+    delay = target_offset < (frameclock_t)offset
+      ? offset - (frame_t)target_offset : 0;
+  }
+  if (!delay && (!ramp || !target->started))
+  {
+    target->gain = gain;  // Immediately, no ramp needed
+    target->gain_ramp = 0;
+    target->gain_delay = 0;
+    return;
+  }
+  if (!ramp)
+  {
+    ramp = 1;
+  }
+  if (curve == EXPONENTIAL && target->gain >= 0.0f && gain >= 0.0f)
+  {
+    // Zero can't be reached exponentially, -60 dB is used instead
+    const float from = target->gain > 0.001f ? target->gain : 0.001f;
+    const float to = gain > 0.001f ? gain : 0.001f;
+    target->gain = from;
+    target->gain_step = powf(to / from, 1.0f / (float)ramp);
+  }
+  else
+  {
+    curve = LINEAR;
+    target->gain_step = (gain - target->gain) / (float)ramp;
+  }
+  target->target_gain = gain;
+  target->gain_curve = curve;
+  target->gain_ramp = ramp;
+  target->gain_delay = delay;
 }
 
-frame_t seconds2samples(PaTime time, double samplerate)
+// Stop "delinquent" after "offset" frames of the current block (or later).
+int cancel_action(struct action* delinquent, frame_t offset
+  , struct state* state)
 {
-  return (frame_t) llround(time * samplerate);
+  if (delinquent->status == PENDING)
+  {
+    // The action would start after the current block, i.e. after the
+    // cancellation, therefore it is removed before it begins.
+
+    CALLBACK_ASSERT(delinquent->pending_index < state->pending_size
+      && state->pending[delinquent->pending_index] == delinquent);
+    delinquent->end_reason = CANCELLED;
+    finish_action(remove_pending(delinquent->pending_index, state), state);
+  }
+  else if (delinquent->status == ACTIVE)
+  {
+    if (!delinquent->started)
+    {
+      // delinquent is not yet playing/recording
+
+      frame_t delinquent_offset = 0;
+      if (delinquent->start_frame >= state->frame)
+      {
+        if (delinquent->start_frame - state->frame >= (frameclock_t)offset)
+        {
+          // Removal is scheduled before playback/recording begins
+
+          // The action is removed from its list when it's visited next:
+          delinquent->end_reason = CANCELLED;
+          delinquent->status = DISCARDED;
+          return paContinue;
+        }
+        delinquent_offset = (frame_t)(delinquent->start_frame - state->frame);
+      }
+      else
+      {
+        if (!delinquent->allow_belated)
+        {
+          return paContinue;  // The action will be TOO_LATE anyway
+        }
+      }
+
+      CALLBACK_ASSERT(offset >= delinquent_offset);
+      // The fade-out (if any) starts at the requested time.
+      // NB: total_frames may be ULONG_MAX (infinite loop)
+      const frame_t frames = offset - delinquent_offset + delinquent->release;
+      if (delinquent->total_frames > frames)
+      {
+        delinquent->total_frames = frames;
+        delinquent->end_reason = CANCELLED;
+      }
+      else
+      {
+        // It stops on its own, i.e. it is COMPLETED
+      }
+    }
+    else
+    {
+      CALLBACK_ASSERT(delinquent->total_frames >= delinquent->done_frames);
+      offset += delinquent->release;  // See above
+      if (delinquent->total_frames - delinquent->done_frames > offset)
+      {
+        delinquent->total_frames = delinquent->done_frames + offset;
+        delinquent->end_reason = CANCELLED;
+      }
+      else
+      {
+        // It stops on its own, i.e. it is COMPLETED
+      }
+    }
+  }
+  else
+  {
+    // The action is already finished (or discarded), nothing to do.
+  }
+  return paContinue;
 }
 
 int callback(const void* input, void* output, frame_t frameCount
   , const PaStreamCallbackTimeInfo* timeInfo, PaStreamCallbackFlags statusFlags
   , void* userData)
 {
+  const double start_time = get_time();
   struct state* state = userData;
   CALLBACK_ASSERT(state);
+  const frame_t finished = state->load.finished;
+  frame_t active = 0;
+  frame_t started = 0;
 
   memset(output, 0, sizeof(float) * state->output_channels * frameCount);
 
   get_stats(statusFlags, &(state->stats));
+  update_clock(timeInfo, state);
+  for (frame_t i = 0; i < state->bus_count; i++)
+  {
+    update_bus(state->buses + i, frameCount);
+  }
+  if (state->input_meter)
+  {
+    update_meter(state->input_meter, input, frameCount);
+  }
+
+  // Actions which start after the current block are stored in a heap,
+  // the others are activated immediately.  Input and output actions use
+  // the same frame clock, their requested time is converted with the
+  // respective time of the current block.
+
+  PaTime io_time_max = timeInfo->outputBufferDacTime;
+  if (timeInfo->inputBufferAdcTime > io_time_max)
+  {
+    io_time_max = timeInfo->inputBufferAdcTime;
+  }
+  const frameclock_t block_end = state->frame + (frameclock_t)frameCount;
 
   for (struct action* action = NULL
       ; PaUtil_ReadRingBuffer(state->action_q, &action, 1)
       ;)
   {
-    // Actions are added at the beginning of the list, because CANCEL actions
-    // must come before the action they are cancelling.  Also, it's easier.
-    struct action* i = action;
-    while (i->next)
+    while (action)
     {
-      i = i->next;
+      struct action* const next = action->next;
+      if (!prepare_action(action, state))
+      {
+        // Invalid channel mapping, the action is discarded
+        action->end_reason = INVALID;
+        finish_action(action, state);
+        action = next;
+        continue;
+      }
+      enum actiontype type = action->type;
+      if (type == CANCEL || type == SET_GAIN)
+      {
+        type = action->action->type;
+      }
+      set_start_frame(action, type == CANCEL_ALL ? io_time_max
+        : is_playing(type) ? timeInfo->outputBufferDacTime
+                           : timeInfo->inputBufferAdcTime, state);
+      if (action->start_frame >= block_end && push_pending(action, state))
+      {
+        // Activated in a later block
+      }
+      else
+      {
+        activate_action(action, state);
+      }
+      action = next;
     }
-    i->next = state->actions;
-    state->actions = action;
   }
 
-  struct action** actionaddr = &(state->actions);
+  while (state->pending_size
+      && state->pending[0]->start_frame < block_end)
+  {
+    activate_action(remove_pending(0, state), state);
+  }
+
+  // Handle CANCEL, CANCEL_ALL and SET_GAIN actions
+
+  struct action** actionaddr = &(state->controls);
   while (*actionaddr)
   {
     struct action* const action = *actionaddr;
 
-    enum actiontype type = action->type;
-    if (type == CANCEL)
+    if (action->status == DISCARDED)
     {
-      CALLBACK_ASSERT(action->action);
-      type = action->action->type;
+      remove_action(actionaddr, state);
+      continue;
     }
-    const bool playing = type == PLAY_BUFFER || type == PLAY_RINGBUFFER;
 
-    PaTime io_time = playing ? timeInfo->outputBufferDacTime
-                             : timeInfo->inputBufferAdcTime;
+    PaTime io_time = io_time_max;
+    if (action->type == CANCEL || action->type == SET_GAIN)
+    {
+      CALLBACK_ASSERT(action->action);
+      io_time = is_playing(action->action->type)
+        ? timeInfo->outputBufferDacTime : timeInfo->inputBufferAdcTime;
+    }
+    else
+    {
+      CALLBACK_ASSERT(action->type == CANCEL_ALL);
+    }
     frame_t offset = 0;
+    enum timing timing = get_timing(action, io_time, frameCount, state
+      , &offset);
+    if (timing == EARLY)
+    {
+      actionaddr = &(action->next);
+      continue;
+    }
+    if (timing == BELATED)
+    {
+      action->end_reason = TOO_LATE;
+      remove_action(actionaddr, state);
+      continue;
+    }
 
-    // Check if the action is due to start in the current block
-
-    if (action->done_frames == 0)
+    if (action->type == SET_GAIN)
+    {
+      set_gain(action->action, action->target_gain, action->gain_ramp
+        , action->gain_curve, offset, state);
+    }
+    else if (action->type == CANCEL)
+    {
+      // The action to be cancelled is found in constant time
+      if (cancel_action(action->action, offset, state) != paContinue)
+      {
+        return paAbort;
+      }
+    }
+    else
     {
-      // This action has not yet been "active"
+      // All matching actions are cancelled in one pass
 
-      PaTime diff = action->requested_time - io_time;
-      if (diff >= 0.0)
+      for (struct action* i = state->actions; i; i = i->next)
       {
-        offset = seconds2samples(diff, state->samplerate);
-        if (offset >= frameCount)
+        if (action->group && i->group != action->group)
         {
-          // We are too early, let's continue in the next block!
-
-          // Due to inaccuracies in timeInfo, "diff" might have a small negative
-          // value in a future block.  We don't count this as "belated" though:
-          action->allow_belated = true;
-          actionaddr = &(action->next);
           continue;
         }
-        // Re-calculate "diff" to propagate rounding errors
-        action->actual_time = io_time + (double)offset / state->samplerate;
+        // Inputs and outputs share the frame clock, therefore the offset
+        // (start_frame - state->frame, limited to the current block) is the
+        // same for all actions, regardless of their input/output time.
+        if (cancel_action(i, offset, state) != paContinue)
+        {
+          return paAbort;
+        }
       }
-      else
+
+      // Pending actions would start after the current block, i.e. after
+      // the cancellation, therefore they are removed before they begin.
+      frame_t kept = 0;
+      for (frame_t i = 0; i < state->pending_size; i++)
       {
-        // We are too late!
-        if (!action->allow_belated)
+        struct action* const pending = state->pending[i];
+        if (is_control(pending->type)
+            || (action->group && pending->group != action->group))
         {
-          action->actual_time = 0.0;  // a.k.a. "false"
-          remove_action(actionaddr, state);
-          continue;
+          // heapify() doesn't visit the leaves, the index is updated here:
+          pending->pending_index = kept;
+          state->pending[kept++] = pending;
+        }
+        else
+        {
+          pending->end_reason = CANCELLED;
+          finish_action(pending, state);
         }
-        action->actual_time = io_time;
       }
+      state->pending_size = kept;
+      heapify(state->pending, state->pending_size);
     }
 
-    // Handle CANCEL action
+    remove_action(actionaddr, state);  // Remove the CANCEL action itself
+  }
+
+  if (state->max_voices || state->max_load > 0.0f)
+  {
+    steal_voices(state, block_end);
+  }
+
+  // Handle all other actions
+
+  actionaddr = &(state->actions);
+  while (*actionaddr)
+  {
+    struct action* const action = *actionaddr;
 
-    if (action->type == CANCEL)
+    if (action->status == DISCARDED)
     {
-      // Search the following list items, not the preceding ones!
-      for (struct action** i = &(action->next); *i; i = &((*i)->next))
-      {
-        if (*i == action->action)
-        {
-          struct action* delinquent = *i;
+      remove_action(actionaddr, state);
+      continue;
+    }
 
-          if (delinquent->done_frames == 0)
-          {
-            // delinquent is not yet playing/recording
-
-            frame_t delinquent_offset = 0;
-            PaTime diff = delinquent->requested_time - io_time;
-            if (diff >= 0.0)
-            {
-              delinquent_offset = seconds2samples(diff, state->samplerate);
-              if (delinquent_offset >= offset)
-              {
-                // Removal is scheduled before playback/recording begins
-
-                // TODO: save some status information?
-                remove_action(i, state);
-                break;
-              }
-            }
-            else
-            {
-              if (!delinquent->allow_belated)
-              {
-                // TODO: save some status information?
-                break;  // The action will not be started, no need to cancel it
-              }
-            }
-
-            if (delinquent->total_frames + delinquent_offset > offset)
-            {
-              CALLBACK_ASSERT(offset >= delinquent_offset);
-              delinquent->total_frames = offset - delinquent_offset;
-            }
-            else
-            {
-              // TODO: stops on its own ... save some status information?
-            }
-          }
-          else
-          {
-            CALLBACK_ASSERT(
-                delinquent->total_frames >= delinquent->done_frames);
-            if (delinquent->total_frames - delinquent->done_frames > offset)
-            {
-              delinquent->total_frames = delinquent->done_frames + offset;
-            }
-            else
-            {
-              // TODO: stops on its own ... save some status information?
-            }
-          }
-          // TODO: save some informations to action->...?
+    const bool playing = is_playing(action->type);
 
-          break;  // We found the action, no need to keep searching
-        }
-      }
-      // TODO: what if the action to cancel wasn't found?
+    PaTime io_time = playing ? timeInfo->outputBufferDacTime
+                             : timeInfo->inputBufferAdcTime;
+    frame_t offset = 0;
+    const bool was_started = action->started;
+
+    // Check if the action is due to start in the current block
 
-      remove_action(actionaddr, state);  // Remove the CANCEL action itself
+    enum timing timing = get_timing(action, io_time, frameCount, state
+      , &offset);
+    if (timing == EARLY)
+    {
+      actionaddr = &(action->next);
+      continue;
+    }
+    if (timing == BELATED)
+    {
+      action->end_reason = TOO_LATE;
+      remove_action(actionaddr, state);
       continue;
     }
 
     // Store buffer over-/underflow information
 
     get_stats(statusFlags, &(action->stats));
+    active++;
+    if (!was_started)
+    {
+      started++;
+    }
 
     // Get number of remaining frames in the current block
 
@@ -220,41 +1569,50 @@ int callback(const void* input, void* output, frame_t frameCount
 
     // Shove audio data around
 
+    const frame_t device_channels
+      = playing ? state->output_channels : state->input_channels;
     float* device_data
-      = playing ? (float*)output + offset * state->output_channels
-                : (float*) input + offset * state->input_channels;
+      = (float*)(playing ? output : input) + offset * device_channels;
+    float ramp = 1.0f;
+    float ramp_step = 0.0f;
+    get_bus_ramp(action, offset, &ramp, &ramp_step);
 
     if (action->type == PLAY_BUFFER || action->type == RECORD_BUFFER)
     {
-      float* buffer = action->buffer + action->done_frames * action->channels;
-      action->done_frames += frames;
       if (action->type == PLAY_BUFFER)
       {
-        while (frames--)
-        {
-          for (frame_t c = 0; c < action->channels; c++)
-          {
-            CALLBACK_ASSERT(action->mapping[c] >= 1);
-            CALLBACK_ASSERT(action->mapping[c] <= state->output_channels);
-            device_data[action->mapping[c] - 1] += *buffer++;
-          }
-          device_data += state->output_channels;
-        }
+        play_buffer_frames(action, device_data, device_channels, frames
+          , ramp, ramp_step);
       }
       else
       {
         CALLBACK_ASSERT(action->type == RECORD_BUFFER);
+        char* buffer = (char*)action->buffer + action->done_frames
+          * action->channels * sample_size(action->sampleformat);
+        action->done_frames += frames;
+        record_frames(action, device_data, device_channels, buffer, frames);
+      }
+    }
+    else if (action->type == PLAY_PLAYLIST)
+    {
+      const frame_t played = play_playlist(action, device_data
+        , device_channels, frames
+        , io_time + (double)offset / state->samplerate, ramp, ramp_step
+        , state);
+      action->done_frames += played;
+      if (played < frames)
+      {
+        // No more segments
 
-        while (frames--)
+        if (!action->continue_on_xrun)
         {
-          for (frame_t c = 0; c < action->channels; c++)
-          {
-            CALLBACK_ASSERT(action->mapping[c] >= 1);
-            CALLBACK_ASSERT(action->mapping[c] <= state->input_channels);
-            *buffer++ = device_data[action->mapping[c] - 1];
-          }
-          device_data += state->input_channels;
+          // All buffers have been played, the playlist is COMPLETED
+          remove_action(actionaddr, state);
+          continue;
         }
+        // The playlist is waiting for more buffers
+        action->xruns++;
+        action->dropped_frames += frames - played;
       }
     }
     else
@@ -262,12 +1620,22 @@ int callback(const void* input, void* output, frame_t frameCount
       CALLBACK_ASSERT(action->type ==   PLAY_RINGBUFFER
                    || action->type == RECORD_RINGBUFFER);
 
-      float* block1 = NULL;
-      float* block2 = NULL;
+      char* block1 = NULL;
+      char* block2 = NULL;
       ring_buffer_size_t size1 = 0;
       ring_buffer_size_t size2 = 0;
       ring_buffer_size_t totalsize = 0;
 
+      const frame_t available = (frame_t)(action->type == PLAY_RINGBUFFER
+        ? PaUtil_GetRingBufferReadAvailable(action->ringbuffer)
+        : PaUtil_GetRingBufferWriteAvailable(action->ringbuffer));
+      // At the end of a finite action, the ring buffer is expected to run dry
+      if (available < action->min_available
+          && available < action->total_frames - action->done_frames)
+      {
+        action->min_available = available;
+      }
+
       if (action->type == PLAY_RINGBUFFER)
       {
         totalsize = PaUtil_GetRingBufferReadRegions(action->ringbuffer
@@ -275,24 +1643,12 @@ int callback(const void* input, void* output, frame_t frameCount
           , (void**)&block1, &size1, (void**)&block2, &size2);
         CALLBACK_ASSERT(!totalsize || size1);
 
-        while (size1--)
-        {
-          for (frame_t c = 0; c < action->channels; c++)
-          {
-            CALLBACK_ASSERT(action->mapping[c] >= 1);
-            CALLBACK_ASSERT(action->mapping[c] <= state->output_channels);
-            device_data[action->mapping[c] - 1] += *block1++;
-          }
-          device_data += state->output_channels;
-        }
-        while (size2--)
-        {
-          for (frame_t c = 0; c < action->channels; c++)
-          {
-            device_data[action->mapping[c] - 1] += *block2++;
-          }
-          device_data += state->output_channels;
-        }
+        play_frames_at(action, device_data, device_channels, block1
+          , (frame_t)size1, action->done_frames, ramp, ramp_step);
+        play_frames_at(action, device_data + size1 * device_channels
+          , device_channels, block2, (frame_t)size2
+          , action->done_frames + (frame_t)size1
+          , ramp + ramp_step * (float)size1, ramp_step);
         action->done_frames += (frame_t)totalsize;
         PaUtil_AdvanceRingBufferReadIndex(action->ringbuffer, totalsize);
       }
@@ -305,36 +1661,26 @@ int callback(const void* input, void* output, frame_t frameCount
           , (void**)&block1, &size1, (void**)&block2, &size2);
         CALLBACK_ASSERT(!totalsize || size1);
 
-        while (size1--)
-        {
-          for (frame_t c = 0; c < action->channels; c++)
-          {
-            CALLBACK_ASSERT(action->mapping[c] >= 1);
-            CALLBACK_ASSERT(action->mapping[c] <= state->input_channels);
-            *block1++ = device_data[action->mapping[c] - 1];
-          }
-          device_data += state->input_channels;
-        }
-        while (size2--)
-        {
-          for (frame_t c = 0; c < action->channels; c++)
-          {
-            *block2++ = device_data[action->mapping[c] - 1];
-          }
-          device_data += state->input_channels;
-        }
+        record_frames(action, device_data, device_channels, block1
+          , (frame_t)size1);
+        record_frames(action, device_data + size1 * device_channels
+          , device_channels, block2, (frame_t)size2);
         action->done_frames += (frame_t)totalsize;
         PaUtil_AdvanceRingBufferWriteIndex(action->ringbuffer, totalsize);
       }
 
-      if (totalsize < frames)
+      if ((frame_t)totalsize < frames)
       {
         // Ring buffer is empty or full
 
-        // TODO: store some information in action?
-
-        remove_action(actionaddr, state);
-        continue;
+        action->xruns++;
+        action->dropped_frames += frames - (frame_t)totalsize;
+        if (!action->continue_on_xrun)
+        {
+          action->end_reason = XRUN;
+          remove_action(actionaddr, state);
+          continue;
+        }
       }
     }
 
@@ -347,5 +1693,17 @@ int callback(const void* input, void* output, frame_t frameCount
     }
     actionaddr = &(action->next);
   }
+
+  if (state->output_meter)
+  {
+    update_meter(state->output_meter, output, frameCount);
+  }
+  if (send_results(state))
+  {
+    notify_results(state);
+  }
+  update_load(state, frameCount, get_time() - start_time, active, started
+    , finished);
+  state->frame += (frameclock_t)frameCount;
   return paContinue;
 }
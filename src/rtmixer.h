@@ -1,4 +1,5 @@
 typedef unsigned long frame_t;
+typedef long long frameclock_t;  // Frame number since the stream was started
 
 enum actiontype
 {
@@ -6,8 +7,52 @@ enum actiontype
   PLAY_RINGBUFFER,
   RECORD_BUFFER,
   RECORD_RINGBUFFER,
+  PLAY_PLAYLIST,  // "ringbuffer" is a queue of PLAY_BUFFER actions
   CANCEL,
-  // TODO: action to query xrun stats etc.?
+  CANCEL_ALL,
+  SET_GAIN,  // Change the gain of "action" to "target_gain"
+};
+
+enum actionstatus
+{
+  QUEUED,  // Not yet seen by the callback
+  PENDING,  // In the "pending" heap
+  ACTIVE,  // In one of the lists of active actions
+  DISCARDED,  // Still in the list, but will be removed without being started
+  FINISHED,  // Sent to the result queue
+};
+
+enum endreason
+{
+  RUNNING,  // Not yet finished
+  COMPLETED,  // All frames were played/recorded (or the control was executed)
+  CANCELLED,  // Stopped before the end (or removed before it was started)
+  TOO_LATE,  // Not started, because the start time has passed, see actual_time
+  XRUN,  // The ring buffer was empty/full (without continue_on_xrun)
+  INVALID,  // E.g. invalid channel mapping, see prepare_action()
+  STOLEN,  // Voice limit or load budget exceeded, see steal_voices()
+};
+
+enum kernel
+{
+  GENERIC,  // Arbitrary channel mapping
+  CONTIGUOUS,  // Consecutive channels, e.g. 1, 2, 3 or 3, 4
+  MONO,  // A single channel
+  MATRIX,  // Sparse gain matrix, see "routes"
+};
+
+enum sampleformat
+{
+  FLOAT32_FORMAT,
+  INT16_FORMAT,
+  INT24_FORMAT,  // Packed, little-endian
+  INT32_FORMAT,
+};
+
+enum curve
+{
+  LINEAR,
+  EXPONENTIAL,  // Linear in dB
 };
 
 struct stats
@@ -19,23 +64,125 @@ struct stats
   frame_t output_overflows;
 };
 
+struct route
+{
+  frame_t source;  // Channel of the action (starting with 1)
+  frame_t target;  // Channel of the device (starting with 1)
+  float gain;
+};
+
+struct bus
+{
+  float gain;  // May be changed at any time, see update_bus()
+  float start_gain;  // At the beginning of the current block
+  float end_gain;  // At the end of the current block
+  float gain_step;  // Per frame within the current block
+};
+
+struct load
+{
+  frame_t blocks;
+  double min_duration;  // Execution time of the callback (in seconds)
+  double max_duration;
+  double total_duration;  // Used for the mean value
+  frame_t histogram[11];  // Blocks by used fraction of deadline, 10% steps
+  frame_t started;  // Actions which started playing/recording
+  frame_t finished;  // All actions sent to result_q (including CANCEL etc.)
+  frame_t stolen;  // Voices which were faded out or skipped
+  float last_load;  // Used fraction of deadline in the previous block
+};
+
+struct telemetry
+{
+  frameclock_t frame;  // Frame clock at the beginning of the block
+  frame_t frames;  // Number of frames in the block
+  float duration;  // Execution time of the callback (in seconds)
+  float load;  // Used fraction of the deadline (the duration of the block)
+  frame_t active;  // Actions which played/recorded in the block
+  frame_t started;
+  frame_t finished;
+};
+
+struct levels
+{
+  float peak;  // Maximum absolute value
+  double sum_squares;  // Used for the RMS value
+  frame_t clipped;  // Number of samples with an absolute value of 1 or more
+};
+
+struct meter
+{
+  const frame_t channels;
+  struct levels* const levels;  // Accumulated since the last reset
+  frame_t frames;  // Number of frames in "levels"
+  struct levels* const block_levels;  // Levels of the latest block only
+  frame_t block_frames;
+  struct levels* const snapshots;  // Two sets of "channels" levels
+  frame_t snapshot_frames[2];
+  volatile unsigned long seq;  // 2 * published snapshots, odd while writing
+  volatile unsigned long acknowledged;  // Written by Python, see update_meter()
+  unsigned long handled;  // Latest acknowledgement seen by update_meter()
+};
+
+struct clock
+{
+  frameclock_t frame;  // Frame clock at the beginning of the last block
+  PaTime input_time;  // Time of the first input frame of the last block
+  PaTime output_time;  // Time of the first output frame of the last block
+};
+
 struct action
 {
   const enum actiontype type;
   bool allow_belated;
   PaTime requested_time;
+  frameclock_t start_frame;  // Calculated from requested_time if not given
+  bool has_start_frame;
   PaTime actual_time;
+  bool started;  // Set when the action is due (even if no frames are played)
   struct action* next;
+  enum actionstatus status;
+  frame_t pending_index;  // Position in the "pending" heap (if PENDING)
+  unsigned int group;  // Arbitrary tag, used in CANCEL_ALL
+  int priority;  // Voices with lower priority are stolen first
   union {
-    float* const buffer;
+    void* const buffer;
     PaUtilRingBuffer* const ringbuffer;
     struct action* action;  // Used in CANCEL
   };
-  frame_t total_frames;
+  frame_t total_frames;  // Including loop repetitions
   frame_t done_frames;
-  // TODO: something to store the result of the action?
+  frame_t buffer_frames;  // Size of buffer (PLAY_BUFFER only)
+  frame_t position;  // Next frame in buffer (PLAY_BUFFER only)
+  frame_t loop_start;  // Looping is disabled if loop_end is 0
+  frame_t loop_end;
+  enum kernel kernel;  // Selected when the callback receives the action
+  enum sampleformat sampleformat;  // Of buffer or ringbuffer
+  // Only used for playback (and SET_GAIN):
+  float gain;
+  float target_gain;  // Reached at the end of gain_ramp
+  float gain_step;  // Added to (or multiplied with) gain for each frame
+  frame_t gain_ramp;  // Remaining frames of ramp (SET_GAIN: duration)
+  frame_t gain_delay;  // Frames to be played before the ramp starts
+  enum curve gain_curve;
+  frame_t attack;  // Length of fade-in
+  frame_t release;  // Length of fade-out at the end of total_frames
+  enum curve fade_curve;
+  const float* channel_gains;  // NULL or one value per channel
+  const struct route* routes;  // If not NULL, "mapping" is not used
+  frame_t route_count;
+  struct bus* bus;  // NULL or submix whose gain is applied
+  enum endreason end_reason;  // Set when the action is sent to result_q
   struct stats stats;
-  // TODO: queue usage: store smallest available write/read size?
+  // Only used for ring buffers (and playlists):
+  bool continue_on_xrun;  // Don't stop if the ring buffer is empty/full
+  frame_t xruns;  // Number of blocks where the ring buffer was empty/full
+  frame_t dropped_frames;  // Frames which couldn't be played/recorded
+  frame_t min_available;  // Smallest readable/writable size in ring buffer
+  // Only used for playlists:
+  struct action* segment;  // Current segment, linked to the next one
+  frame_t crossfade;  // Maximum overlap of consecutive segments
+  frame_t fade;  // Overlap of the current and the next segment
   const frame_t channels;  // Size of the following array
   const frame_t mapping[];  // "flexible array member"
 };
@@ -47,10 +194,37 @@ struct state
   double samplerate;
   PaUtilRingBuffer* const action_q;  // Queue for incoming commands
   PaUtilRingBuffer* const result_q;  // Queue for results and command disposal
-  struct action* actions;  // Singly linked list of actions
+  int result_fd;  // Written to after adding to result_q (if not negative)
+  struct action* finished;  // Singly linked list of not yet sent results
+  struct action* actions;  // Singly linked list of active actions
+  struct action* controls;  // Singly linked list of active CANCEL actions
+  struct action** const pending;  // Min-heap of actions, by start_frame
+  const frame_t pending_capacity;  // Size of the "pending" array
+  frame_t pending_size;  // Number of actions in the "pending" heap
   struct stats stats;
+  frameclock_t frame;  // Frame clock at the beginning of the current block
+  struct clock clock;  // Written with a sequence lock, see clock_seq
+  volatile unsigned long clock_seq;  // Odd while clock is being written
+  struct bus* const buses;
+  const frame_t bus_count;
+  struct meter* input_meter;  // NULL if metering is disabled
+  struct meter* output_meter;
+  struct load load;
+  struct telemetry* const telemetry;  // Ring of records (NULL if disabled)
+  const frame_t telemetry_size;  // Power of 2
+  volatile unsigned long telemetry_count;  // Number of written records
+  frame_t max_voices;  // Maximum number of PLAY_BUFFER actions (0: no limit)
+  float max_load;  // Budget as fraction of the deadline (0: no budget)
+  frame_t steal_fade;  // Length of fade-out of stolen voices
 };
 
+// Also used by SampleBank (in Python):
+frame_t sample_size(enum sampleformat format);
+void int_to_float(const void* data, float* out, frame_t samples
+  , enum sampleformat format);
+void float_to_int(const float* in, void* data, frame_t samples
+  , enum sampleformat format);
+
 int callback(const void* input, void* output, frame_t frameCount
   , const PaStreamCallbackTimeInfo* timeInfo, PaStreamCallbackFlags statusFlags
   , void* userData);
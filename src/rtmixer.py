@@ -1,6 +1,17 @@
 """Reliable low-latency audio playback and recording."""
 __version__ = '0.0.0'
 
+import collections as _collections
+import math as _math
+import mmap as _mmap
+import operator as _operator
+import os as _os
+import struct as _struct
+import threading as _threading
+import time as _time
+import weakref as _weakref
+from timeit import default_timer as _timer
+
 import sounddevice as _sd
 from _rtmixer import ffi as _ffi, lib as _lib
 
@@ -8,11 +19,34 @@ from _rtmixer import ffi as _ffi, lib as _lib
 class _Base(_sd._StreamBase):
     """Base class for Mixer et al."""
 
-    def __init__(self, kind, qsize=16, **kwargs):
+    def __init__(self, kind, qsize=16, pendingsize=1024, poolsize=1024,
+                 buses=(), metering=False, telemetrysize=256, logsize=1024,
+                 maxvoices=0, maxload=0.0, stealfade=0.005, **kwargs):
+        if maxvoices < 0:
+            raise ValueError('maxvoices must not be negative')
         callback = _ffi.addressof(_lib, 'callback')
 
         self._action_q = RingBuffer(_ffi.sizeof('struct action*'), qsize)
         self._result_q = RingBuffer(_ffi.sizeof('struct action*'), qsize)
+        # Actions which are scheduled for later are stored in a heap of this
+        # size, any further actions are checked in every block:
+        self._pending = _ffi.new('struct action*[]', pendingsize)
+        if not hasattr(buses, 'items'):
+            names = list(buses)
+            buses = _collections.OrderedDict((name, 1.0) for name in names)
+            if len(buses) != len(names):
+                raise ValueError('Bus names must be unique')
+        bus_array = _ffi.new('struct bus[]', [
+            (gain, gain, gain) for gain in buses.values()])
+        self._buses = _collections.OrderedDict(
+            (name, Bus(name, bus_array, i)) for i, name in enumerate(buses))
+        if telemetrysize < 0 or telemetrysize & (telemetrysize - 1):
+            raise ValueError('telemetrysize must be a power of 2 (or 0)')
+        if telemetrysize:
+            self._telemetry = _ffi.new('struct telemetry[]', telemetrysize)
+        else:
+            self._telemetry = _ffi.NULL
+        self._telemetry_read = 0  # Number of records seen by telemetry()
         self._state = _ffi.new('struct state*', dict(
             input_channels=0,
             output_channels=0,
@@ -20,22 +54,268 @@ class _Base(_sd._StreamBase):
             action_q=self._action_q._ptr,
             result_q=self._result_q._ptr,
             actions=_ffi.NULL,
+            controls=_ffi.NULL,
+            pending=self._pending,
+            pending_capacity=pendingsize,
+            pending_size=0,
+            result_fd=-1,
+            finished=_ffi.NULL,
+            buses=bus_array,
+            bus_count=len(buses),
+            telemetry=self._telemetry,
+            telemetry_size=telemetrysize,
         ))
-        _sd._StreamBase.__init__(
-            self, kind=kind, dtype='float32',
+        # This is normally sounddevice._StreamBase, see also _VirtualStream:
+        super(_Base, self).__init__(
+            kind=kind, dtype='float32',
             callback=callback, userdata=self._state, **kwargs)
         self._state.samplerate = self.samplerate
-
-        self._actions = set()
+        self._state.max_voices = maxvoices
+        self._state.max_load = maxload
+        self._state.steal_fade = int(round(stealfade * self.samplerate))
+        self._pool = _ActionPool(poolsize, max(_sd._split(self.channels)))
+        self._meters = {}
+        if metering:
+            input_channels, output_channels = _sd._split(self.channels)
+            if kind != 'output':
+                self._state.input_meter = self._new_meter(
+                    'input', input_channels)
+            if kind != 'input':
+                self._state.output_meter = self._new_meter(
+                    'output', output_channels)
+
+        # The values contain the same objects as the keys (plus the memory
+        # used by the action), because the pointers coming back from
+        # result_q don't own their memory, so we have to keep the original
+        # objects alive as long as they might be used:
+        self._actions = {}
         self._temp_action_ptr = _ffi.new('struct action**')
+        self._result_ptr = _ffi.new('struct action**')
+        self._finished = _threading.Condition()
+        self._futures = {}  # Used in wait_async()
+        self._results = _collections.deque(maxlen=logsize)  # See results()
+        self._samples = {}  # See register_samples()
+        self._listeners = _weakref.WeakSet()  # Used in finished_actions()
+        # Used in play_file() and record_to_file():
+        self._file_thread = _FileThread()
+
+        # The callback writes to this pipe whenever there are new results.
+        # The helper thread waits for it (without polling) and drains result_q.
+        # The callback must never block, so if the pipe can't be made
+        # non-blocking, it isn't used and the helper thread polls instead:
+        self._result_fds = _os.pipe()
+        if _set_nonblocking(self._result_fds[1]):
+            self._state.result_fd = self._result_fds[1]
+        self._result_thread = _threading.Thread(target=self._watch_results)
+        self._result_thread.daemon = True
+        self._result_thread.start()
 
     @property
     def actions(self):
         """The set of active "actions"."""
-        self._drain_result_q()
-        return self._actions
+        with self._finished:
+            self._drain_result_q()
+            return set(self._actions)
+
+    @property
+    def pool_usage(self):
+        """Number of preallocated actions which are currently in use.
+
+        Actions are returned to the pool when they are finished and no
+        longer referenced.  When the pool is exhausted (see *poolsize*),
+        actions are allocated individually.
+
+        """
+        return self._pool.usage
+
+    @property
+    def pool_highwater(self):
+        """Maximum value of `pool_usage` so far."""
+        return self._pool.highwater
+
+    @property
+    def frame(self):
+        """Position of the frame clock at the beginning of the last block.
+
+        The frame clock counts the frames processed by the callback,
+        starting with 0.  It can be used for the *start_frame* argument
+        of `Mixer.play_buffer()` et al.
+
+        """
+        return self._clock()[0]
+
+    def time_to_frame(self, time):
+        """Convert a stream time (in seconds) to the frame clock.
+
+        The conversion is based on the times of the last block given to
+        the callback (the output time, if there are output channels),
+        it is only valid after the stream has been started.
+
+        """
+        frame, block_time = self._clock()
+        return frame + int(round((time - block_time) * self.samplerate))
+
+    def frame_to_time(self, frame):
+        """Convert a position on the frame clock to stream time.
+
+        See `time_to_frame()`.
+
+        """
+        clock_frame, block_time = self._clock()
+        return block_time + (frame - clock_frame) / self.samplerate
+
+    @property
+    def stats(self):
+        """Statistics of the callback (a copy of the ``struct stats``).
+
+        *blocks* is the number of processed blocks, *input_underflows*,
+        *input_overflows*, *output_underflows* and *output_overflows*
+        count the blocks with the respective status flag.
+
+        """
+        stats = _ffi.new('struct stats*')
+        stats[0] = self._state.stats
+        return stats
+
+    @property
+    def load_stats(self):
+        """Execution time of the callback, relative to its deadline.
 
-    def cancel(self, action, time=0, allow_belated=True):
+        The time is measured in the callback (from its beginning to its
+        end), in contrast to `cpu_load`, which is an average provided by
+        PortAudio.  The values are accumulated since the stream was
+        started, see `LoadStats`.  For the values of individual blocks,
+        see `telemetry()`.
+
+        """
+        load = _ffi.new('struct load*')
+        load[0] = self._state.load
+        blocks = load.blocks
+        return LoadStats(
+            blocks,
+            load.min_duration,
+            load.total_duration / blocks if blocks else 0.0,
+            load.max_duration,
+            list(load.histogram),
+            load.started,
+            load.finished,
+            load.stolen)
+
+    def telemetry(self):
+        """Get information about the blocks since the last call.
+
+        The callback writes one record per block into a ring of
+        *telemetrysize* records, which is continuously overwritten.
+        If this is not called often enough, the oldest records are lost
+        (which can be seen from the *frame* values).
+
+        Returns
+        -------
+        list of Telemetry
+            One record per block, oldest first.
+
+        """
+        state = self._state
+        size = state.telemetry_size
+        if not size:
+            raise RuntimeError('Telemetry is disabled')
+        count = state.telemetry_count
+        first = max(self._telemetry_read, count - size)
+        copy = _ffi.new('struct telemetry[]', count - first)
+        index = first % size
+        part = min(count - first, size - index)
+        recordsize = _ffi.sizeof('struct telemetry')
+        _ffi.memmove(copy, state.telemetry + index, part * recordsize)
+        _ffi.memmove(copy + part, state.telemetry,
+                     (count - first - part) * recordsize)
+        # While copying, the callback may have overwritten the oldest ones:
+        overwritten = state.telemetry_count - size + 1 - first
+        self._telemetry_read = count
+        return [
+            Telemetry(r.frame, r.frames, r.duration, r.load, r.active,
+                      r.started, r.finished)
+            for r in copy[min(max(overwritten, 0), len(copy)):len(copy)]]
+
+    def _new_meter(self, kind, channels):
+        """Allocate the memory used for metering in the callback."""
+        # The accumulated levels are followed by those of the latest block:
+        levels = _ffi.new('struct levels[]', 2 * channels)
+        snapshots = _ffi.new('struct levels[]', 2 * channels)
+        meter = _ffi.new('struct meter*', dict(
+            channels=channels, levels=levels, block_levels=levels + channels,
+            snapshots=snapshots))
+        self._meters[kind] = meter, levels, snapshots
+        return meter
+
+    def _levels(self, kind):
+        """Implementation of input_levels() and output_levels()."""
+        try:
+            meter, _, snapshots = self._meters[kind]
+        except KeyError:
+            raise RuntimeError('Metering is not enabled')
+        channels = meter.channels
+        copy = _ffi.new('struct levels[]', channels)
+        if meter.seq // 2 == meter.acknowledged:
+            # No block since the last call (or since the start)
+            return Levels([0.0] * channels, [0.0] * channels, [0] * channels,
+                          0)
+        while True:
+            published = meter.seq // 2
+            slot = published % 2
+            _ffi.memmove(copy, snapshots + slot * channels,
+                         _ffi.sizeof(copy))
+            frames = meter.snapshot_frames[slot]
+            # The slot is only overwritten after the next snapshot:
+            if meter.seq <= 2 * published + 2:
+                break
+        # This is the number of the snapshot which was actually read, even
+        # if a newer one has been published in the meantime:
+        meter.acknowledged = published
+        return Levels(
+            [levels.peak for levels in copy],
+            [_math.sqrt(levels.sum_squares / frames) if frames else 0.0
+             for levels in copy],
+            [levels.clipped for levels in copy],
+            frames)
+
+    def _clock(self):
+        """Get frame clock and time of the last block (without tearing)."""
+        state = self._state
+        while True:
+            seq = state.clock_seq
+            if seq % 2:
+                continue  # The callback is writing
+            frame = state.clock.frame
+            if state.output_channels:
+                time = state.clock.output_time
+            else:
+                time = state.clock.input_time
+            if state.clock_seq == seq:
+                return frame, time
+
+    def close(self, ignore_errors=True):
+        """Close the stream and stop the helper thread."""
+        super(_Base, self).close(ignore_errors)
+        if self._result_thread is None:
+            return
+        self._file_thread.close()
+        self._state.result_fd = -1
+        fd_read, fd_write = self._result_fds
+        self._result_fds = None
+        _os.write(fd_write, b'\0')
+        self._result_thread.join()
+        self._result_thread = None
+        _os.close(fd_read)
+        _os.close(fd_write)
+        with self._finished:
+            for futures in self._futures.values():
+                for loop, future in futures:
+                    _call_soon_threadsafe(loop, future.cancel)
+            self._futures.clear()
+            for listener in self._listeners:
+                _call_soon_threadsafe(listener._loop, listener._close)
+
+    def cancel(self, action, time=0, allow_belated=True, frame=None):
         """Initiate stopping a running action.
 
         This creates another action that is sent to the callback in
@@ -44,33 +324,140 @@ class _Base(_sd._StreamBase):
         This function typically returns before the *action* is actually
         stopped.  Use `wait()` to wait until it's done.
 
+        Instead of the stream *time*, a position on the frame clock can
+        be given as *frame*, see `Mixer.play_buffer()`.
+
         """
-        cancel_action = _ffi.new('struct action*', dict(
-            type=_lib.CANCEL,
-            allow_belated=allow_belated,
-            requested_time=time,
-            action=action,
-        ))
+        cancel_action = self._new_action(_lib.CANCEL)
+        cancel_action.allow_belated = allow_belated
+        _set_start(cancel_action, time, frame)
+        cancel_action.action = action
+        # The cancelled action must not be recycled while in use:
+        self._enqueue(cancel_action, keepalive=action)
+        return cancel_action
+
+    def cancel_all(self, group=0, time=0, allow_belated=True, frame=None):
+        """Initiate stopping all running and scheduled actions.
+
+        If *group* is non-zero, only the actions which were created with
+        the same *group* argument are stopped.
+
+        Like `cancel()`, this creates another action, which stops all
+        matching actions in a single pass.
+
+        """
+        cancel_action = self._new_action(_lib.CANCEL_ALL)
+        cancel_action.allow_belated = allow_belated
+        _set_start(cancel_action, time, frame)
+        cancel_action.group = group
         self._enqueue(cancel_action)
         return cancel_action
 
-    def wait(self, action, sleeptime=10):
+    def wait(self, action=None, timeout=None):
         """Wait for *action* to be finished.
 
-        Between repeatedly checking if the action is finished, this
-        waits for *sleeptime* milliseconds.
+        Instead of a single action, a sequence of actions can be given,
+        in which case this waits until all of them are finished.
+        By default, this waits until all currently active actions are
+        finished.
+
+        The callback notifies a helper thread as soon as any action is
+        finished, there is no polling involved.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum time to wait (in seconds).
+
+        Returns
+        -------
+        bool
+            ``False`` if the *timeout* expired, ``True`` otherwise.
+
+        """
+        with self._finished:
+            self._drain_result_q()
+            if action is None:
+                actions = set(self._actions)
+            elif isinstance(action, _ffi.CData):
+                actions = {action}
+            else:
+                actions = set(action)
+            return self._finished.wait_for(
+                lambda: actions.isdisjoint(self._actions), timeout)
+
+    def wait_async(self, action):
+        """Return an awaitable which is done when *action* is finished.
+
+        The awaitable's result is the *action* itself, which can be used
+        to inspect its *stats*, *actual_time* etc.
+
+        This has to be called from a coroutine (or callback) running in
+        an `asyncio` event loop.  The helper thread wakes up the event
+        loop when the action is finished, there is no polling involved.
+        Use `asyncio.gather()` to wait for several actions.
 
         """
-        while action in self.actions:
-            _sd.sleep(sleeptime)
+        import asyncio
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._finished:
+            self._drain_result_q()
+            if action in self._actions:
+                self._futures.setdefault(action, []).append((loop, future))
+            else:
+                future.set_result(action)
+        return future
+
+    def finished_actions(self):
+        """Return an asynchronous iterator over finished actions.
+
+        This yields all actions which are finished after calling this
+        function, until the stream is closed.  It has to be called from
+        a coroutine (or callback) running in an `asyncio` event loop,
+        and used there, e.g. with ``async for``.
+
+        """
+        import asyncio
+        listener = _FinishedActions(asyncio.get_running_loop())
+        with self._finished:
+            self._listeners.add(listener)
+        return listener
+
+    def results(self):
+        """Get the results of the actions finished since the last call.
 
-    def _check_channels(self, channels, kind):
-        """Check if number of channels or mapping was given."""
+        When an action is finished, a compact `Result` record is stored
+        in a log, so that finished actions can be monitored without
+        keeping the action objects alive.  If this is not called often
+        enough, the oldest records are lost (see *logsize*).
+
+        Returns
+        -------
+        list of Result
+            In the order in which the actions were finished.
+
+        """
+        with self._finished:
+            self._drain_result_q()
+            results = list(self._results)
+            self._results.clear()
+        return results
+
+    def _check_channels(self, channels, kind, routes=None):
+        """Check if number of channels or mapping was given.
+
+        If *routes* are given, the mapping is not used.
+
+        """
         assert kind in ('input', 'output')
         try:
             channels, mapping = len(channels), channels
         except TypeError:
+            channels = _operator.index(channels)
             mapping = tuple(range(1, channels + 1))
+        if routes is not None:
+            return channels, mapping
         max_channels = _sd._split(self.channels)[kind == 'output']
         if max(mapping) > max_channels:
             raise ValueError('Channel number too large')
@@ -78,21 +465,230 @@ class _Base(_sd._StreamBase):
             raise ValueError('Channel numbers start with 1')
         return channels, mapping
 
-    def _enqueue(self, action):
-        self._drain_result_q()
-        self._temp_action_ptr[0] = action
-        ret = self._action_q.write(self._temp_action_ptr)
-        if ret != 1:
-            raise RuntimeError('Action queue is full')
-        self._actions.add(action)
+    def _new_action(self, type, channels=0, mapping=()):
+        """Get an action from the pool (or allocate a new one).
 
-    def _drain_result_q(self):
-        """Get actions from the result queue and discard them."""
-        while self._result_q.read(self._temp_action_ptr):
+        Apart from *type*, *channels*, *mapping* and *gain* (which is
+        1), all members are zero.
+
+        """
+        action = self._pool.acquire(channels)
+        if action is None:
+            return _ffi.new('struct action*', dict(
+                type=type, channels=channels, mapping=mapping, gain=1.0))
+        action.type = type
+        action.channels = channels
+        action.mapping[0:channels] = mapping
+        action.gain = 1.0
+        return action
+
+    def _set_gain(self, action, gain, channel_gains, attack, release,
+                  curve):
+        """Set gain and fades of a playback action.
+
+        Return the per-channel gains, which must be kept alive.
+
+        """
+        action.gain = gain
+        action.attack = int(round(attack * self.samplerate))
+        action.release = int(round(release * self.samplerate))
+        action.fade_curve = _curve(curve)
+        if channel_gains is not None:
+            channel_gains = _ffi.new('float[]', list(channel_gains))
+            if len(channel_gains) != action.channels:
+                raise ValueError('Need one value per channel')
+            action.channel_gains = channel_gains
+        return channel_gains
+
+    def _set_routing(self, action, routes, bus):
+        """Set gain matrix and bus of a playback action.
+
+        Return the routes, which must be kept alive.
+
+        """
+        if bus is not None:
             try:
-                self._actions.remove(self._temp_action_ptr[0])
+                action.bus = self._buses[bus]._ptr
             except KeyError:
-                assert False
+                raise ValueError('Unknown bus: {0!r}'.format(bus))
+        if routes is not None:
+            routes = [tuple(route) for route in routes]
+            output_channels = _sd._split(self.channels)[1]
+            for source, target, _ in routes:
+                if not 1 <= source <= action.channels:
+                    raise ValueError('Source channel out of range')
+                if not 1 <= target <= output_channels:
+                    raise ValueError('Target channel out of range')
+            routes = _ffi.new('struct route[]', routes)
+            action.routes = routes
+            action.route_count = len(routes)
+        return routes
+
+    def _enqueue(self, action, keepalive=None):
+        """Send *action* to the callback.
+
+        *keepalive* is kept alive until the action is finished.
+
+        """
+        with self._finished:
+            self._drain_result_q()
+            self._temp_action_ptr[0] = action
+            ret = self._action_q.write(self._temp_action_ptr)
+            if ret != 1:
+                raise RuntimeError('Action queue is full')
+            self._actions[action] = action, keepalive
+
+    def _enqueue_chain(self, actions):
+        """Send a list of (action, keepalive) pairs with a single write.
+
+        Return False if the action queue is full (nothing is sent).
+
+        """
+        for (action, _), (next, _) in zip(actions, actions[1:]):
+            action.next = next
+        with self._finished:
+            self._drain_result_q()
+            self._temp_action_ptr[0] = actions[0][0]
+            if self._action_q.write(self._temp_action_ptr) != 1:
+                return False
+            for action, keepalive in actions:
+                self._actions[action] = action, keepalive
+        return True
+
+    def _buffer_action(self, type, kind, buffer, channels, start,
+                       allow_belated, group, dtype, start_frame=None,
+                       routes=None):
+        """Create action for play_buffer() and record_buffer()."""
+        channels, mapping = self._check_channels(channels, kind, routes)
+        if dtype is None:
+            dtype = getattr(buffer, 'dtype', 'float32')
+        sampleformat, samplesize = _sampleformat(dtype)
+        buffer = _ffi.from_buffer(buffer)
+        action = self._new_action(type, channels, mapping)
+        action.allow_belated = allow_belated
+        _set_start(action, start, start_frame)
+        action.group = group
+        action.buffer = buffer
+        action.total_frames = len(buffer) // channels // samplesize
+        action.buffer_frames = action.total_frames
+        action.sampleformat = sampleformat
+        return action, buffer
+
+    def _ringbuffer_action(self, type, kind, ringbuffer, channels, start,
+                           allow_belated, group, dtype, continue_on_xrun,
+                           start_frame=None, routes=None):
+        """Create action for play_ringbuffer() and record_ringbuffer()."""
+        if ringbuffer._offset:
+            raise ValueError('Ring buffer must be created by this process')
+        sampleformat, samplesize = _sampleformat(dtype)
+        if channels is None:
+            channels = ringbuffer.elementsize // samplesize
+        channels, mapping = self._check_channels(channels, kind, routes)
+        if ringbuffer.elementsize != samplesize * channels:
+            raise ValueError('Incompatible elementsize')
+        action = self._new_action(type, channels, mapping)
+        action.allow_belated = allow_belated
+        _set_start(action, start, start_frame)
+        action.group = group
+        action.ringbuffer = ringbuffer._ptr
+        action.total_frames = _lib.ULONG_MAX
+        action.sampleformat = sampleformat
+        action.continue_on_xrun = continue_on_xrun
+        action.min_available = _lib.ULONG_MAX
+        return action
+
+    def _enqueue_buffers(self, type, kind, buffers, channels, start,
+                         allow_belated, group, dtype, start_frame, gain=1.0,
+                         attack=0, release=0, curve='linear', routes=None,
+                         bus=None, priority=0):
+        """Implementation of play_buffers() and record_buffers()."""
+        buffers = list(buffers)
+        if not buffers:
+            return []
+        try:
+            channels = [_operator.index(channels)] * len(buffers)
+        except TypeError:
+            pass  # A sequence with a number of channels/mapping per buffer
+        start, allow_belated, group, start_frame, gain, priority = (
+            _broadcast(arg, len(buffers))
+            for arg in (start, allow_belated, group, start_frame, gain,
+                        priority))
+        if not len(buffers) == len(channels) == len(start) == \
+                len(allow_belated) == len(group) == len(start_frame) == \
+                len(gain) == len(priority):
+            raise ValueError('Arguments must have the same length')
+        actions = [
+            self._buffer_action(type, kind, buffer, channels, start,
+                                allow_belated, group, dtype, start_frame,
+                                routes)
+            for buffer, channels, start, allow_belated, group, start_frame
+            in zip(buffers, channels, start, allow_belated, group,
+                   start_frame)]
+        for (action, _), action_gain, action_priority in zip(
+                actions, gain, priority):
+            self._set_gain(action, action_gain, None, attack, release, curve)
+            action.priority = action_priority
+        actions = [
+            (action, (buffer, self._set_routing(action, routes, bus)))
+            for action, buffer in actions]
+        if not self._enqueue_chain(actions):
+            return None
+        return [action for action, _ in actions]
+
+    def _drain_result_q(self):
+        """Get actions from the result queue and discard them.
+
+        This must be called while holding the lock of self._finished.
+
+        """
+        drained = False
+        while self._result_q.read(self._result_ptr):
+            # The callback sends linked lists of actions, newest first:
+            chain = []
+            ptr = self._result_ptr[0]
+            while ptr:
+                chain.append(ptr)
+                ptr = ptr.next
+            for ptr in reversed(chain):
+                self._finish(ptr)
+            drained = True
+        if drained:
+            self._finished.notify_all()
+
+    def _finish(self, ptr):
+        """Release a finished action and notify anyone waiting for it."""
+        try:
+            action, keepalive = self._actions.pop(ptr)
+        except KeyError:
+            assert False
+        stats = action.stats
+        self._results.append(Result(
+            _ACTION_TYPES[action.type], action.group,
+            _END_REASONS[action.end_reason], action.actual_time,
+            action.done_frames,
+            action.xruns + stats.input_underflows + stats.input_overflows +
+            stats.output_underflows + stats.output_overflows))
+        for loop, future in self._futures.pop(action, ()):
+            _call_soon_threadsafe(loop, _set_result, future, action)
+        for listener in self._listeners:
+            _call_soon_threadsafe(listener._loop, listener._put, action)
+        if action.type == _lib.PLAY_PLAYLIST:
+            # The callback doesn't touch the queue anymore:
+            for segment in keepalive._take_queued():
+                segment.end_reason = _lib.CANCELLED
+                self._finish(segment)
+
+    def _watch_results(self):
+        """Run in the helper thread, wait for notifications from callback."""
+        fd = self._result_fds[0]
+        polling = self._state.result_fd < 0
+        while self._result_fds is not None:
+            if polling:
+                _time.sleep(_POLLING_INTERVAL)
+            else:
+                _os.read(fd, 4096)
+            with self._finished:
+                self._drain_result_q()
 
 
 class Mixer(_Base):
@@ -106,57 +702,568 @@ class Mixer(_Base):
 
         Uses default values from `sounddevice.default`.
 
+        In addition, the following keyword arguments can be used (also
+        in `Recorder` and `MixerAndRecorder`):
+
+        Parameters
+        ----------
+        qsize : int, optional
+            Size of the queues for sending actions to the callback and
+            for getting them back (must be a power of 2).
+        pendingsize : int, optional
+            Maximum number of actions which can be efficiently stored
+            before they are due to start.
+        poolsize : int, optional
+            Number of preallocated actions, see `pool_usage`.
+        buses : sequence of str or dict, optional
+            Names of submix buses (only used for playback), see
+            `buses`.  Instead of a sequence, a mapping from names to
+            initial gains can be given, otherwise the gains are 1.
+        metering : bool, optional
+            Whether the levels of the input and/or output signal are
+            measured in the callback, see `output_levels()` and
+            `Recorder.input_levels()`.
+        telemetrysize : int, optional
+            Number of blocks stored for `telemetry()` (must be a power
+            of 2, 0 disables it).
+        logsize : int, optional
+            Maximum number of records stored for `results()`.
+        maxvoices : int, optional
+            Maximum number of actions created by `play_buffer()` et al.
+            which are played at the same time (0 means no limit).
+            If there are more, the ones with the lowest *priority* (and
+            among those, the quietest and then the oldest ones) are
+            "stolen": they are faded out or, if they haven't started
+            yet, skipped.  At most 16 voices are stolen per block, if
+            there are more, the limit is reached within the following
+            blocks.  See also `load_stats`.
+        maxload : float, optional
+            Budget for the execution time of the callback, as a fraction
+            of the duration of a block (0 means no budget).  Whenever a
+            block takes longer, one voice is stolen in the next block
+            (see *maxvoices*).
+        stealfade : float, optional
+            Duration (in seconds) of the fade-out of stolen voices.
+
         """
         _Base.__init__(self, kind='output', **kwargs)
         self._state.output_channels = self.channels
 
-    def play_buffer(self, buffer, channels, start=0, allow_belated=True):
+    def output_levels(self):
+        """Get the levels of the output signal since the last call.
+
+        The levels are measured in the callback (if the stream was
+        created with ``metering=True``) after all actions have been
+        mixed.  Only a few values per channel are transferred, not the
+        signal itself, so this can be called often (e.g. to update a
+        level meter).  No peaks are lost if it is called rarely.
+
+        Returns
+        -------
+        Levels
+            Levels of all output channels.  On the first call, the
+            levels since the stream was started are returned.  If no
+            block has been processed since the last call, *frames* is
+            0 and all levels are 0.
+
+        """
+        return self._levels('output')
+
+    @property
+    def buses(self):
+        """Submix buses (a mapping from names to `Bus` objects).
+
+        Playback actions can be mixed into one of the buses (see the
+        *bus* argument of `play_buffer()` et al.), which multiplies
+        them with the gain of the bus before they reach the device.
+
+        """
+        return self._buses
+
+    def play_buffer(self, buffer, channels, start=0, allow_belated=True,
+                    group=0, dtype=None, offset=0, loop_start=0,
+                    loop_end=None, loops=0, start_frame=None, gain=1.0,
+                    channel_gains=None, attack=0, release=0,
+                    curve='linear', routes=None, bus=None, priority=0):
         """Send a buffer to the callback to be played back.
 
         After that, the *buffer* must not be written to anymore.
 
+        The samples in *buffer* can have the *dtype* ``'float32'``,
+        ``'int16'``, ``'int24'`` (packed 3-byte little-endian samples)
+        or ``'int32'``, they are converted in the callback.  By default,
+        the *dtype* of the buffer is used if it has one (e.g. a NumPy
+        array), otherwise ``'float32'``.
+
+        Playback begins at frame *offset* of the buffer.  If *loops* is
+        non-zero, the frames from *loop_start* up to (but not including)
+        *loop_end* (by default the end of the buffer) are repeated
+        *loops* times before playback continues to the end of the
+        buffer.  If *loops* is negative, the loop is repeated until the
+        action is cancelled.  The loop region has to be reached by the
+        playhead, i.e. *offset* must be smaller than *loop_end*.
+
+        The ``total_frames`` of the returned action include all
+        repetitions (or are ``ULONG_MAX`` for an infinite loop), the
+        current frame in the buffer is available as ``position``.
+
+        The *start* time is converted to a position on the stream's
+        frame clock when the callback receives the action.  For
+        sample-accurate scheduling, the frame number can be given
+        directly as *start_frame* (*start* is ignored in this case),
+        see `frame` and `time_to_frame()`.  The frame clock is shared
+        by input and output.
+
+        The samples are multiplied by *gain* and, if given, by the
+        respective value in *channel_gains* (one per channel).
+        *attack* and *release* are the durations (in seconds) of a
+        fade-in at the beginning and a fade-out at the end of the
+        action.  When the action is stopped with `cancel()`, the
+        fade-out starts at the requested time.  The *curve*
+        of the fades can be ``'linear'`` or ``'exponential'`` (i.e.
+        linear in dB, starting at -60 dB).  The gain can be changed
+        with `set_gain()` while the action is playing.  All this is
+        done in the callback, the same *buffer* can be used by many
+        actions.
+
+        Instead of a channel mapping, a sparse gain matrix can be given
+        as *routes*, i.e. a sequence of ``(source, target, gain)``
+        triples: channel *source* of the buffer is added to channel
+        *target* of the stream (both starting with 1), multiplied by
+        *gain*.  In this case, *channels* only determines the number of
+        channels in the buffer.  Each frame of the buffer is read only
+        once, even if its channels are sent to several outputs.
+
+        If *bus* is given, it must be the name of one of the `buses`,
+        whose gain is applied in addition to the other gains.
+
+        If the number of voices is limited (see *maxvoices* in
+        `Mixer`), the voices with the lowest *priority* are stolen
+        first.
+
         """
-        channels, mapping = self._check_channels(channels, 'output')
-        buffer = _ffi.from_buffer(buffer)
-        _, samplesize = _sd._split(self.samplesize)
-        action = _ffi.new('struct action*', dict(
-            type=_lib.PLAY_BUFFER,
-            allow_belated=allow_belated,
-            requested_time=start,
-            buffer=_ffi.cast('float*', buffer),
-            total_frames=len(buffer) // channels // samplesize,
-            channels=channels,
-            mapping=mapping,
-        ))
-        self._enqueue(action)
+        action, keepalive = self._play_buffer_action(
+            buffer, channels, start, allow_belated, group, dtype, offset,
+            loop_start, loop_end, loops, start_frame, gain, channel_gains,
+            attack, release, curve, routes, bus)
+        action.priority = priority
+        self._enqueue(action, keepalive=keepalive)
+        return action
+
+    def _play_buffer_action(self, buffer, channels, start, allow_belated,
+                            group, dtype, offset, loop_start, loop_end,
+                            loops, start_frame, gain, channel_gains, attack,
+                            release, curve, routes, bus):
+        """Create action for play_buffer() and Playlist.append().
+
+        Return the action and the objects to be kept alive.
+
+        """
+        action, buffer = self._buffer_action(
+            _lib.PLAY_BUFFER, 'output', buffer, channels, start,
+            allow_belated, group, dtype, start_frame, routes)
+        channel_gains = self._set_gain(action, gain, channel_gains, attack,
+                                       release, curve)
+        routes = self._set_routing(action, routes, bus)
+        frames = action.buffer_frames
+        if not 0 <= offset <= frames:
+            raise ValueError('offset out of range')
+        action.position = offset
+        action.total_frames = frames - offset
+        if loops:
+            if loop_end is None:
+                loop_end = frames
+            if not 0 <= loop_start < loop_end <= frames:
+                raise ValueError('Invalid loop region')
+            if offset >= loop_end:
+                raise ValueError('offset must be smaller than loop_end')
+            action.loop_start = loop_start
+            action.loop_end = loop_end
+            if loops < 0:
+                action.total_frames = _lib.ULONG_MAX
+            else:
+                action.total_frames += loops * (loop_end - loop_start)
+        return action, (buffer, channel_gains, routes)
+
+    def play_buffers(self, buffers, channels, start=0, allow_belated=True,
+                     group=0, dtype=None, start_frame=None, gain=1.0,
+                     attack=0, release=0, curve='linear', routes=None,
+                     bus=None, priority=0):
+        """Send several buffers to the callback at once.
+
+        This is equivalent to calling `play_buffer()` for each buffer,
+        but all actions are sent to the callback in a single queue
+        operation, therefore they only need one slot in the action
+        queue.
+
+        Parameters
+        ----------
+        buffers : sequence of buffers
+            Buffers to be played back.
+        channels : int or sequence
+            Either a number of channels used for all buffers, or a
+            sequence containing a number of channels or a channel
+            mapping for each buffer.
+        start, allow_belated, group, start_frame, gain : scalar or sequence
+            See `play_buffer()`.  A single value is used for all
+            buffers, a sequence (e.g. a NumPy array) must contain a
+            value for each buffer.
+        dtype, attack, release, curve, routes, bus : optional
+            See `play_buffer()`, used for all buffers.
+        priority : int or sequence, optional
+            See `play_buffer()`, a single value or one per buffer.
+
+        Returns
+        -------
+        list of actions or None
+            If the action queue is full, ``None`` is returned and
+            none of the buffers are played.
+
+        """
+        return self._enqueue_buffers(_lib.PLAY_BUFFER, 'output', buffers,
+                                     channels, start, allow_belated, group,
+                                     dtype, start_frame, gain, attack,
+                                     release, curve, routes, bus, priority)
+
+    def register_samples(self, bank):
+        """Make the samples of a `SampleBank` available to `trigger()`.
+
+        The sample IDs must be unique among all registered banks.
+
+        """
+        output_channels = _sd._split(self.channels)[1]
+        for sample_id, sample in bank._samples.items():
+            if sample_id in self._samples:
+                raise ValueError('Duplicate sample ID: {0!r}'.format(
+                    sample_id))
+            if sample.channels > output_channels:
+                raise ValueError('Too many channels in sample {0!r}'.format(
+                    sample_id))
+        self._samples.update(
+            (sample_id, (sample, bank))
+            for sample_id, sample in bank._samples.items())
+
+    def trigger(self, sample_id, start=0, gain=1.0, channels=None,
+                start_frame=None, allow_belated=True, group=0, priority=0):
+        """Play a sample which was registered with `register_samples()`.
+
+        This is a faster alternative to `play_buffer()` for sounds
+        which are played many times: the buffer, its size, sample
+        format and default channel mapping are already known, only
+        the action has to be created and sent to the callback.
+
+        By default, the channels of the sample are played on the
+        channels 1, 2, ... of the stream, a different channel mapping
+        (with one channel per channel of the sample) can be given as
+        *channels*.  The other arguments are the same as in
+        `play_buffer()`.
+
+        """
+        try:
+            sample, bank = self._samples[sample_id]
+        except KeyError:
+            raise ValueError('Unknown sample ID: {0!r}'.format(sample_id))
+        mapping = sample.mapping
+        if channels is not None:
+            count, mapping = self._check_channels(channels, 'output')
+            if count != sample.channels:
+                raise ValueError('Wrong number of channels for sample')
+        action = self._new_action(_lib.PLAY_BUFFER, sample.channels, mapping)
+        action.allow_belated = allow_belated
+        _set_start(action, start, start_frame)
+        action.group = group
+        action.priority = priority
+        action.buffer = sample.buffer
+        action.total_frames = sample.frames
+        action.buffer_frames = sample.frames
+        action.sampleformat = sample.sampleformat
+        action.gain = gain
+        self._enqueue(action, keepalive=bank)
         return action
 
+    def play_buffer_async(self, *args, **kwargs):
+        """Like `play_buffer()`, but return an awaitable.
+
+        See `wait_async()`.
+
+        """
+        return self.wait_async(self.play_buffer(*args, **kwargs))
+
+    def set_gain(self, action, gain, duration=0, curve='linear', time=0,
+                 allow_belated=True, frame=None):
+        """Change the gain of a playback action.
+
+        Like `cancel()`, this creates another action that is sent to
+        the callback, the playing *action* is not interrupted.  The
+        gain changes smoothly within *duration* seconds, starting at
+        the frame in which the new action is due (see *time* and
+        *frame* in `cancel()`).  With an ``'exponential'`` *curve*,
+        the gain changes linearly in dB (going to and from zero via
+        -60 dB), see `play_buffer()`.  If the *action* doesn't start
+        before that frame, its gain is changed without a ramp.
+
+        The gain of a playlist can't be changed (but the gain of each
+        buffer can be given to `Playlist.append()`).
+
+        """
+        if action.type == _lib.PLAY_PLAYLIST:
+            raise ValueError('set_gain() is not supported for playlists')
+        gain_action = self._new_action(_lib.SET_GAIN)
+        gain_action.allow_belated = allow_belated
+        _set_start(gain_action, time, frame)
+        gain_action.action = action
+        gain_action.target_gain = gain
+        gain_action.gain_ramp = int(round(duration * self.samplerate))
+        gain_action.gain_curve = _curve(curve)
+        # The action must not be recycled while in use:
+        self._enqueue(gain_action, keepalive=action)
+        return gain_action
+
+    def play_playlist(self, buffers=(), channels=None, start=0,
+                      allow_belated=True, group=0, dtype=None, crossfade=0,
+                      qsize=64, continue_on_xrun=False, start_frame=None,
+                      bus=None):
+        """Play a sequence of buffers back to back.
+
+        The callback switches to the next buffer within the same block,
+        so the buffers are joined without gaps (and without relying on
+        the accuracy of the *start* times of separate actions).  More
+        buffers can be added with `Playlist.append()` while the
+        playlist is playing.
+
+        Parameters
+        ----------
+        buffers : sequence of buffers, optional
+            Buffers to be played first, see `Playlist.append()`.
+        channels : int or sequence, optional
+            Default channels (or channel mapping) of the buffers.
+        start, allow_belated, group, start_frame, bus
+            See `play_buffer()`, these apply to the whole playlist.
+        dtype : str, optional
+            Default sample format of the buffers, see `play_buffer()`.
+        crossfade : int, optional
+            If non-zero, the last *crossfade* frames of each buffer are
+            mixed with the beginning of the next one, using linear
+            fades.  The overlap is shorter if one of the buffers is
+            too short or if the next buffer is appended too late.
+        qsize : int, optional
+            Maximum number of buffers waiting in the queue, must be a
+            power of 2.
+        continue_on_xrun : bool, optional
+            By default, the playlist is finished when it runs out of
+            buffers.  If true, it waits for new buffers (counting the
+            blocks and frames without audio data in ``xruns`` and
+            ``dropped_frames``) until it is cancelled.
+
+        Returns
+        -------
+        Playlist
+            The action can be obtained from `Playlist.action`.
+
+        """
+        action = self._new_action(_lib.PLAY_PLAYLIST)
+        action.allow_belated = allow_belated
+        _set_start(action, start, start_frame)
+        action.group = group
+        action.total_frames = _lib.ULONG_MAX
+        action.crossfade = crossfade
+        action.continue_on_xrun = continue_on_xrun
+        self._set_routing(action, None, bus)
+        playlist = Playlist(self, qsize, channels, dtype)
+        for buffer in buffers:
+            if playlist.append(buffer) is None:
+                playlist._discard()
+                raise ValueError('qsize is too small for all buffers')
+        action.ringbuffer = playlist._queue._ptr
+        playlist.action = action
+        try:
+            self._enqueue(action, keepalive=playlist)
+        except RuntimeError:
+            playlist._discard()
+            raise
+        return playlist
+
     def play_ringbuffer(self, ringbuffer, channels=None, start=0,
-                        allow_belated=True):
+                        allow_belated=True, group=0, dtype='float32',
+                        continue_on_xrun=False, start_frame=None, gain=1.0,
+                        channel_gains=None, attack=0, release=0,
+                        curve='linear', routes=None, bus=None):
         """Send a ring buffer to the callback to be played back.
 
         By default, the number of channels is obtained from the ring
-        buffer's *elementsize*.
+        buffer's *elementsize* and the sample format *dtype* (see
+        `play_buffer()`).
+
+        If the ring buffer doesn't contain enough data, playback is
+        stopped, unless *continue_on_xrun* is true, in which case the
+        missing frames are left silent.  In both cases, the action's
+        ``xruns`` and ``dropped_frames`` are incremented.  The smallest
+        number of frames which were available for reading is stored in
+        ``min_available``.
+
+        For the gain-related arguments, *routes* and *bus*, see
+        `play_buffer()`.  The *release* fade is applied when the action
+        is cancelled.
 
         """
-        _, samplesize = _sd._split(self.samplesize)
-        if channels is None:
-            channels = ringbuffer.elementsize // samplesize
-        channels, mapping = self._check_channels(channels, 'output')
-        if ringbuffer.elementsize != samplesize * channels:
-            raise ValueError('Incompatible elementsize')
-        action = _ffi.new('struct action*', dict(
-            type=_lib.PLAY_RINGBUFFER,
-            allow_belated=allow_belated,
-            requested_time=start,
-            ringbuffer=ringbuffer._ptr,
-            total_frames=_lib.ULONG_MAX,
-            channels=channels,
-            mapping=mapping,
-        ))
-        self._enqueue(action)
+        action = self._ringbuffer_action(
+            _lib.PLAY_RINGBUFFER, 'output', ringbuffer, channels, start,
+            allow_belated, group, dtype, continue_on_xrun, start_frame,
+            routes)
+        channel_gains = self._set_gain(action, gain, channel_gains, attack,
+                                       release, curve)
+        routes = self._set_routing(action, routes, bus)
+        self._enqueue(action, keepalive=(ringbuffer, channel_gains, routes))
         return action
 
+    def play_ringbuffer_async(self, *args, **kwargs):
+        """Like `play_ringbuffer()`, but return an awaitable.
+
+        See `wait_async()`.
+
+        """
+        return self.wait_async(self.play_ringbuffer(*args, **kwargs))
+
+    def play_file(self, file, channels=None, start=0, allow_belated=True,
+                  group=0, buffersize=65536, dtype='float32',
+                  start_frame=None, gain=1.0, channel_gains=None, attack=0,
+                  release=0, curve='linear', routes=None, bus=None,
+                  **kwargs):
+        """Play an audio file, reading it in a background thread.
+
+        The file is opened with `soundfile.SoundFile` (which also gets
+        the additional *kwargs*), and it is read directly into a
+        `RingBuffer` of *buffersize* frames (must be a power of 2).
+        All files played by this stream are read by the same thread.
+
+        Parameters
+        ----------
+        file : str or file-like object or soundfile.SoundFile
+            The file to be played.  It must be seekable (i.e. its
+            length must be known).
+        channels : int or sequence, optional
+            Channel mapping, by default the channels of the file are
+            played on the first channels of the stream.
+        start, allow_belated, group, start_frame
+            See `play_buffer()`.
+        buffersize : int, optional
+            Size of the ring buffer in frames.
+        dtype : {'float32', 'int16', 'int32'}, optional
+            Sample format used in the ring buffer.
+        gain, channel_gains, attack, release, curve, routes, bus : optional
+            See `play_buffer()`.  If *routes* are given, *channels* is
+            ignored.
+
+        Returns
+        -------
+        FileStreamer
+            The action can be obtained from `FileStreamer.action`.
+
+        """
+        import soundfile
+        if not isinstance(file, soundfile.SoundFile):
+            file = soundfile.SoundFile(file, **kwargs)
+        if channels is None or routes is not None:
+            channels = file.channels
+        _file_subtype(dtype)  # Check if soundfile supports dtype
+        _, samplesize = _sampleformat(dtype)
+        ringbuffer = RingBuffer(samplesize * file.channels, buffersize)
+        streamer = FileStreamer(file, ringbuffer, dtype)
+        streamer._service()  # Pre-fill ring buffer
+        action = self._ringbuffer_action(
+            _lib.PLAY_RINGBUFFER, 'output', ringbuffer, channels, start,
+            allow_belated, group, dtype, True, start_frame, routes)
+        action.total_frames = streamer._frames
+        channel_gains = self._set_gain(action, gain, channel_gains, attack,
+                                       release, curve)
+        routes = self._set_routing(action, routes, bus)
+        streamer.action = action
+        self._enqueue(action, keepalive=(ringbuffer, channel_gains, routes))
+        self._file_thread.add(streamer)
+        return streamer
+
+    def play_mmap(self, file, channels=None, start=0, allow_belated=True,
+                  group=0, dtype=None, byteoffset=0, prefetch=2.0,
+                  start_frame=None, gain=1.0, channel_gains=None, attack=0,
+                  release=0, curve='linear', routes=None, bus=None):
+        """Play a WAV or raw file directly from a memory mapping.
+
+        The file is not read by Python, the callback reads the samples
+        directly from the mapped memory (which is shared between all
+        processes that map the same file).  To avoid page faults in
+        the callback, the pages ahead of the current playback position
+        are pre-faulted by the background thread that is also used by
+        `play_file()`.
+
+        Parameters
+        ----------
+        file : str
+            The file name.  If the file is a WAV file (with
+            uncompressed integer or 32-bit float samples), the sample
+            format and number of channels are obtained from its header.
+            Otherwise, *dtype* and *channels* must be given.
+        channels : int or sequence, optional
+            Number of channels or channel mapping, see `play_buffer()`.
+            For WAV files, it must match the number of channels in the
+            file.
+        start, allow_belated, group, start_frame
+            See `play_buffer()`.
+        dtype : {'float32', 'int16', 'int24', 'int32'}, optional
+            Sample format of a raw file.
+        byteoffset : int, optional
+            Position of the first sample in a raw file (in bytes, e.g.
+            the size of a header).  Unlike the *offset* of
+            `play_buffer()`, this is not counted in frames.
+        prefetch : float, optional
+            How far ahead of the playback position (in seconds) the
+            pages are kept in memory.
+        gain, channel_gains, attack, release, curve, routes, bus : optional
+            See `play_buffer()`.
+
+        Returns
+        -------
+        MmapStreamer
+            The action can be obtained from `MmapStreamer.action`.
+
+        """
+        with open(file, 'rb') as f:
+            memory = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+        wav = _parse_wav(memory)
+        if wav:
+            offset, size, filechannels, dtype = wav
+            if channels is None:
+                channels = filechannels
+        elif dtype is None or channels is None:
+            raise ValueError('dtype and channels are needed for raw files')
+        else:
+            offset = byteoffset
+            size = len(memory) - offset
+        sampleformat, samplesize = _sampleformat(dtype)
+        channels, mapping = self._check_channels(channels, 'output', routes)
+        if wav and channels != filechannels:
+            raise ValueError('Wrong number of channels')
+        framesize = samplesize * channels
+        data = _ffi.from_buffer(memory)
+        action = self._new_action(_lib.PLAY_BUFFER, channels, mapping)
+        action.allow_belated = allow_belated
+        _set_start(action, start, start_frame)
+        action.group = group
+        action.buffer = data + offset
+        action.total_frames = size // framesize
+        action.buffer_frames = action.total_frames
+        action.sampleformat = sampleformat
+        channel_gains = self._set_gain(action, gain, channel_gains, attack,
+                                       release, curve)
+        routes = self._set_routing(action, routes, bus)
+        streamer = MmapStreamer(memory, action, offset, framesize,
+                                int(prefetch * self.samplerate),
+                                self.samplerate)
+        streamer._service()  # Pre-fault the beginning
+        self._enqueue(action, keepalive=(data, memory, channel_gains,
+                                         routes))
+        self._file_thread.add(streamer)
+        return streamer
+
 
 class Recorder(_Base):
     """PortAudio input stream for realtime recording."""
@@ -173,51 +1280,141 @@ class Recorder(_Base):
         _Base.__init__(self, kind='input', **kwargs)
         self._state.input_channels = self.channels
 
-    def record_buffer(self, buffer, channels, start=0, allow_belated=True):
+    def input_levels(self):
+        """Get the levels of the input signal since the last call.
+
+        See `Mixer.output_levels()`.
+
+        """
+        return self._levels('input')
+
+    def record_buffer(self, buffer, channels, start=0, allow_belated=True,
+                      group=0, dtype=None, start_frame=None):
         """Send a buffer to the callback to be recorded into.
 
+        Integer sample formats are supported, see `Mixer.play_buffer()`.
+        Values outside of the range from -1 to 1 are clipped when
+        recording into integer buffers.
+
         """
-        channels, mapping = self._check_channels(channels, 'input')
-        buffer = _ffi.from_buffer(buffer)
-        samplesize, _ = _sd._split(self.samplesize)
-        action = _ffi.new('struct action*', dict(
-            type=_lib.RECORD_BUFFER,
-            allow_belated=allow_belated,
-            requested_time=start,
-            buffer=_ffi.cast('float*', buffer),
-            total_frames=len(buffer) // channels // samplesize,
-            channels=channels,
-            mapping=mapping,
-        ))
-        self._enqueue(action)
+        action, buffer = self._buffer_action(
+            _lib.RECORD_BUFFER, 'input', buffer, channels, start,
+            allow_belated, group, dtype, start_frame)
+        self._enqueue(action, keepalive=buffer)
         return action
 
+    def record_buffers(self, buffers, channels, start=0, allow_belated=True,
+                       group=0, dtype=None, start_frame=None):
+        """Send several buffers to the callback at once.
+
+        This is the recording counterpart of `Mixer.play_buffers()`.
+
+        Returns
+        -------
+        list of actions or None
+            If the action queue is full, ``None`` is returned and
+            none of the buffers are recorded into.
+
+        """
+        return self._enqueue_buffers(_lib.RECORD_BUFFER, 'input', buffers,
+                                     channels, start, allow_belated, group,
+                                     dtype, start_frame)
+
+    def record_buffer_async(self, *args, **kwargs):
+        """Like `record_buffer()`, but return an awaitable.
+
+        See `wait_async()`.
+
+        """
+        return self.wait_async(self.record_buffer(*args, **kwargs))
+
     def record_ringbuffer(self, ringbuffer, channels=None, start=0,
-                          allow_belated=True):
+                          allow_belated=True, group=0, dtype='float32',
+                          continue_on_xrun=False, start_frame=None):
         """Send a ring buffer to the callback to be recorded into.
 
         By default, the number of channels is obtained from the ring
-        buffer's *elementsize*.
+        buffer's *elementsize* and the sample format *dtype* (see
+        `record_buffer()`).
+
+        If the ring buffer is full, recording is stopped, unless
+        *continue_on_xrun* is true, in which case the frames are
+        dropped, see `Mixer.play_ringbuffer()`.
 
         """
-        samplesize, _ = _sd._split(self.samplesize)
-        if channels is None:
-            channels = ringbuffer.elementsize // samplesize
-        channels, mapping = self._check_channels(channels, 'input')
-        if ringbuffer.elementsize != samplesize * channels:
-            raise ValueError('Incompatible elementsize')
-        action = _ffi.new('struct action*', dict(
-            type=_lib.RECORD_RINGBUFFER,
-            allow_belated=allow_belated,
-            requested_time=start,
-            ringbuffer=ringbuffer._ptr,
-            total_frames=_lib.ULONG_MAX,
-            channels=channels,
-            mapping=mapping,
-        ))
-        self._enqueue(action)
+        action = self._ringbuffer_action(
+            _lib.RECORD_RINGBUFFER, 'input', ringbuffer, channels, start,
+            allow_belated, group, dtype, continue_on_xrun, start_frame)
+        self._enqueue(action, keepalive=ringbuffer)
         return action
 
+    def record_ringbuffer_async(self, *args, **kwargs):
+        """Like `record_ringbuffer()`, but return an awaitable.
+
+        See `wait_async()`.
+
+        """
+        return self.wait_async(self.record_ringbuffer(*args, **kwargs))
+
+    def record_to_file(self, file, channels, start=0, allow_belated=True,
+                       group=0, frames=None, buffersize=65536,
+                       dtype='float32', start_frame=None, **kwargs):
+        """Record into an audio file, writing it in a background thread.
+
+        The frames are recorded into a `RingBuffer` of *buffersize*
+        frames (must be a power of 2), which is written directly to the
+        file (using `soundfile.SoundFile`) by the same thread that is
+        used by `Mixer.play_file()`.
+
+        If the ring buffer is full, the recording continues, but the
+        frames which don't fit are dropped, see
+        `FileRecorder.dropped_frames` and
+        `FileRecorder.max_buffered_frames`.
+
+        Parameters
+        ----------
+        file : str or file-like object
+            The file to be written.  The *kwargs* are passed to
+            `soundfile.SoundFile`, e.g. *format* and *subtype*.  By
+            default, the subtype matches *dtype*.
+        channels : int or sequence
+            Number of channels or channel mapping, see
+            `record_buffer()`.
+        start, allow_belated, group, start_frame
+            See `record_buffer()`.
+        frames : int, optional
+            Number of frames to record.  By default, the recording
+            continues until it is cancelled (see `cancel()`).
+        buffersize : int, optional
+            Size of the ring buffer in frames.
+        dtype : {'float32', 'int16', 'int32'}, optional
+            Sample format used in the ring buffer.
+
+        Returns
+        -------
+        FileRecorder
+            The action can be obtained from `FileRecorder.action`.
+
+        """
+        import soundfile
+        kwargs.setdefault('subtype', _file_subtype(dtype))
+        _, samplesize = _sampleformat(dtype)
+        channels, mapping = self._check_channels(channels, 'input')
+        file = soundfile.SoundFile(
+            file, 'w', samplerate=int(self.samplerate), channels=channels,
+            **kwargs)
+        ringbuffer = RingBuffer(samplesize * channels, buffersize)
+        recorder = FileRecorder(file, ringbuffer, dtype)
+        action = self._ringbuffer_action(
+            _lib.RECORD_RINGBUFFER, 'input', ringbuffer, mapping, start,
+            allow_belated, group, dtype, True, start_frame)
+        if frames is not None:
+            action.total_frames = frames
+        recorder.action = action
+        self._enqueue(action, keepalive=ringbuffer)
+        self._file_thread.add(recorder)
+        return recorder
+
 
 class MixerAndRecorder(Mixer, Recorder):
     """PortAudio stream for realtime mixing and recording."""
@@ -236,6 +1433,775 @@ class MixerAndRecorder(Mixer, Recorder):
         self._state.output_channels = self.channels[1]
 
 
+class _VirtualStream(_sd._StreamBase):
+    """Replacement for sounddevice._StreamBase without an audio device.
+
+    The audio callback is invoked with a virtual clock, either on demand
+    (see `process()` and `render()`) or by a driver thread which is
+    started with `start()`.
+
+    """
+
+    def __init__(self, kind, samplerate=48000, blocksize=1024, channels=2,
+                 dtype='float32', callback=None, userdata=None, input=None,
+                 realtime=True):
+        if blocksize < 1:
+            raise ValueError('blocksize must be at least 1')
+        assert dtype == 'float32'
+        if kind == 'duplex':
+            input_channels, output_channels = _sd._split(channels)
+            self._channels = input_channels, output_channels
+            self._samplesize = 4, 4
+            self._latency = 0.0, 0.0
+            self._device = -1, -1
+        else:
+            assert kind in ('input', 'output')
+            input_channels = channels if kind == 'input' else 0
+            output_channels = channels if kind == 'output' else 0
+            self._channels = channels
+            self._samplesize = 4
+            self._latency = 0.0
+            self._device = -1
+        self._samplerate = float(samplerate)
+        self._blocksize = blocksize
+        self._dtype = dtype
+        self._callback = callback
+        self._userdata = userdata
+        self._input_function = None
+        self._input_data = None
+        if callable(input):
+            self._input_function = input
+        elif input is not None:
+            self._input_data = _ffi.from_buffer(input)
+        self._input_offset = 0
+        self._realtime = realtime
+        self._input_framesize = 4 * input_channels
+        self._output_framesize = 4 * output_channels
+        self._input_buffer = _ffi.new('float[]', blocksize * input_channels)
+        self._output_buffer = _ffi.new('float[]', blocksize * output_channels)
+        self._timeinfo = _ffi.new('PaStreamCallbackTimeInfo*')
+        self._frames = 0
+        self._cpu_load = 0.0
+        self._lock = _threading.Lock()
+        self._stopping = _threading.Event()
+        self._thread = None
+        self._closed = False
+
+    @property
+    def active(self):
+        """``True`` while the driver thread is running."""
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def stopped(self):
+        """``True`` if the driver thread is not running."""
+        return not self.active
+
+    @property
+    def closed(self):
+        """``True`` after a call to `close()`, ``False`` otherwise."""
+        return self._closed
+
+    @property
+    def time(self):
+        """The virtual stream time in seconds.
+
+        This starts at 0 and advances by the duration of each processed
+        block, regardless of the wall-clock time.
+
+        """
+        return self._frames / self._samplerate
+
+    @property
+    def cpu_load(self):
+        """Time spent in the last callback, relative to its block duration."""
+        return self._cpu_load
+
+    def start(self):
+        """Start a thread which invokes the callback block by block.
+
+        If *realtime* was set, the thread waits for the wall-clock
+        duration of each block, otherwise it runs as fast as possible.
+        The output signal is discarded.
+
+        """
+        if self._closed:
+            raise RuntimeError('Stream is closed')
+        if self.active:
+            return
+        self._stopping.clear()
+        self._thread = _threading.Thread(target=self._drive)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, ignore_errors=True):
+        """Stop the driver thread (if running)."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    abort = stop
+
+    def close(self, ignore_errors=True):
+        """Stop the driver thread and close the stream."""
+        self.stop()
+        self._closed = True
+
+    def process(self, frames=None, out=None):
+        """Invoke the callback for the next *frames* frames.
+
+        Parameters
+        ----------
+        frames : int, optional
+            Number of frames to process, by default a single block.
+            The callback is invoked once per block, only the last block
+            may be shorter than *blocksize*.
+        out : writable buffer, optional
+            If given, the output signal is stored there (32-bit float,
+            interleaved channels).  It must be large enough to hold
+            *frames* frames.
+
+        """
+        if frames is None:
+            frames = self._blocksize
+        if out is not None:
+            out = _ffi.from_buffer(out)
+            if len(out) < frames * self._output_framesize:
+                raise ValueError('out is too small')
+        done = 0
+        while done < frames:
+            blocksize = min(frames - done, self._blocksize)
+            self._process_block(blocksize)
+            if out is not None:
+                _ffi.memmove(out + done * self._output_framesize,
+                             self._output_buffer,
+                             blocksize * self._output_framesize)
+            done += blocksize
+
+    def render(self, frames=None, file=None):
+        """Invoke the callback as fast as possible and collect the output.
+
+        This can be used to "bounce" a whole mix of scheduled actions.
+
+        Parameters
+        ----------
+        frames : int, optional
+            Number of frames to process.  By default, processing
+            continues block by block until all `actions` are finished.
+        file : file-like object, optional
+            If given, the output signal is passed block by block (as
+            32-bit float, interleaved channels) to its ``write()``
+            method instead of being returned.
+
+        Returns
+        -------
+        numpy.ndarray or int
+            The output signal with one column per output channel, or
+            the number of processed frames if *file* was given.
+
+        """
+        chunks = []
+        done = 0
+        while self.actions if frames is None else done < frames:
+            blocksize = self._blocksize
+            if frames is not None:
+                blocksize = min(frames - done, blocksize)
+            self._process_block(blocksize)
+            data = _ffi.buffer(self._output_buffer,
+                               blocksize * self._output_framesize)
+            if file is None:
+                chunks.append(data[:])
+            else:
+                file.write(data)
+            done += blocksize
+        if file is not None:
+            return done
+        import numpy as np
+        data = np.frombuffer(b''.join(chunks), dtype='float32')
+        return data.reshape(done, self._output_framesize // 4)
+
+    def _process_block(self, frames):
+        """Invoke the callback once, *frames* must not exceed blocksize."""
+        with self._lock:
+            if self._input_framesize:
+                self._read_input(frames)
+            time = self._frames / self._samplerate
+            self._timeinfo.inputBufferAdcTime = time
+            self._timeinfo.currentTime = time
+            self._timeinfo.outputBufferDacTime = time
+            start = _timer()
+            result = self._callback(
+                self._input_buffer, self._output_buffer, frames,
+                self._timeinfo, 0, self._userdata)
+            self._cpu_load = (_timer() - start) * self._samplerate / frames
+            self._frames += frames
+        if result != _lib.paContinue:
+            raise RuntimeError('Audio callback was aborted')
+
+    def _read_input(self, frames):
+        """Copy the next input block to the callback's input buffer."""
+        size = frames * self._input_framesize
+        if self._input_function is not None:
+            data = _ffi.from_buffer(self._input_function(frames))
+            offset = 0
+        elif self._input_data is not None:
+            data = self._input_data
+            offset = self._input_offset
+            self._input_offset += size
+        else:
+            return  # The input buffer is never written to, it stays silent
+        available = max(0, min(size, len(data) - offset))
+        if available:
+            _ffi.memmove(self._input_buffer, data + offset, available)
+        if available < size:
+            _ffi.buffer(self._input_buffer)[available:size] = (
+                b'\0' * (size - available))
+
+    def _drive(self):
+        """Run in the driver thread, see `start()`."""
+        blocktime = self._blocksize / self._samplerate
+        deadline = _timer()
+        while not self._stopping.is_set():
+            try:
+                self._process_block(self._blocksize)
+            except RuntimeError:
+                break
+            if self._realtime:
+                deadline += blocktime
+                self._stopping.wait(max(0, deadline - _timer()))
+
+
+class VirtualMixer(Mixer, _VirtualStream):
+    """Realtime mixer without an audio device."""
+
+    def __init__(self, **kwargs):
+        """Create a mixer object which is driven by a virtual clock.
+
+        Takes the same keyword arguments as `Mixer` (e.g. *qsize*,
+        *poolsize*, *buses*, *metering* or *maxvoices*), except the
+        device-specific ones from `sounddevice.OutputStream`.  Instead,
+        the following keyword arguments can be used:
+
+        Parameters
+        ----------
+        samplerate : float, optional
+            Sampling frequency of the virtual clock, default 48000.
+        blocksize : int, optional
+            Number of frames per callback invocation, default 1024.
+        channels : int, optional
+            Number of channels, default 2.  For `VirtualMixerAndRecorder`
+            this can be a pair of input and output channels.
+        input : buffer or callable, optional
+            Only for `VirtualRecorder` and `VirtualMixerAndRecorder`:
+            the input signal (32-bit float, interleaved channels), which
+            is followed by silence when it's exhausted.  Alternatively,
+            a function which gets the number of frames and returns a
+            buffer with (at most) that many frames.  By default, the
+            input is silent.
+        realtime : bool, optional
+            Whether the driver thread started by `start()` waits for
+            the wall-clock time of each block.  This does not affect
+            `process()` and `render()`, which are always running as
+            fast as possible.
+
+        """
+        Mixer.__init__(self, **kwargs)
+
+
+class VirtualRecorder(Recorder, _VirtualStream):
+    """Realtime recorder without an audio device."""
+
+    def __init__(self, **kwargs):
+        """Create a recorder object which is driven by a virtual clock.
+
+        Takes the same keyword arguments as `VirtualMixer`.
+
+        """
+        Recorder.__init__(self, **kwargs)
+
+
+class VirtualMixerAndRecorder(MixerAndRecorder, _VirtualStream):
+    """Realtime mixer and recorder without an audio device."""
+
+    def __init__(self, **kwargs):
+        """Create a mixer/recorder object driven by a virtual clock.
+
+        Takes the same keyword arguments as `VirtualMixer`.
+
+        """
+        MixerAndRecorder.__init__(self, **kwargs)
+
+
+class _FileJob(object):
+    """Base class for FileStreamer and FileRecorder."""
+
+    def __init__(self, file, ringbuffer, dtype):
+        self.file = file
+        self.ringbuffer = ringbuffer
+        self.action = None
+        self._dtype = dtype
+        self.error = None  # Exception raised in the background thread
+        self._lock = _threading.Lock()  # The file is used by two threads
+        # Wake up when about a quarter of the ring buffer is used up:
+        self._interval = ringbuffer.size / file.samplerate / 4
+
+    @property
+    def buffered_frames(self):
+        """Number of frames currently waiting in the ring buffer."""
+        return self.ringbuffer.read_available
+
+    @property
+    def xruns(self):
+        """Number of audio blocks with missing or dropped data."""
+        return self.action.xruns
+
+    @property
+    def dropped_frames(self):
+        """Number of frames which couldn't be played or recorded."""
+        return self.action.dropped_frames
+
+    @property
+    def finished(self):
+        """Whether the file has been closed."""
+        return self.file.closed
+
+    def _service(self):
+        """Transfer data, return False when finished."""
+        with self._lock:
+            if self.file.closed:
+                return False
+            return self._transfer()
+
+
+class FileStreamer(_FileJob):
+    """Feeds a ring buffer from a sound file, see `Mixer.play_file()`."""
+
+    def __init__(self, file, ringbuffer, dtype):
+        _FileJob.__init__(self, file, ringbuffer, dtype)
+        self._frames = file.frames - file.tell()
+        self._remaining = self._frames
+
+    @property
+    def min_buffered_frames(self):
+        """Smallest number of buffered frames seen by the callback.
+
+        This is ``None`` if playback hasn't started yet.
+
+        """
+        value = self.action.min_available
+        return None if value == _lib.ULONG_MAX else value
+
+    def close(self):
+        """Close the file.
+
+        This doesn't stop playback of the already buffered frames,
+        use `Mixer.cancel()` for that.  The action is finished when
+        the buffered frames have been played.
+
+        """
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        """Close the file and end the action after the written frames.
+
+        This must be called while holding self._lock.
+
+        """
+        self.file.close()
+        if not self._remaining:
+            return
+        # The file ended early (or couldn't be read), no more frames are
+        # coming.  The callback never reads more frames than were written
+        # to the ring buffer, so total_frames can't get below done_frames:
+        self._frames -= self._remaining
+        self._remaining = 0
+        action = self.action
+        if action is not None and action.total_frames > self._frames:
+            action.total_frames = self._frames
+
+    def _transfer(self):
+        if self.action is not None and self.action.status == _lib.FINISHED:
+            self.file.close()  # E.g. cancelled
+            return False
+        size, buf1, buf2 = self.ringbuffer.get_write_buffers(
+            min(self.ringbuffer.write_available, self._remaining))
+        written = 0
+        for buf in buf1, buf2:
+            if len(buf):
+                frames = self.file.buffer_read_into(buf, self._dtype)
+                # Each region is published on its own, because reading the
+                # second one may fail:
+                self.ringbuffer.advance_write_index(frames)
+                self._remaining -= frames
+                written += frames
+        if written < size or not self._remaining:
+            self._close()  # End of file
+            return False
+        return True
+
+
+class Levels(_collections.namedtuple(
+        'Levels', ['peak', 'rms', 'clipped', 'frames'])):
+    """Signal levels, see `Mixer.output_levels()`.
+
+    *peak* (maximum absolute value), *rms* and *clipped* (number of
+    samples with an absolute value of 1 or more) are lists with one
+    value per channel, *frames* is the number of frames they are
+    based on.
+
+    """
+
+    __slots__ = ()
+
+
+class LoadStats(_collections.namedtuple('LoadStats', [
+        'blocks', 'min_duration', 'mean_duration', 'max_duration',
+        'histogram', 'started', 'finished', 'stolen'])):
+    """Load statistics of the callback, see `Mixer.load_stats`.
+
+    The durations are given in seconds.  *histogram* contains the
+    numbers of blocks which used 0-10%, 10-20%, ..., 90-100% and more
+    than 100% of their deadline (i.e. the duration of the block).
+    *started* and *finished* are the numbers of actions which have
+    been started and finished (including cancelled and invalid ones).
+    *stolen* is the number of voices which were faded out or skipped
+    because of *maxvoices* or *maxload* (see `Mixer`).
+
+    """
+
+    __slots__ = ()
+
+
+class Telemetry(_collections.namedtuple('Telemetry', [
+        'frame', 'frames', 'duration', 'load', 'active', 'started',
+        'finished'])):
+    """Information about a single block, see `Mixer.telemetry()`.
+
+    *frame* is the position of the frame clock at the beginning of the
+    block, *frames* is its size.  *duration* is the execution time of
+    the callback in seconds, *load* is the same relative to the
+    duration of the block.  *active* is the number of actions which
+    played or recorded in the block, *started* and *finished* are the
+    numbers of actions which were started and finished in it.
+
+    """
+
+    __slots__ = ()
+
+
+class Result(_collections.namedtuple('Result', [
+        'type', 'group', 'reason', 'actual_time', 'frames', 'xruns'])):
+    """Result of a finished action, see `Mixer.results()`.
+
+    *type* is the type of the action (e.g. ``'play_buffer'``), *group*
+    is the value given when it was created.  *reason* is one of:
+
+    ``'completed'``
+        All frames were played/recorded (or the control action, e.g.
+        a cancellation, was executed).
+    ``'cancelled'``
+        Stopped before the end (or removed before it was started).
+    ``'too_late'``
+        Not started because its start time had already passed (and
+        *allow_belated* was ``False``).
+    ``'xrun'``
+        The ring buffer was empty/full, without *continue_on_xrun*.
+        A playlist without *continue_on_xrun* is ``'completed'``
+        when it runs out of buffers.
+    ``'invalid'``
+        Rejected by the callback, e.g. because of an invalid channel
+        mapping.
+    ``'stolen'``
+        Faded out early (or skipped) because of *maxvoices* or
+        *maxload* (see `Mixer`).
+
+    *actual_time* is the time when the action was started (0.0 if it
+    wasn't started), *frames* is the number of frames played/recorded.
+    *xruns* is the number of blocks where the ring buffer was
+    empty/full (or where a playlist was waiting for buffers) plus the
+    number of device under-/overflows while the action was active
+    (see its *stats*).
+
+    """
+
+    __slots__ = ()
+
+
+class Bus(object):
+    """Submix with a shared gain, see `Mixer.buses`."""
+
+    def __init__(self, name, array, index):
+        self.name = name
+        self._array = array  # Must be kept alive
+        self._ptr = array + index
+
+    @property
+    def gain(self):
+        """Gain applied to all actions which are mixed into this bus.
+
+        A new value is reached smoothly within the next audio block.
+
+        """
+        return self._ptr.gain
+
+    @gain.setter
+    def gain(self, value):
+        self._ptr.gain = value
+
+
+class Playlist(object):
+    """Queue of buffers played back to back, see `Mixer.play_playlist()`.
+
+    Each buffer is played by a separate action of type ``PLAY_BUFFER``,
+    which can be used with `Mixer.wait()` and friends (but not with
+    `Mixer.cancel()`).
+
+    """
+
+    def __init__(self, mixer, qsize, channels, dtype):
+        self.action = None
+        self._mixer = mixer
+        self._queue = RingBuffer(_ffi.sizeof('struct action*'), qsize)
+        self._channels = channels
+        self._dtype = dtype
+        self._ptr = _ffi.new('struct action**')
+
+    @property
+    def queued(self):
+        """Number of buffers waiting in the queue."""
+        return self._queue.read_available
+
+    @property
+    def xruns(self):
+        """Number of audio blocks where no buffer was available."""
+        return self.action.xruns
+
+    @property
+    def dropped_frames(self):
+        """Number of frames where no buffer was available."""
+        return self.action.dropped_frames
+
+    @property
+    def finished(self):
+        """Whether the playlist action has been finished."""
+        return self.action.status == _lib.FINISHED
+
+    def append(self, buffer, channels=None, dtype=None, offset=0,
+               loop_start=0, loop_end=None, loops=0, gain=1.0,
+               channel_gains=None, attack=0, release=0, curve='linear',
+               routes=None):
+        """Add a buffer to the end of the playlist.
+
+        By default, the *channels* and *dtype* given to
+        `Mixer.play_playlist()` are used.  For the other arguments,
+        see `Mixer.play_buffer()`.  Fades are applied in addition to
+        the crossfade (if any).
+
+        Returns
+        -------
+        action or None
+            ``None`` if the queue is full or if the playlist has
+            already been finished.
+
+        """
+        if channels is None:
+            channels = self._channels
+            if channels is None:
+                raise TypeError('channels must be specified')
+        if dtype is None:
+            dtype = self._dtype
+        mixer = self._mixer
+        action, keepalive = mixer._play_buffer_action(
+            buffer, channels, 0, True, 0, dtype, offset, loop_start,
+            loop_end, loops, None, gain, channel_gains, attack, release,
+            curve, routes, None)
+        with mixer._finished:
+            if self.action is not None and self.action not in mixer._actions:
+                return None
+            self._ptr[0] = action
+            if self._queue.write(self._ptr) != 1:
+                return None
+            mixer._actions[action] = action, keepalive
+        return action
+
+    def _take_queued(self):
+        """Remove all buffers from the queue, return their actions."""
+        actions = []
+        while self._queue.read(self._ptr):
+            actions.append(self._ptr[0])
+        return actions
+
+    def _discard(self):
+        """Forget queued buffers if the playlist couldn't be started."""
+        with self._mixer._finished:
+            for action in self._take_queued():
+                del self._mixer._actions[action]
+
+
+class MmapStreamer(object):
+    """Keeps a memory mapping in RAM, see `Mixer.play_mmap()`."""
+
+    def __init__(self, memory, action, offset, framesize, prefetch,
+                 samplerate):
+        self.mmap = memory
+        self.action = action
+        self._offset = offset
+        self._framesize = framesize
+        self._prefetch = prefetch
+        self._end = offset + action.total_frames * framesize
+        self._prefaulted = offset  # Bytes up to this position
+        self.error = None  # Exception raised in the background thread
+        # Wake up when about a quarter of the pre-faulted frames are played:
+        self._interval = prefetch / samplerate / 4
+        self._pagesize = _mmap.PAGESIZE
+        if hasattr(memory, 'madvise'):
+            memory.madvise(_mmap.MADV_SEQUENTIAL)
+
+    @property
+    def prefaulted_frames(self):
+        """Number of frames that have been pre-faulted so far."""
+        return (self._prefaulted - self._offset) // self._framesize
+
+    @property
+    def finished(self):
+        """Whether the whole file has been pre-faulted (or was stopped)."""
+        return self._prefaulted >= self._end
+
+    def close(self):
+        """Stop pre-faulting."""
+        self._prefaulted = self._end
+
+    def _service(self):
+        """Touch pages ahead of playback, return False when finished."""
+        if self.finished or self.action.status == _lib.FINISHED:
+            self.close()
+            return False
+        playhead = self._offset + self.action.position * self._framesize
+        end = min(playhead + self._prefetch * self._framesize, self._end)
+        start = self._prefaulted - self._prefaulted % self._pagesize
+        if end > start:
+            memory = self.mmap
+            if hasattr(memory, 'madvise'):
+                memory.madvise(_mmap.MADV_WILLNEED, start, end - start)
+            for position in range(start, end, self._pagesize):
+                memory[position]  # Page fault happens here (if at all)
+            self._prefaulted = end
+        return not self.finished
+
+
+class FileRecorder(_FileJob):
+    """Writes a ring buffer to a sound file, see `Recorder.record_to_file()`.
+
+    """
+
+    @property
+    def max_buffered_frames(self):
+        """Largest number of buffered frames seen by the callback.
+
+        If this reaches the size of the ring buffer, frames are dropped.
+
+        """
+        value = self.action.min_available
+        return 0 if value == _lib.ULONG_MAX else self.ringbuffer.size - value
+
+    def close(self):
+        """Write the remaining buffered frames and close the file.
+
+        This should only be called after the action has finished (e.g.
+        after `Recorder.cancel()`), otherwise the frames recorded
+        afterwards are lost.  It is called automatically when the action
+        has finished or when the stream is closed.
+
+        """
+        with self._lock:
+            if not self.file.closed:
+                self._write()
+                self.file.close()
+
+    def _write(self):
+        size, buf1, buf2 = self.ringbuffer.get_read_buffers(
+            self.ringbuffer.read_available)
+        for buf in buf1, buf2:
+            if len(buf):
+                self.file.buffer_write(buf, self._dtype)
+        self.ringbuffer.advance_read_index(size)
+
+    def _transfer(self):
+        # The status has to be checked before writing the remaining frames:
+        finished = self.action.status == _lib.FINISHED
+        self._write()
+        if finished:
+            self.file.close()
+            return False
+        return True
+
+
+class SampleBank(object):
+    """Audio data which is stored once and played with `Mixer.trigger()`.
+
+    All samples are copied into one contiguous block of memory, each of
+    them starting at a cache line boundary.  They can be converted to
+    a different *dtype* on the way, e.g. ``'int16'`` to save memory
+    (they are converted back to ``'float32'`` in the callback).
+
+    The bank can be used by several streams, see
+    `Mixer.register_samples()`.
+
+    Parameters
+    ----------
+    samples : dict or sequence of buffers
+        A mapping from sample IDs to buffers, or a sequence of buffers
+        (in which case the IDs are 0, 1, 2, ...).  The *dtype* of each
+        buffer is used if it has one (e.g. a NumPy array), otherwise
+        ``'float32'``.
+    channels : int, optional
+        Number of channels of buffers which don't have a 2-dimensional
+        *shape*.
+    dtype : str, optional
+        Sample format in the bank, see `Mixer.play_buffer()`.
+
+    """
+
+    def __init__(self, samples, channels=1, dtype='float32'):
+        if not hasattr(samples, 'items'):
+            samples = dict(enumerate(samples))
+        self.dtype = dtype
+        sampleformat, samplesize = _sampleformat(dtype)
+        sources = []
+        size = 0
+        for sample_id, buffer in samples.items():
+            shape = getattr(buffer, 'shape', ())
+            sample_channels = shape[1] if len(shape) == 2 else channels
+            source_format, source_size = _sampleformat(
+                getattr(buffer, 'dtype', 'float32'))
+            data = _ffi.from_buffer(buffer)
+            frames = len(data) // sample_channels // source_size
+            sources.append((sample_id, data, source_format, sample_channels,
+                            frames, size))
+            size += -(-frames * sample_channels * samplesize // 64) * 64
+        self._memory = _ffi.new('char[]', size + 63)
+        arena = self._memory + (
+            -int(_ffi.cast('uintptr_t', self._memory)) % 64)
+        self.nbytes = size
+        self._samples = {}
+        for sample_id, data, source_format, sample_channels, frames, offset \
+                in sources:
+            buffer = arena + offset
+            _convert(data, source_format, buffer, sampleformat,
+                     frames * sample_channels)
+            self._samples[sample_id] = _Sample(
+                buffer, frames, sample_channels,
+                tuple(range(1, sample_channels + 1)), sampleformat)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def __contains__(self, sample_id):
+        return sample_id in self._samples
+
+
 class RingBuffer(object):
     """Wrapper for PortAudio's ring buffer.
 
@@ -243,7 +2209,10 @@ class RingBuffer(object):
 
     """
 
-    def __init__(self, elementsize, size):
+    # The header is followed by the data, starting at a cache line boundary:
+    _HEADER_SIZE = -(-_ffi.sizeof('PaUtilRingBuffer') // 64) * 64
+
+    def __init__(self, elementsize, size, buffer=None):
         """Create an instance of PortAudio's ring buffer.
 
         Parameters
@@ -252,10 +2221,30 @@ class RingBuffer(object):
             The size of a single data element in bytes.
         size : int
             The number of elements in the buffer (must be a power of 2).
+        buffer : writable buffer, optional
+            If given, the ring buffer (including its read and write
+            positions) is stored in this memory, which can be shared
+            with other processes, e.g. the ``buf`` attribute of a
+            `multiprocessing.shared_memory.SharedMemory` object, or an
+            `mmap.mmap` object.  It must have at least
+            `required_size()` bytes.  Other processes can use the ring
+            buffer with `attach()`.  The memory is in use as long as
+            the ring buffer object exists, it has to be deleted before
+            `SharedMemory.close()` can be called.
 
         """
-        self._ptr = _ffi.new('PaUtilRingBuffer*')
-        self._data = _ffi.new('unsigned char[]', size * elementsize)
+        if buffer is None:
+            self._memory = None
+            self._ptr = _ffi.new('PaUtilRingBuffer*')
+            self._data = _ffi.new('unsigned char[]', size * elementsize)
+        else:
+            self._memory = _ffi.from_buffer(buffer, require_writable=True)
+            if len(self._memory) < self.required_size(elementsize, size):
+                raise ValueError('buffer is too small')
+            self._ptr = _ffi.cast('PaUtilRingBuffer*', self._memory)
+            self._data = _ffi.cast('unsigned char*',
+                                   self._memory + self._HEADER_SIZE)
+        self._offset = 0  # See attach()
         res = _lib.PaUtil_InitializeRingBuffer(
             self._ptr, elementsize, size, self._data)
         if res != 0:
@@ -263,6 +2252,56 @@ class RingBuffer(object):
             raise ValueError('size must be a power of 2')
         assert self._ptr.bufferSize == size
         assert self._ptr.elementSizeBytes == elementsize
+        self._init_scratch()
+
+    @classmethod
+    def required_size(cls, elementsize, size):
+        """Number of bytes needed for the *buffer* argument of __init__().
+        """
+        return cls._HEADER_SIZE + elementsize * size
+
+    @classmethod
+    def attach(cls, buffer):
+        """Use a ring buffer which was created in another process.
+
+        *buffer* must contain the same memory which was used to create
+        the ring buffer, see __init__().  The memory may be mapped at a
+        different address.
+
+        A ring buffer which was attached at a different address can
+        only be used from Python, i.e. it cannot be passed to
+        `Mixer.play_ringbuffer()` or `Recorder.record_ringbuffer()`.
+        The audio stream should therefore run in the process which
+        created the ring buffer.
+
+        """
+        self = cls.__new__(cls)
+        self._memory = _ffi.from_buffer(buffer, require_writable=True)
+        if len(self._memory) < cls._HEADER_SIZE:
+            raise ValueError('buffer is too small')
+        self._ptr = _ffi.cast('PaUtilRingBuffer*', self._memory)
+        if (self._ptr.bufferSize <= 0 or self._ptr.elementSizeBytes <= 0 or
+                self._ptr.bufferSize & (self._ptr.bufferSize - 1) or
+                len(self._memory) < cls.required_size(
+                    self._ptr.elementSizeBytes, self._ptr.bufferSize)):
+            raise ValueError('buffer does not contain a valid ring buffer')
+        self._data = _ffi.cast('unsigned char*',
+                               self._memory + cls._HEADER_SIZE)
+        # Pointers calculated by PortAudio are valid in the creating process,
+        # they have to be shifted by this amount:
+        self._offset = (int(_ffi.cast('uintptr_t', self._data)) -
+                        int(_ffi.cast('uintptr_t', self._ptr.buffer)))
+        self._init_scratch()
+        return self
+
+    def _init_scratch(self):
+        # Scratch space for get_*_buffers() and get_*_arrays(), separately
+        # for the writing and the reading thread:
+        self._write_ptrs = _ffi.new('void*[2]')
+        self._write_sizes = _ffi.new('ring_buffer_size_t[2]')
+        self._read_ptrs = _ffi.new('void*[2]')
+        self._read_sizes = _ffi.new('ring_buffer_size_t[2]')
+        self._arrays = {}  # NumPy arrays for the whole buffer, by dtype
 
     def flush(self):
         """Reset buffer to empty.
@@ -306,6 +2345,9 @@ class RingBuffer(object):
             size, rest = divmod(_ffi.sizeof(data), self._ptr.elementSizeBytes)
             if rest:
                 raise ValueError('data size must be multiple of elementsize')
+        if self._offset:
+            return self._copy(self.get_write_buffers, self.advance_write_index,
+                              data, size, writing=True)
         return _lib.PaUtil_WriteRingBuffer(self._ptr, data, size)
 
     def read(self, data, size=-1):
@@ -332,6 +2374,9 @@ class RingBuffer(object):
             size, rest = divmod(_ffi.sizeof(data), self._ptr.elementSizeBytes)
             if rest:
                 raise ValueError('data size must be multiple of elementsize')
+        if self._offset:
+            return self._copy(self.get_read_buffers, self.advance_read_index,
+                              data, size, writing=False)
         return _lib.PaUtil_ReadRingBuffer(self._ptr, data, size)
 
     def get_write_buffers(self, size):
@@ -353,14 +2398,8 @@ class RingBuffer(object):
             The second buffer.
 
         """
-        ptr1 = _ffi.new('void**')
-        ptr2 = _ffi.new('void**')
-        size1 = _ffi.new('ring_buffer_size_t*')
-        size2 = _ffi.new('ring_buffer_size_t*')
-        return (_lib.PaUtil_GetRingBufferWriteRegions(
-                    self._ptr, size, ptr1, size1, ptr2, size2),
-                _ffi.buffer(ptr1[0], size1[0] * self.elementsize),
-                _ffi.buffer(ptr2[0], size2[0] * self.elementsize))
+        return self._get_buffers(_lib.PaUtil_GetRingBufferWriteRegions,
+                                 size, self._write_ptrs, self._write_sizes)
 
     def advance_write_index(self, size):
         """Advance the write index to the next location to be written.
@@ -396,14 +2435,8 @@ class RingBuffer(object):
             The second buffer.
 
         """
-        ptr1 = _ffi.new('void**')
-        ptr2 = _ffi.new('void**')
-        size1 = _ffi.new('ring_buffer_size_t*')
-        size2 = _ffi.new('ring_buffer_size_t*')
-        return (_lib.PaUtil_GetRingBufferReadRegions(
-                    self._ptr, size, ptr1, size1, ptr2, size2),
-                _ffi.buffer(ptr1[0], size1[0] * self.elementsize),
-                _ffi.buffer(ptr2[0], size2[0] * self.elementsize))
+        return self._get_buffers(_lib.PaUtil_GetRingBufferReadRegions,
+                                 size, self._read_ptrs, self._read_sizes)
 
     def advance_read_index(self, size):
         """Advance the read index to the next location to be read.
@@ -421,7 +2454,444 @@ class RingBuffer(object):
         """
         return _lib.PaUtil_AdvanceRingBufferReadIndex(self._ptr, size)
 
+    def get_write_arrays(self, size, dtype='float32'):
+        """Get NumPy arrays to which we can write data.
+
+        Like `get_write_buffers()`, but the two regions are returned as
+        two-dimensional arrays (elements x channels) which use the ring
+        buffer's memory.  The number of channels is obtained from
+        *elementsize* and *dtype*.  The arrays may be empty.
+
+        """
+        return self._get_arrays(_lib.PaUtil_GetRingBufferWriteRegions,
+                                size, dtype, self._write_ptrs,
+                                self._write_sizes)
+
+    def get_read_arrays(self, size, dtype='float32'):
+        """Get NumPy arrays from which we can read data.
+
+        Like `get_read_buffers()`, but see `get_write_arrays()`.
+
+        """
+        return self._get_arrays(_lib.PaUtil_GetRingBufferReadRegions,
+                                size, dtype, self._read_ptrs,
+                                self._read_sizes)
+
+    def write_array(self, data, dtype='float32'):
+        """Write (part of) an array to the ring buffer.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            Two-dimensional (elements x channels), or one-dimensional
+            for a single channel.  The values are converted to *dtype*.
+        dtype : str, optional
+            Sample format used in the ring buffer.
+
+        Returns
+        -------
+        int
+            The number of elements written, which may be less than
+            ``len(data)`` if the ring buffer doesn't have enough room.
+
+        """
+        size, array1, array2 = self.get_write_arrays(len(data), dtype)
+        for array, part in ((array1, data[:len(array1)]),
+                            (array2, data[len(array1):size])):
+            array.reshape(part.shape)[:] = part
+        self.advance_write_index(size)
+        return size
+
+    def read_into(self, out, dtype='float32'):
+        """Read from the ring buffer into an array.
+
+        Parameters
+        ----------
+        out : numpy.ndarray
+            Two-dimensional (elements x channels), or one-dimensional
+            for a single channel.  The values are converted from *dtype*
+            to the data type of *out*.
+        dtype : str, optional
+            Sample format used in the ring buffer.
+
+        Returns
+        -------
+        int
+            The number of elements read, which may be less than
+            ``len(out)`` if not enough data is available.
+
+        """
+        size, array1, array2 = self.get_read_arrays(len(out), dtype)
+        for array, part in ((array1, out[:len(array1)]),
+                            (array2, out[len(array1):size])):
+            part[:] = array.reshape(part.shape)
+        self.advance_read_index(size)
+        return size
+
     @property
     def elementsize(self):
         """Element size in bytes."""
         return self._ptr.elementSizeBytes
+
+    @property
+    def size(self):
+        """Number of elements in the buffer."""
+        return self._ptr.bufferSize
+
+    def _get_buffers(self, function, size, ptrs, sizes):
+        total = function(self._ptr, size, ptrs, sizes, ptrs + 1, sizes + 1)
+        if self._offset:
+            ptrs = [self._translate(ptrs[0]), self._translate(ptrs[1])]
+        return (total,
+                _ffi.buffer(ptrs[0], sizes[0] * self.elementsize),
+                _ffi.buffer(ptrs[1], sizes[1] * self.elementsize))
+
+    def _translate(self, ptr):
+        """Turn a pointer of the creating process into a local one."""
+        if not ptr:
+            return ptr
+        return _ffi.cast('void*',
+                         int(_ffi.cast('uintptr_t', ptr)) + self._offset)
+
+    def _copy(self, get_buffers, advance, data, size, writing):
+        """Implementation of write()/read() for attached ring buffers."""
+        data = _ffi.cast('unsigned char*', data)
+        total, buf1, buf2 = get_buffers(size)
+        position = 0
+        for buf in buf1, buf2:
+            ptr = _ffi.from_buffer(buf)
+            if writing:
+                _ffi.memmove(ptr, data + position, len(buf))
+            else:
+                _ffi.memmove(data + position, ptr, len(buf))
+            position += len(buf)
+        advance(total)
+        return total
+
+    def _get_arrays(self, function, size, dtype, ptrs, sizes):
+        try:
+            array = self._arrays[dtype]
+        except KeyError:
+            import numpy as np
+            if self.elementsize % np.dtype(dtype).itemsize:
+                raise ValueError('elementsize must be a multiple of itemsize')
+            array = np.frombuffer(
+                _ffi.buffer(self._data, self.size * self.elementsize),
+                dtype=dtype)
+            array = self._arrays[dtype] = array.reshape(self.size, -1)
+        total = function(self._ptr, size, ptrs, sizes, ptrs + 1, sizes + 1)
+        start = (_ffi.cast('unsigned char*', ptrs[0]) -
+                 _ffi.cast('unsigned char*', self._ptr.buffer)) \
+            // self.elementsize if sizes[0] else 0
+        return (total,
+                array[start:start + sizes[0]],
+                array[:sizes[1]])
+
+
+_Sample = _collections.namedtuple(
+    '_Sample', ['buffer', 'frames', 'channels', 'mapping', 'sampleformat'])
+
+
+class _ActionPool(object):
+    """Preallocated memory for actions, see `_Base.pool_usage`."""
+
+    def __init__(self, size, channels):
+        slotsize = (_ffi.sizeof('struct action') +
+                    channels * _ffi.sizeof('frame_t'))
+        self._slotsize = -(-slotsize // 64) * 64  # Multiple of cache line
+        self._channels = channels
+        self._arena = _ffi.new('char[]', size * self._slotsize)
+        self._zeros = _ffi.new('char[]', self._slotsize)
+        self._free = list(range(size - 1, -1, -1))
+        self.size = size
+        self.highwater = 0
+
+    @property
+    def usage(self):
+        return self.size - len(self._free)
+
+    def acquire(self, channels):
+        """Return a zeroed action, or None if none is available.
+
+        The action is automatically returned to the pool when the
+        returned object is garbage-collected.
+
+        """
+        if channels > self._channels or not self._free:
+            return None
+        ptr = self._arena + self._free.pop() * self._slotsize
+        _ffi.memmove(ptr, self._zeros, self._slotsize)
+        self.highwater = max(self.highwater, self.usage)
+        return _ffi.gc(_ffi.cast('struct action*', ptr), self._release)
+
+    def _release(self, action):
+        offset = _ffi.cast('char*', action) - self._arena
+        self._free.append(offset // self._slotsize)
+
+
+class _FileThread(object):
+    """Background thread for reading and writing files.
+
+    The thread is started when the first job is added and it stops when
+    there are no more jobs.  A job has a method _service(), which
+    returns False when the job is done, and an attribute _interval with
+    the maximum time (in seconds) between two calls to _service().
+    If _service() raises an exception, it is stored as the job's
+    "error" attribute and the job is closed and removed, the other jobs
+    are not affected.
+
+    """
+
+    def __init__(self):
+        self._jobs = []
+        self._lock = _threading.Lock()
+        self._wakeup = _threading.Event()
+        self._thread = None
+
+    def add(self, job):
+        with self._lock:
+            self._jobs.append(job)
+            if self._thread is None:
+                self._thread = _threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+
+    def close(self):
+        """Close all jobs and wait for the thread to finish."""
+        with self._lock:
+            jobs, self._jobs = self._jobs, []
+            thread = self._thread
+        self._wakeup.set()
+        if thread is not None:
+            thread.join()
+        for job in jobs:
+            job.close()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                jobs = list(self._jobs)
+                if not jobs:
+                    self._thread = None
+                    return
+            for job in jobs:
+                try:
+                    active = job._service()
+                except Exception as e:
+                    job.error = e
+                    try:
+                        job.close()
+                    except Exception:
+                        pass  # The first error is more interesting
+                    active = False
+                if not active:
+                    with self._lock:
+                        if job in self._jobs:
+                            self._jobs.remove(job)
+            self._wakeup.wait(min(job._interval for job in jobs))
+            self._wakeup.clear()
+
+
+class _FinishedActions(object):
+    """Asynchronous iterator, see `_Base.finished_actions()`.
+
+    All methods must be called from the thread of the event loop.
+
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._queue = _collections.deque()
+        self._waiter = None
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = self._loop.create_future()
+        if self._queue:
+            future.set_result(self._queue.popleft())
+        elif self._closed:
+            future.set_exception(StopAsyncIteration())
+        else:
+            self._waiter = future
+        return future
+
+    def _put(self, action):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(action)
+        else:
+            self._queue.append(action)
+        self._waiter = None
+
+    def _close(self):
+        self._closed = True
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_exception(StopAsyncIteration())
+        self._waiter = None
+
+
+def _parse_wav(data):
+    """Return offset, size, channels and dtype of WAV data (or None)."""
+    if data[:4] not in (b'RIFF', b'RF64') or data[8:12] != b'WAVE':
+        return None
+    position = 12
+    fmt = None
+    size64 = None
+    while position + 8 <= len(data):
+        chunk_id = data[position:position + 4]
+        chunk_size, = _struct.unpack('<I', data[position + 4:position + 8])
+        position += 8
+        if chunk_id == b'ds64':
+            size64, = _struct.unpack('<Q', data[position + 8:position + 16])
+        elif chunk_id == b'fmt ':
+            fmt = _struct.unpack('<HHIIHH', data[position:position + 16])
+            if fmt[0] == 0xFFFE:  # WAVE_FORMAT_EXTENSIBLE
+                subformat, = _struct.unpack(
+                    '<H', data[position + 24:position + 26])
+                fmt = (subformat,) + fmt[1:]
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise ValueError('Invalid WAV file (no fmt chunk)')
+            if chunk_size == 0xFFFFFFFF and size64 is not None:
+                chunk_size = size64
+            formattag, channels, _, _, _, bits = fmt
+            try:
+                dtype = {
+                    (1, 16): 'int16',
+                    (1, 24): 'int24',
+                    (1, 32): 'int32',
+                    (3, 32): 'float32',
+                }[formattag, bits]
+            except KeyError:
+                raise ValueError('Unsupported WAV format')
+            size = min(chunk_size, len(data) - position)
+            return position, size, channels, dtype
+        position += chunk_size + chunk_size % 2
+    raise ValueError('Invalid WAV file (no data chunk)')
+
+
+# Used by the helper thread if the callback can't notify it (in seconds):
+_POLLING_INTERVAL = 0.01
+
+_ACTION_TYPES = {
+    _lib.PLAY_BUFFER: 'play_buffer',
+    _lib.PLAY_RINGBUFFER: 'play_ringbuffer',
+    _lib.RECORD_BUFFER: 'record_buffer',
+    _lib.RECORD_RINGBUFFER: 'record_ringbuffer',
+    _lib.PLAY_PLAYLIST: 'play_playlist',
+    _lib.CANCEL: 'cancel',
+    _lib.CANCEL_ALL: 'cancel_all',
+    _lib.SET_GAIN: 'set_gain',
+}
+
+_END_REASONS = {
+    _lib.RUNNING: 'running',
+    _lib.COMPLETED: 'completed',
+    _lib.CANCELLED: 'cancelled',
+    _lib.TOO_LATE: 'too_late',
+    _lib.XRUN: 'xrun',
+    _lib.INVALID: 'invalid',
+    _lib.STOLEN: 'stolen',
+}
+
+
+def _curve(name):
+    """Get the enum value for a fade or ramp shape."""
+    try:
+        return {
+            'linear': _lib.LINEAR,
+            'exponential': _lib.EXPONENTIAL,
+        }[name]
+    except KeyError:
+        raise ValueError('Unknown curve: {0!r}'.format(name))
+
+
+def _sampleformat(dtype):
+    """Return enum value and sample size (in bytes) for *dtype*."""
+    name = str(getattr(dtype, 'name', dtype))
+    try:
+        return {
+            'float32': (_lib.FLOAT32_FORMAT, 4),
+            'int16': (_lib.INT16_FORMAT, 2),
+            'int24': (_lib.INT24_FORMAT, 3),
+            'int32': (_lib.INT32_FORMAT, 4),
+        }[name]
+    except KeyError:
+        raise ValueError('Unsupported dtype: {0!r}'.format(dtype))
+
+
+def _convert(data, source_format, out, sampleformat, samples):
+    """Copy *samples* samples from *data* to *out*, converting formats."""
+    if source_format == sampleformat:
+        _ffi.memmove(out, data, samples * _lib.sample_size(sampleformat))
+        return
+    if source_format == _lib.FLOAT32_FORMAT:
+        floats = _ffi.cast('float*', data)
+    else:
+        floats = _ffi.new('float[]', samples)
+        _lib.int_to_float(data, floats, samples, source_format)
+    if sampleformat == _lib.FLOAT32_FORMAT:
+        _ffi.memmove(out, floats, samples * 4)
+    else:
+        _lib.float_to_int(floats, out, samples, sampleformat)
+
+
+def _file_subtype(dtype):
+    """Return the soundfile subtype for a dtype used with sound files."""
+    name = str(getattr(dtype, 'name', dtype))
+    try:
+        return {
+            'float32': 'FLOAT',
+            'int16': 'PCM_16',
+            'int32': 'PCM_32',
+        }[name]
+    except KeyError:
+        raise ValueError(
+            'Unsupported dtype for sound files: {0!r}'.format(dtype))
+
+
+def _set_nonblocking(fd):
+    """Make a file descriptor non-blocking, return False if impossible."""
+    try:
+        _os.set_blocking(fd, False)
+    except (AttributeError, OSError):
+        # Python 2 or Windows (before Python 3.12)
+        try:
+            import fcntl
+        except ImportError:
+            return False
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | _os.O_NONBLOCK)
+    return True
+
+
+def _broadcast(value, length):
+    """Return *value* if it is a sequence, otherwise repeat it."""
+    try:
+        len(value)
+    except TypeError:
+        return [value] * length
+    return value
+
+
+def _set_start(action, start, start_frame):
+    """Set the requested time, or the start frame (if not None)."""
+    action.requested_time = start
+    if start_frame is not None:
+        action.start_frame = start_frame
+        action.has_start_frame = True
+
+
+def _set_result(future, result):
+    if not future.done():  # It might have been cancelled
+        future.set_result(result)
+
+
+def _call_soon_threadsafe(loop, callback, *args):
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        pass  # The event loop is closed
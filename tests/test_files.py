@@ -0,0 +1,97 @@
+"""Tests for streaming from/to files using the virtual streams."""
+import time
+
+import numpy as np
+import pytest
+
+import rtmixer
+
+sf = pytest.importorskip('soundfile')
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.001)
+
+
+def test_play_file(tmp_path):
+    data = np.random.RandomState(0).uniform(-1, 1, (5000, 2))
+    filename = str(tmp_path / 'test.wav')
+    sf.write(filename, data.astype('float32'), 48000, subtype='FLOAT')
+    m = rtmixer.VirtualMixer(channels=2, blocksize=64)
+    streamer = m.play_file(filename, buffersize=1024)
+    chunks = []
+    while not streamer.action.status == rtmixer._lib.FINISHED:
+        # Give the background thread time to refill the ring buffer:
+        wait_for(lambda: streamer.finished or streamer.buffered_frames >= 64)
+        chunks.append(m.render(64))
+    out = np.concatenate(chunks)
+    assert np.allclose(out[:5000], data, atol=1e-7)
+    assert streamer.xruns == 0
+
+
+def test_record_to_file(tmp_path):
+    signal = np.arange(1000, dtype='float32') / 1000
+    filename = str(tmp_path / 'rec.wav')
+    r = rtmixer.VirtualRecorder(channels=1, blocksize=64, input=signal)
+    recorder = r.record_to_file(filename, 1, frames=1000)
+    r.process(1024)
+    wait_for(lambda: recorder.finished)
+    data, _ = sf.read(filename, dtype='float32')
+    assert np.array_equal(data, signal)
+
+
+def test_record_to_file_rejects_int24(tmp_path):
+    r = rtmixer.VirtualRecorder(channels=1)
+    with pytest.raises(ValueError):
+        r.record_to_file(str(tmp_path / 'rec.wav'), 1, dtype='int24')
+
+
+def test_play_mmap(tmp_path):
+    data = np.arange(200, dtype='int16').reshape(100, 2) * 100
+    filename = str(tmp_path / 'test.raw')
+    with open(filename, 'wb') as f:
+        f.write(b'HEADER')
+        f.write(data.tobytes())
+    m = rtmixer.VirtualMixer(channels=2, blocksize=64)
+    m.play_mmap(filename, channels=2, dtype='int16', byteoffset=6)
+    out = m.render(100)
+    assert np.allclose(out, data / 2 ** 15)
+
+
+class FailingSoundFile(sf.SoundFile):
+    """Returns no more frames (or raises) after reading *limit* frames."""
+
+    def __init__(self, *args, **kwargs):
+        self.limit = kwargs.pop('limit')
+        self.truncate = kwargs.pop('truncate')
+        sf.SoundFile.__init__(self, *args, **kwargs)
+
+    def buffer_read_into(self, buffer, dtype):
+        frames = self.limit - self.tell()
+        if frames <= 0 and not self.truncate:
+            raise IOError('read error')
+        frames = max(0, frames)
+        buffer = memoryview(buffer)[:frames * self.channels * 4]  # float32
+        return sf.SoundFile.buffer_read_into(self, buffer, dtype)
+
+
+@pytest.mark.parametrize('truncate', [True, False])
+def test_play_file_ends_early(tmp_path, truncate):
+    filename = str(tmp_path / 'test.wav')
+    sf.write(filename, np.zeros((48000, 1), dtype='float32'), 48000)
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64)
+    # 1000 frames don't fill whole regions of the ring buffer:
+    f = FailingSoundFile(filename, limit=1000, truncate=truncate)
+    streamer = m.play_file(f, buffersize=512)
+    m.start()
+    assert m.wait(streamer.action, timeout=5)
+    m.stop()
+    assert streamer.finished
+    assert (streamer.error is None) == truncate
+    assert streamer.action.done_frames == 1000
+    [result] = [r for r in m.results() if r.type == 'play_ringbuffer']
+    assert result.reason == 'completed'
+    assert result.frames == 1000
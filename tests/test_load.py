@@ -0,0 +1,80 @@
+"""Load statistics, telemetry and voice stealing tests."""
+import numpy as np
+
+import rtmixer
+
+
+def test_stats_and_telemetry():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64, telemetrysize=8)
+    m.play_buffer(np.ones(100, 'float32'), 1)
+    m.process(3 * 64)
+    records = m.telemetry()
+    assert [r.frame for r in records] == [0, 64, 128]
+    assert [r.active for r in records] == [1, 1, 0]
+    assert [r.started for r in records] == [1, 0, 0]
+    assert [r.finished for r in records] == [0, 1, 0]
+    assert m.telemetry() == []
+    assert m.stats.blocks == 3
+    load = m.load_stats
+    assert load.blocks == 3
+    assert load.started == load.finished == 1
+    assert sum(load.histogram) == 3
+    assert 0 < load.min_duration <= load.mean_duration <= load.max_duration
+
+
+def test_telemetry_ring_keeps_newest():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=16, telemetrysize=4)
+    m.process(16 * 10)
+    frames = [r.frame for r in m.telemetry()]
+    assert frames == list(range(16 * 7, 16 * 10, 16))
+
+
+def test_voice_limit_steals_lowest_priority():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64, samplerate=48000,
+                             maxvoices=2, stealfade=100 / 48000)
+    one = np.ones(2000, 'float32')
+    m.play_buffer(one, 1, priority=1)
+    low = m.play_buffer(one, 1, gain=0.5)
+    m.process(128)
+    m.play_buffer(one, 1, gain=0.25, priority=2)
+    out = m.render(400)[:, 0]
+    fade = 0.5 * (100 - np.arange(100) - 0.5) / 100
+    assert np.allclose(out[:100], 1.25 + fade)
+    assert np.allclose(out[100:], 1.25)
+    assert low.end_reason == rtmixer._lib.STOLEN
+    assert m.load_stats.stolen == 1
+
+
+def test_voice_limit_skips_quietest_unstarted():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64, maxvoices=1,
+                             stealfade=0)
+    one = np.ones(1000, 'float32')
+    actions = m.play_buffers([one, one, one], 1, gain=[0.3, 0.9, 0.5])
+    m.process(64)
+    assert [a.done_frames for a in actions] == [0, 64, 0]
+    assert m.load_stats.stolen == 2
+
+
+def test_voice_limit_steals_at_most_16_per_block():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64, maxvoices=4,
+                             stealfade=0)
+    actions = m.play_buffers([np.ones(1000, 'float32')] * 30, 1,
+                             priority=list(range(30)))
+    m.process(64)
+    assert m.load_stats.stolen == 16
+    m.process(64)
+    assert m.load_stats.stolen == 26
+    playing = [a for a in actions if a.end_reason == rtmixer._lib.RUNNING]
+    assert playing == actions[26:]
+
+
+def test_voice_limit_skips_wide_voices():
+    # Voices with more channels than the scratch buffer can't be faded out
+    m = rtmixer.VirtualMixer(channels=1025, blocksize=64, maxvoices=1)
+    wide = m.play_buffer(np.ones((1000, 1025), 'float32'), 1025)
+    m.process(64)
+    narrow = m.play_buffer(np.ones(100, 'float32'), [1], priority=1)
+    out = m.render(128)
+    assert np.all(out == 1)
+    assert narrow.end_reason == rtmixer._lib.STOLEN
+    assert wide.end_reason == rtmixer._lib.RUNNING
@@ -0,0 +1,273 @@
+"""Playback tests using VirtualMixer (no audio device needed)."""
+import gc
+
+import numpy as np
+import pytest
+
+import rtmixer
+
+
+def ramp(frames, channels=1):
+    """Distinct, non-zero values for every sample."""
+    data = np.arange(1, frames * channels + 1, dtype='float32') / 1024
+    return data.reshape(frames, channels)
+
+
+def test_play_buffer_identity():
+    m = rtmixer.VirtualMixer(channels=2, blocksize=64)
+    data = ramp(300, 2)
+    m.play_buffer(data, 2)
+    out = m.render(400)
+    assert np.array_equal(out[:300], data)
+    assert not out[300:].any()
+
+
+def test_channel_mapping():
+    m = rtmixer.VirtualMixer(channels=3, blocksize=64)
+    data = ramp(100, 2)
+    m.play_buffer(data, [3, 1])
+    out = m.render(100)
+    assert np.array_equal(out[:, 2], data[:, 0])
+    assert np.array_equal(out[:, 0], data[:, 1])
+    assert not out[:, 1].any()
+
+
+def test_mixing():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64)
+    a = np.full(100, 0.25, 'float32')
+    b = np.full(50, 0.5, 'float32')
+    m.play_buffer(a, 1)
+    m.play_buffer(b, 1)
+    out = m.render(100)[:, 0]
+    assert np.allclose(out[:50], 0.75)
+    assert np.allclose(out[50:], 0.25)
+
+
+def test_action_pool():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64, poolsize=2)
+    actions = [m.play_buffer(np.full(100, 0.25, 'float32'), 1)
+               for _ in range(3)]
+    assert m.pool_usage == 2
+    out = m.render(100)[:, 0]
+    assert np.allclose(out, 0.75)
+    assert m.wait(actions, timeout=5)
+    del actions
+    gc.collect()
+    assert m.pool_usage == 0
+    assert m.pool_highwater == 2
+
+
+def test_play_buffers():
+    m = rtmixer.VirtualMixer(channels=2, blocksize=64, samplerate=1000,
+                             qsize=1)
+    data = ramp(100, 2)
+    # A NumPy integer is a number of channels, not a sequence:
+    actions = m.play_buffers([data, data], np.int64(2), start=[0, 0.01])
+    assert len(actions) == 2
+    assert m.play_buffers([data], 2) is None  # The queue is full
+    out = m.render(110)
+    assert np.array_equal(out[:10], data[:10])
+    assert np.array_equal(out[10:100], data[10:] + data[:90])
+    assert np.array_equal(out[100:], data[90:])
+
+
+@pytest.mark.parametrize('mapping', [
+    [1], [3], [2, 3], [1, 2, 3, 4], [4, 3, 2, 1], [1, 3],
+])
+def test_kernels(mapping):
+    m = rtmixer.VirtualMixer(channels=4, blocksize=64)
+    data = ramp(100, len(mapping))
+    m.play_buffer(data, mapping)
+    m.play_buffer(data, mapping)  # Mixed with the first one
+    out = m.render(100)
+    expected = np.zeros((100, 4), 'float32')
+    expected[:, np.array(mapping) - 1] = 2 * data
+    assert np.array_equal(out, expected)
+
+
+@pytest.mark.parametrize('dtype, scale', [
+    ('int16', 2 ** 15),
+    ('int32', 2 ** 31),
+])
+def test_integer_formats(dtype, scale):
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64)
+    data = (np.arange(-100, 100) * (scale // 256)).astype(dtype)
+    m.play_buffer(data, 1)
+    out = m.render(200)[:, 0]
+    assert np.allclose(out, data / scale)
+
+
+def test_offset_and_loop():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=7)
+    data = ramp(10)[:, 0]
+    action = m.play_buffer(data, 1, offset=2, loop_start=4, loop_end=6,
+                           loops=2)
+    assert action.total_frames == 8 + 2 * 2
+    out = m.render(20)[:, 0]
+    expected = np.concatenate([data[2:6], data[4:6], data[4:6], data[6:]])
+    assert np.array_equal(out[:12], expected)
+    assert not out[12:].any()
+
+
+def test_playlist_is_gapless():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64)
+    buffers = [ramp(n)[:, 0] + i for i, n in enumerate([50, 70, 30])]
+    playlist = m.play_playlist(buffers, channels=1)
+    out = m.render(200)[:, 0]
+    assert np.array_equal(out[:150], np.concatenate(buffers))
+    assert not out[150:].any()
+    assert playlist.finished
+
+
+def test_playlist_crossfade():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=32)
+    playlist = m.play_playlist(channels=1, crossfade=50)
+    playlist.append(np.full(200, 0.5, 'float32'))
+    playlist.append(np.full(200, 2, 'float32'))
+    out = m.render(400)[:, 0]
+    fade = (np.arange(50) + 0.5) / 50
+    assert np.allclose(out[150:200], 0.5 * (1 - fade) + 2 * fade)
+    assert np.allclose(out[200:350], 2)
+
+
+def test_gain_and_channel_gains():
+    m = rtmixer.VirtualMixer(channels=2, blocksize=64)
+    m.play_buffer(np.ones((100, 2), 'float32'), 2, gain=0.5,
+                  channel_gains=[1, -0.5])
+    out = m.render(100)
+    assert np.allclose(out, [[0.5, -0.25]])
+
+
+def test_linear_fades():
+    attack, release, frames = 100, 200, 1000
+    m = rtmixer.VirtualMixer(channels=1, blocksize=37, samplerate=48000)
+    m.play_buffer(np.ones(frames, 'float32'), 1, attack=attack / 48000,
+                  release=release / 48000)
+    out = m.render(frames)[:, 0]
+    envelope = np.ones(frames)
+    envelope[:attack] = (np.arange(attack) + 0.5) / attack
+    remaining = frames - np.arange(frames)
+    tail = remaining <= release
+    envelope[tail] *= (remaining[tail] - 0.5) / release
+    assert np.allclose(out, envelope, atol=1e-6)
+
+
+def test_set_gain_ramp():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64, samplerate=48000)
+    action = m.play_buffer(np.ones(2000, 'float32'), 1)
+    m.process(128)
+    m.set_gain(action, 0.0, duration=256 / 48000)
+    out = m.render(600)[:, 0]
+    assert np.allclose(out[:256], 1 - (np.arange(256) + 1) / 256, atol=1e-5)
+    assert not out[256:].any()
+
+
+def test_routes():
+    m = rtmixer.VirtualMixer(channels=3, blocksize=64)
+    data = ramp(100)
+    m.play_buffer(data, 1, routes=[(1, 1, 0.5), (1, 3, -1)])
+    out = m.render(100)
+    assert np.allclose(out[:, 0], 0.5 * data[:, 0])
+    assert not out[:, 1].any()
+    assert np.allclose(out[:, 2], -data[:, 0])
+
+
+def test_bus_gain():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64, buses={'fx': 0.5})
+    m.play_buffer(np.ones(100, 'float32'), 1, bus='fx')
+    m.play_buffer(np.ones(100, 'float32'), 1)
+    out = m.render(100)[:, 0]
+    assert np.allclose(out, 1.5)
+    with pytest.raises(ValueError):
+        m.play_buffer(np.ones(10, 'float32'), 1, bus='nope')
+
+
+def test_sample_bank_trigger():
+    data = ramp(100, 2)
+    bank = rtmixer.SampleBank({'a': data, 'b': data[:, 0].copy()})
+    m = rtmixer.VirtualMixer(channels=2, blocksize=64)
+    m.register_samples(bank)
+    m.trigger('a', gain=0.5)
+    m.trigger('b', channels=[2])
+    out = m.render(100)
+    assert np.allclose(out[:, 0], 0.5 * data[:, 0])
+    assert np.allclose(out[:, 1], 0.5 * data[:, 1] + data[:, 0])
+    with pytest.raises(ValueError):
+        m.trigger('c')
+
+
+def test_sample_bank_int16():
+    data = np.linspace(-1, 1, 101, dtype='float32')
+    bank = rtmixer.SampleBank([data], dtype='int16')
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64)
+    m.register_samples(bank)
+    m.trigger(0)
+    out = m.render(101)[:, 0]
+    assert np.allclose(out, data, atol=1 / 2 ** 15)
+
+
+def test_playlist_starts_empty_without_belated():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64, samplerate=1000)
+    playlist = m.play_playlist(channels=1, continue_on_xrun=True,
+                               allow_belated=False, start_frame=10)
+    m.process(128)
+    playlist.append(np.ones(100, 'float32'))
+    out = m.render(128)[:, 0]
+    assert np.array_equal(out, np.arange(128) < 100)
+    m.cancel(playlist.action)
+    m.process(64)
+    [result] = [r for r in m.results() if r.type == 'play_playlist']
+    assert result.reason == 'cancelled'
+    assert np.isclose(result.actual_time, 0.01)
+    assert m.load_stats.started == 1
+
+
+def test_ringbuffer_starts_empty_without_belated():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64, samplerate=1000,
+                             telemetrysize=16)
+    ringbuffer = rtmixer.RingBuffer(4, 256)
+    action = m.play_ringbuffer(ringbuffer, 1, continue_on_xrun=True,
+                               allow_belated=False, start_frame=10)
+    m.process(192)
+    ringbuffer.write(np.ones(100, 'float32'))
+    out = m.render(128)[:, 0]
+    assert np.array_equal(out, np.arange(128) < 100)
+    m.cancel(action)
+    m.process(64)
+    [result] = [r for r in m.results() if r.type == 'play_ringbuffer']
+    assert result.reason == 'cancelled'
+    assert result.frames == 100
+    assert np.isclose(result.actual_time, 0.01)
+    assert m.load_stats.started == 1
+    assert [r.started for r in m.telemetry()] == [1, 0, 0, 0, 0, 0]
+
+
+def test_set_gain_at_frame():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64)
+    action = m.play_buffer(np.ones(2000, 'float32'), 1)
+    m.process(64)
+    m.set_gain(action, 0.0, duration=100 / 48000, frame=100)
+    m.set_gain(action, 0.5, frame=300)
+    out = m.render(400)[:, 0]
+    assert np.all(out[:36] == 1)
+    assert np.allclose(out[36:136], 1 - (np.arange(100) + 1) / 100,
+                       atol=1e-5)
+    assert not out[136:236].any()
+    assert np.all(out[236:] == 0.5)
+
+
+def test_set_gain_before_start_in_same_block():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64)
+    action = m.play_buffer(np.ones(100, 'float32'), 1, start_frame=10)
+    m.set_gain(action, 0.5, frame=40)
+    out = m.render(128)[:, 0]
+    assert not out[:10].any()
+    assert np.all(out[10:40] == 1)
+    assert np.all(out[40:110] == 0.5)
+
+
+def test_set_gain_rejects_playlist():
+    m = rtmixer.VirtualMixer(channels=1)
+    playlist = m.play_playlist(channels=1)
+    with pytest.raises(ValueError):
+        m.set_gain(playlist.action, 0.5)
@@ -0,0 +1,108 @@
+"""Recording and metering tests using the virtual streams."""
+import numpy as np
+
+import rtmixer
+
+
+def test_record_buffer():
+    signal = np.arange(2 * 300, dtype='float32').reshape(300, 2) / 1000
+    r = rtmixer.VirtualRecorder(channels=2, blocksize=64, input=signal)
+    buffer = np.zeros((200, 2), 'float32')
+    r.record_buffer(buffer, 2)
+    r.process(300)
+    assert np.array_equal(buffer, signal[:200])
+
+
+def test_record_int16_with_mapping():
+    signal = np.linspace(-0.5, 0.5, 200, dtype='float32').reshape(100, 2)
+    r = rtmixer.VirtualRecorder(channels=2, blocksize=64, input=signal)
+    buffer = np.zeros(100, 'int16')
+    r.record_buffer(buffer, [2])
+    r.process(100)
+    assert np.allclose(buffer / 2 ** 15, signal[:, 1], atol=1 / 2 ** 15)
+
+
+def test_record_ringbuffer():
+    signal = np.arange(500, dtype='float32') / 1000
+    r = rtmixer.VirtualRecorder(channels=1, blocksize=64, input=signal)
+    ringbuffer = rtmixer.RingBuffer(4, 512)
+    r.record_ringbuffer(ringbuffer, 1)
+    r.process(500)
+    data = np.zeros(500, 'float32')
+    assert ringbuffer.read(data) == 500
+    assert np.array_equal(data, signal)
+
+
+def test_duplex_delay():
+    signal = np.zeros(256, 'float32')
+    signal[10] = 1.0
+    s = rtmixer.VirtualMixerAndRecorder(channels=(1, 1), blocksize=64,
+                                        input=signal)
+    buffer = np.zeros(256, 'float32')
+    s.record_buffer(buffer, 1)
+    s.process(256)
+    out = np.zeros((256, 1), 'float32')
+    s.play_buffer(buffer, 1)
+    s.process(256, out=out)
+    assert np.flatnonzero(out[:, 0]).tolist() == [10]
+
+
+def test_record_buffer_start_frame():
+    signal = np.arange(2 * 300, dtype='float32').reshape(300, 2) / 1000
+    r = rtmixer.VirtualRecorder(channels=2, blocksize=64, input=signal)
+    buffer = np.zeros((200, 2), 'float32')
+    r.record_buffer(buffer, 2, start_frame=50)
+    r.process(300)
+    assert np.array_equal(buffer, signal[50:250])
+
+
+def test_input_levels():
+    signal = np.zeros((1000, 2), 'float32')
+    signal[:, 0] = 0.5
+    signal[300, 1] = -1.0
+    r = rtmixer.VirtualRecorder(channels=2, blocksize=64, input=signal,
+                                metering=True)
+    r.process(1000)
+    levels = r.input_levels()
+    assert levels.frames == 1000
+    assert np.allclose(levels.peak, [0.5, 1.0])
+    assert np.allclose(levels.rms, [0.5, np.sqrt(1 / 1000)])
+    assert levels.clipped == [0, 1]
+    # The input is exhausted, silence follows:
+    r.process(64)
+    levels = r.input_levels()
+    assert levels.frames == 64
+    assert np.allclose(levels.peak, [0.0, 0.0])
+
+
+def test_output_levels():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64, metering=True)
+    m.play_buffer(np.full(100, 0.25, 'float32'), 1)
+    m.process(200)
+    levels = m.output_levels()
+    assert levels.frames == 200
+    assert np.isclose(levels.peak[0], 0.25)
+    assert np.isclose(levels.rms[0], 0.25 * np.sqrt(0.5))
+    # Nothing has been processed since:
+    levels = m.output_levels()
+    assert levels.frames == 0
+    assert levels.peak == [0.0]
+    assert levels.rms == [0.0]
+    assert levels.clipped == [0]
+
+
+def test_levels_acknowledged_late():
+    signal = np.concatenate([np.full(64, x, 'float32') for x in (.9, .5, .2)])
+    r = rtmixer.VirtualRecorder(channels=1, blocksize=64, input=signal,
+                                metering=True)
+    meter = r._meters['input'][0]
+    r.process(64)
+    # Python reads the first snapshot, but acknowledges it only after the
+    # callback has already published the next one:
+    read = meter.seq // 2
+    r.process(64)
+    meter.acknowledged = read
+    r.process(64)
+    levels = r.input_levels()
+    assert levels.frames == 128
+    assert np.isclose(levels.peak[0], 0.5)
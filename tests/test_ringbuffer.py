@@ -0,0 +1,71 @@
+"""Tests for the RingBuffer class (no audio stream needed)."""
+import numpy as np
+import pytest
+
+import rtmixer
+
+
+def test_arrays_wrap_around():
+    ringbuffer = rtmixer.RingBuffer(8, 16)  # Two float32 channels
+    data = np.arange(40, dtype='float32').reshape(20, 2)
+    assert ringbuffer.write_array(data[:12]) == 12
+    size, array1, array2 = ringbuffer.get_read_arrays(10)
+    assert size == 10
+    assert array1.shape == (10, 2)
+    assert len(array2) == 0
+    assert np.array_equal(array1, data[:10])
+    ringbuffer.advance_read_index(10)
+    # The second region starts at the beginning of the buffer:
+    size, array1, array2 = ringbuffer.get_write_arrays(8)
+    assert size == 8
+    assert len(array1) == len(array2) == 4
+    assert ringbuffer.write_array(data[12:]) == 8
+    out = np.zeros((20, 2))  # Converted from float32
+    assert ringbuffer.read_into(out) == 10
+    assert np.array_equal(out[:10], data[10:])
+
+
+def test_arrays_are_views():
+    ringbuffer = rtmixer.RingBuffer(4, 8)
+    _, array, _ = ringbuffer.get_write_arrays(1)
+    array[0] = 0.5
+    ringbuffer.advance_write_index(1)
+    data = np.zeros(1, 'float32')
+    assert ringbuffer.read(data) == 1
+    assert data[0] == 0.5
+
+
+def test_shared_memory():
+    shared_memory = pytest.importorskip('multiprocessing.shared_memory')
+    size = rtmixer.RingBuffer.required_size(4, 16)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    # A second mapping of the same memory, as in another process:
+    other = shared_memory.SharedMemory(shm.name)
+    try:
+        ringbuffer = rtmixer.RingBuffer(4, 16, shm.buf)
+        attached = rtmixer.RingBuffer.attach(other.buf)
+        assert attached.size == 16
+        assert attached.elementsize == 4
+        data = np.arange(20, dtype='float32')
+        assert attached.write(data[:12]) == 12
+        out = np.zeros(10, 'float32')
+        assert ringbuffer.read(out) == 10
+        assert attached.write(data[12:]) == 8  # Wraps around
+        out = np.zeros(10, 'float32')
+        assert attached.read(out) == 10
+        assert np.array_equal(out, data[10:])
+        m = rtmixer.VirtualMixer(channels=1)
+        with pytest.raises(ValueError):
+            m.play_ringbuffer(attached, 1)
+        del ringbuffer, attached  # The memory must be released
+    finally:
+        other.close()
+        shm.close()
+        shm.unlink()
+
+
+def test_attach_invalid_memory():
+    with pytest.raises(ValueError):
+        rtmixer.RingBuffer.attach(bytearray(100))
+    with pytest.raises(ValueError):
+        rtmixer.RingBuffer.attach(bytearray(10))
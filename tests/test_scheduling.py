@@ -0,0 +1,182 @@
+"""Scheduling and cancellation tests using VirtualMixer."""
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+import rtmixer
+
+
+def onsets(signal):
+    """Frame numbers where the signal becomes non-zero."""
+    nonzero = np.concatenate([[False], signal != 0])
+    return list(np.flatnonzero(nonzero[1:] & ~nonzero[:-1]))
+
+
+def test_start_time():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64, samplerate=1000)
+    click = np.ones(10, 'float32')
+    action = m.play_buffer(click, 1, start=0.1)
+    out = m.render(200)[:, 0]
+    assert onsets(out) == [100]
+    assert np.isclose(action.actual_time, 0.1)
+
+
+def test_pending_heap_order():
+    # More actions than fit into the pending heap, in random order:
+    m = rtmixer.VirtualMixer(channels=1, blocksize=32, samplerate=1000,
+                             pendingsize=16, qsize=256)
+    click = np.ones(1, 'float32')
+    frames = np.random.RandomState(0).permutation(100) * 10 + 5
+    for frame in frames:
+        m.play_buffer(click, 1, start=frame / 1000)
+    out = m.render(1100)[:, 0]
+    assert onsets(out) == sorted(frames)
+
+
+def test_cancel():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64, samplerate=1000)
+    buffer = np.ones(1000, 'float32')
+    action = m.play_buffer(buffer, 1)
+    m.cancel(action, time=0.1)
+    out = m.render(300)[:, 0]
+    assert np.array_equal(out, np.arange(300) < 100)
+    assert action.status == rtmixer._lib.FINISHED
+
+
+def test_cancel_before_start():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64, samplerate=1000)
+    buffer = np.ones(100, 'float32')
+    action = m.play_buffer(buffer, 1, start=0.5)
+    m.process(64)
+    m.cancel(action, time=0.2)
+    out = m.render(800)[:, 0]
+    assert not out.any()
+    assert action.status == rtmixer._lib.FINISHED
+    assert action.end_reason == rtmixer._lib.CANCELLED
+
+
+def test_cancel_all_by_group():
+    m = rtmixer.VirtualMixer(channels=2, blocksize=64, samplerate=1000)
+    buffer = np.ones(1000, 'float32')
+    a = m.play_buffer(buffer, [1], group=1)
+    b = m.play_buffer(buffer, [2], group=2)
+    m.process(64)
+    m.cancel_all(group=1, time=0.1)
+    out = m.render(300)
+    assert np.array_equal(out[:, 0], np.arange(64, 364) < 100)
+    assert out[:, 1].all()
+    assert a.status == rtmixer._lib.FINISHED
+    assert b.status != rtmixer._lib.FINISHED
+
+
+def test_wait_is_notified():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64)
+    buffer = np.ones(100, 'float32')
+    action = m.play_buffer(buffer, 1)
+    assert not m.wait(action, timeout=0)
+    assert m.actions == {action}
+    # The waiting thread is woken up by the callback running elsewhere:
+    threading.Timer(0.05, m.process, [128]).start()
+    assert m.wait(action, timeout=5)
+    assert m.actions == set()
+
+
+def test_wait_async():
+    async def main():
+        m = rtmixer.VirtualMixer(channels=1, blocksize=64)
+        finished = m.finished_actions()
+        buffer = np.ones(100, 'float32')
+        action = m.play_buffer(buffer, 1)
+        future = m.wait_async(action)
+        m.process(128)
+        assert await asyncio.wait_for(future, 5) is action
+        assert await asyncio.wait_for(finished.__anext__(), 5) is action
+        m.close()
+
+    asyncio.run(main())
+
+
+def test_start_frame_is_sample_accurate():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64)
+    click = np.ones(1, 'float32')
+    frames = [0, 2, 63, 65, 127, 200, 511]
+    for frame in frames:
+        m.play_buffer(click, 1, start_frame=frame)
+    out = m.render(600)[:, 0]
+    assert onsets(out) == frames
+
+
+def test_cancel_at_frame():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64)
+    action = m.play_buffer(np.ones(1000, 'float32'), 1)
+    m.cancel(action, frame=100)
+    out = m.render(300)[:, 0]
+    assert np.array_equal(out, np.arange(300) < 100)
+    assert m.results()[-1].reason == 'cancelled'
+
+
+def test_belated():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64)
+    m.process(128)
+    late = m.play_buffer(np.ones(10, 'float32'), 1, start_frame=10,
+                         allow_belated=False)
+    belated = m.play_buffer(np.ones(10, 'float32'), 1, start_frame=10)
+    m.process(64)
+    assert late.actual_time == 0.0
+    assert late.done_frames == 0
+    assert belated.done_frames == 10
+    reasons = {r.frames: r.reason for r in m.results()}
+    assert reasons == {0: 'too_late', 10: 'completed'}
+
+
+def test_wait_and_results():
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64)
+    action = m.play_buffer(np.ones(100, 'float32'), 1, group=7)
+    m.render()
+    assert m.wait(action, timeout=0)
+    results = m.results()
+    assert [(r.type, r.group, r.reason, r.frames) for r in results] == [
+        ('play_buffer', 7, 'completed', 100)]
+    assert m.results() == []
+
+
+def test_cancel_after_cancel_all():
+    # CANCEL_ALL compacts the pending heap, indices must stay valid
+    m = rtmixer.VirtualMixer(channels=1, blocksize=64)
+    actions = [m.play_buffer(np.ones(100, 'float32'), 1,
+                             start_frame=1000 + 100 * i, group=1 + i % 2)
+               for i in range(8)]
+    m.process(64)
+    m.cancel_all(group=1)
+    m.process(64)
+    m.cancel(actions[5])
+    m.process(64)
+    assert actions[5].end_reason == rtmixer._lib.CANCELLED
+    m.process(2000)
+    assert m.wait(timeout=1)
+    assert [a.end_reason for a in actions] == [
+        rtmixer._lib.CANCELLED if i % 2 == 0 or i == 5
+        else rtmixer._lib.COMPLETED for i in range(8)]
+
+
+def test_async_requires_running_loop():
+    m = rtmixer.VirtualMixer(channels=1)
+    with pytest.raises(RuntimeError):
+        m.finished_actions()
+
+
+def test_cancel_all_duplex():
+    signal = np.ones(1000, 'float32')
+    s = rtmixer.VirtualMixerAndRecorder(channels=(1, 1), blocksize=64,
+                                        input=signal)
+    buffer = np.zeros(1000, 'float32')
+    recording = s.record_buffer(buffer, 1)
+    playback = s.play_buffer(np.ones(1000, 'float32'), 1)
+    s.process(64)
+    s.cancel_all(frame=100)
+    out = s.render(300)[:, 0]
+    assert np.array_equal(out, np.arange(64, 364) < 100)
+    assert recording.done_frames == playback.done_frames == 100
+    assert np.array_equal(buffer, np.arange(1000) < 100)